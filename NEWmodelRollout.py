@@ -1,5 +1,4 @@
 import configparser
-import torch
 import h5py
 #torch.manual_seed(0)
 import customDatasetMakers
@@ -8,16 +7,20 @@ import numpy as np
 import sys
 import os
 import prediction_helpers
-import pickle
+import evaluation_helpers
+import pipeline_helpers
+import shutil
+import functools
+import concurrent.futures
 from train_helpers import make_bucket
-from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from dataSettings import get_denormalized_dic,normalizations
 from customDatasetMakers import state_to_dic
 from scipy import stats
-import copy
+import aggregate
+import customModels
 from aggregate import inference_model, train_model
 # for fake actuators
-from customDatasetMakers import get_state_indices_dic
+from customDatasetMakers import get_state_indices_dic, get_chain_bounds, get_batched_chain_bounds
 
 import matplotlib.pyplot as plt
 import matplotlib
@@ -34,41 +37,22 @@ plt.rc('legend', fontsize=SMALL_SIZE)    # legend fontsize
 plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
 plt.rc('lines',linewidth=4)
 
-import time
-
-MAX_NUMBER_OF_PREDICTIONS=100000
-MAX_NUMBER_OF_TIMES=300
 
 def extract_chains(array, min_length=1):
-    chains = []
-    chain_indices = []
-    current_chain = []
-    start_index = None
-    for index, value in enumerate(array):
-        if np.isnan(value):
-            if len(current_chain)>0:  # Check if the current chain is not empty
-                if len(current_chain)>=min_length:
-                    chains.append(current_chain)
-                    chain_indices.append((start_index, index - 1))
-                current_chain = []  # Reset the current chain
-                start_index = None
-        else:
-            if start_index is None:
-                start_index = index
-            current_chain.append(value)
-    if current_chain:  # Add the last chain if it exists
-        chains.append(current_chain)
-        chain_indices.append((start_index, index))
+    starts,ends=get_chain_bounds(array, min_length=min_length)
+    chains=[list(array[start:end+1]) for start,end in zip(starts,ends)]
+    chain_indices=list(zip(starts.tolist(),ends.tolist()))
     return chains, chain_indices
 
 def get_ml_truth(x_test,y_test,
                  profiles, parameters,
                  recorded_profiles=['zipfit_etempfit_rho','zipfit_itempfit_rho','zipfit_trotfit_rho'],
-                 prediction_length=20, nwarmup=0, use_fancy_normalization=False):
+                 prediction_length=20, nwarmup=0, use_fancy_normalization=False,
+                 calculations=[], actuators=[]):
     num_samples=len(y_test)
     num_profiles=len(profiles)
-    # just make this bigger than you think it needs to be
-    y=np.ones((num_samples,num_profiles,MAX_NUMBER_OF_TIMES,dataSettings.nx))*np.nan
+    num_result_times=prediction_helpers.get_num_result_times(max([len(arr) for arr in y_test], default=0)-nwarmup, prediction_length)
+    y=np.ones((num_samples,num_profiles,num_result_times,dataSettings.nx))*np.nan
     for sample_ind in range(num_samples):
         output_dic=state_to_dic(y_test[sample_ind], profiles, parameters)
         #### get input stuff (profile warmup and actuator trajectories
@@ -80,9 +64,9 @@ def get_ml_truth(x_test,y_test,
         ####
         denormed_dic=get_denormalized_dic(output_dic, use_fancy_normalization=use_fancy_normalization)
         for profile_ind,profile in enumerate(recorded_profiles):
-            num_times=len(denormed_dic[profile][nwarmup:])
-            y[sample_ind,profile_ind,:num_times]=denormed_dic[profile][nwarmup:]
-    return y[:,:,:prediction_length]
+            num_times=len(denormed_dic[profile][nwarmup:nwarmup+num_result_times])
+            y[sample_ind,profile_ind,:num_times]=denormed_dic[profile][nwarmup:nwarmup+num_result_times]
+    return y
         #for sig in parameters:
         # remember this returns actuators at the present AND NEXT time, hence -1 index below        
         # input_dic=state_to_dic(x_test[sample_ind], profiles, parameters, calculations, actuators)
@@ -98,19 +82,21 @@ def get_ml_profile_warmup_and_actuator_trajectory(x_test,
                                                   prediction_length=15, nwarmup=0, use_fancy_normalization=False):
     num_samples=len(x_test)
     profile_warmup=np.ones((num_samples,len(recorded_profiles),nwarmup+1,dataSettings.nx))*np.nan
-    # make this bigger than you think is necessary
-    actuator_trajectory=np.ones((num_samples,len(recorded_actuators),MAX_NUMBER_OF_TIMES))*np.nan
+    # each sample gives its actuators at every time plus the one after the last
+    num_result_times=prediction_helpers.get_num_result_times(max([len(arr) for arr in x_test], default=0)+1, prediction_length+nwarmup+1)
+    actuator_trajectory=np.ones((num_samples,len(recorded_actuators),num_result_times))*np.nan
     for sample_ind in range(num_samples):
         output_dic=state_to_dic(x_test[sample_ind], profiles, parameters, calculations, actuators)
         denormed_dic=get_denormalized_dic(output_dic, use_fancy_normalization=use_fancy_normalization)
         for profile_ind,profile in enumerate(recorded_profiles):
             profile_warmup[sample_ind,profile_ind]=denormed_dic[profile][:nwarmup+1]
         for actuator_ind,actuator in enumerate(recorded_actuators):
-            num_times=len(denormed_dic[actuator])
-            actuator_trajectory[sample_ind,actuator_ind,:num_times]=denormed_dic[actuator][:,0]
-            actuator_trajectory[sample_ind,actuator_ind,num_times]=denormed_dic[actuator][-1,1]
-    return profile_warmup, actuator_trajectory[:,:,:prediction_length+nwarmup+1]
+            trajectory=np.append(denormed_dic[actuator][:,0], denormed_dic[actuator][-1,1])[:num_result_times]
+            actuator_trajectory[sample_ind,actuator_ind,:len(trajectory)]=trajectory
+    return profile_warmup, actuator_trajectory
 
+# num_rollout_steps is unused, kept so old calls still work
+# with return_uncertainty also returns the profiles' spread over ensemble members (same shape as the predictions)
 def get_ml_predictions(x_test, y_test,
                 profiles, parameters, calculations, actuators,
                 considered_models,
@@ -119,168 +105,530 @@ def get_ml_predictions(x_test, y_test,
                 prediction_length=15,nwarmup=0,
                 use_fancy_normalization=False,
                 num_rollout_steps=400,
-                bucket_size=10000):
-    test_x_buckets = make_bucket(x_test, bucket_size)
-    test_y_buckets = make_bucket(y_test, bucket_size)
-    test_length_buckets = [[len(arr) for arr in bucket] for bucket in test_x_buckets]
-    # used to help index stuff later
-    running_num_samples=np.insert(np.cumsum([len(bucket) for bucket in test_x_buckets]),0,0)
-    num_keys=len(x_test)
-    num_profiles=len(recorded_profiles)
-    yhat=np.ones((num_keys,num_profiles,MAX_NUMBER_OF_TIMES,dataSettings.nx))*np.nan
-    yhat_error=np.ones((num_keys,num_profiles,MAX_NUMBER_OF_TIMES,dataSettings.nx))*np.nan
-    begin_time=time.time()
-    prev_time=begin_time
-    evaluation_begin_time=time.time()
-    prev_time=evaluation_begin_time
-    with torch.no_grad():
-        sample_ind=0
-        for which_bucket in range(len(test_x_buckets)):
-            x_bucket=test_x_buckets[which_bucket]
-            y_bucket=test_y_buckets[which_bucket]
-            length_bucket=test_length_buckets[which_bucket]
-            padded_x=pad_sequence(x_bucket, batch_first=True)
-            padded_y=pad_sequence(y_bucket, batch_first=True)
-            #padded_x=padded_x.to(device)
-            #padded_y=padded_y.to(device)
-            # only save simulations after warmup is over
-            # see note above, taking out ability to ensemble models
-            # since the ethos should be considering different ML and sim
-            # models on equal footing
-            model_output=torch.zeros_like(padded_y)
-            for model in considered_models:
-                #model=considered_models[0]
-                model_output+=model(padded_x, reset_probability=0, nwarmup=nwarmup)
-            model_output/=len(considered_models)
-            unpadded_output=unpad_sequence(model_output, length_bucket, batch_first=True)
-            for which_output,output in enumerate(unpadded_output):
-                output_dic=state_to_dic(output, profiles, parameters)
-                #### get input stuff (profile warmup and actuator trajectories
-                # only needed for 
-                input_dic=state_to_dic(x_test[sample_ind], profiles, parameters, calculations, actuators)
-                if use_fancy_normalization:
-                    for actuator in actuators:
-                        output_dic[actuator]=input_dic[actuator][:,-1]
-                ####
-                denormed_dic=get_denormalized_dic(output_dic, use_fancy_normalization=use_fancy_normalization)
-                for profile_ind,profile in enumerate(recorded_profiles):
-                    num_times=len(denormed_dic[profile][nwarmup:])
-                    yhat[sample_ind,profile_ind,:num_times]=denormed_dic[profile][nwarmup:]
-                sample_ind+=1
-                #for sig in parameters:
-                    #yhat[sample_ind,profile_ind,:prediction_length]=denormed_dic[sig][nwarmup:prediction_length+nwarmup]
-            print(f'Bucket {which_bucket+1}/{len(test_x_buckets)} took {time.time()-prev_time:0.0f}s')
-            prev_time=time.time()
-    print(f'Took {time.time()-begin_time:.2f} s')
-    return yhat[:,:,:prediction_length]
+                bucket_size=10000,
+                return_uncertainty=False,
+                padded_buckets=None,
+                input_columns=slice(None),
+                output_columns=slice(None)):
+    predictions=prediction_helpers.get_ml_predictions(x_test, y_test,
+                                                 profiles, parameters, calculations, actuators,
+                                                 considered_models,
+                                                 recorded_profiles=recorded_profiles,
+                                                 recorded_actuators=recorded_actuators,
+                                                 prediction_length=prediction_length, nwarmup=nwarmup,
+                                                 use_fancy_normalization=use_fancy_normalization,
+                                                 bucket_size=bucket_size,
+                                                 return_uncertainty=return_uncertainty,
+                                                 padded_buckets=padded_buckets,
+                                                 input_columns=input_columns, output_columns=output_columns)
+    if return_uncertainty:
+        return predictions[0], predictions[2]['profiles_std']
+    return predictions[0]
+
+ASTRA_NAME_MAP={'zipfit_etempfit_rho': 'TE', 'zipfit_itempfit_rho': 'TI', 'zipfit_trotfit_rho': 'UPAR', 'zipfit_edensfit_rho': 'NE', 'qpsi_EFIT01': 'MU',
+                'zeff_rho': 'ZEF'}
+ASTRA_EXPERIMENT_NAMES={'TE': 'TEX', 'TI': 'TIX', 'UPAR': 'VTORX', 'NE': 'NEX', 'MU': 'MUX', 'ZEF': 'ZEF'}
+
+# reads every rollout (run of non-NaN TE) of one shot: each needed dataset is read from the h5 once with [:], then all
+# rollouts are cut out together by fancy indexing with the (flattened) time indices of every rollout
+# returns the start indices, the number of kept prediction times per rollout, and the kept
+# predictions/truth concatenated over rollouts with shape (sum of kept times, profile, rho)
+# chain_starts and chain_ends are the bounds of the shot's rollouts, see get_batched_chain_bounds
+def read_sim_shot(h5_path, shot, chain_starts, chain_ends, sim_name, recorded_profile_astra_names, prediction_length,
+                  ntimestep_delay=0, use_delta=False, return_truth=False):
+    with h5py.File(h5_path,'r') as f:
+        group=f[shot]
+        # start_index is the time from which the first prediction is made
+        # we also save 1 point before this hence +1 throughout
+        start_indices=chain_starts+ntimestep_delay
+        end_indices=chain_ends+1
+        num_times=np.clip(end_indices-(start_indices+1), 0, prediction_length)
+        first_indices=np.repeat(start_indices, num_times)
+        time_indices=first_indices+1+np.arange(num_times.sum())-np.repeat(np.cumsum(num_times)-num_times, num_times)
+        trajectory=np.ones((len(time_indices),len(recorded_profile_astra_names),dataSettings.nx))*np.nan
+        truth_trajectory=np.ones((len(time_indices),len(recorded_profile_astra_names),dataSettings.nx))*np.nan
+        if len(time_indices)>0:
+            for profile_ind, profile in enumerate(recorded_profile_astra_names):
+                expt_profile=ASTRA_EXPERIMENT_NAMES[profile]
+                sim_data=group[f'{profile}_{sim_name}'][:]
+                if use_delta or return_truth:
+                    expt_data=group[f'{expt_profile}_{sim_name}'][:]
+                if use_delta:
+                    # usually this is used for ntimestep_delay
+                    trajectory[:,profile_ind]=expt_data[first_indices]+(sim_data[time_indices]-sim_data[first_indices])
+                else:
+                    trajectory[:,profile_ind]=sim_data[time_indices]
+                if return_truth:
+                    truth_trajectory[:,profile_ind]=expt_data[time_indices]
+                if profile=='MU':
+                    trajectory[:,profile_ind]=1./trajectory[:,profile_ind]
+                    if return_truth:
+                        truth_trajectory[:,profile_ind]=1./trajectory[:,profile_ind]
+                if profile=='UPAR':
+                    upar_scaling=1./(1.e3*group[f'rgeo_{sim_name}'][:][time_indices][:,None])
+                    trajectory[:,profile_ind]=trajectory[:,profile_ind]*upar_scaling
+                    if return_truth:
+                        truth_trajectory[:,profile_ind]=truth_trajectory[:,profile_ind]*upar_scaling
+    return start_indices, end_indices, num_times, trajectory, truth_trajectory
 
 # use_delta and return_truth are obsolete with newer versions, where I deal with that stuff on the ASTRA side
 # max_num_shots is helpful for testing
+# shots are read in parallel over num_workers processes (None for all cores, 0 to read in this process)
 def get_sim_predictions_shots_times(sim_name, sim_dir, prediction_length,
                                     recorded_profiles=['zipfit_etempfit_rho','zipfit_itempfit_rho','zipfit_trotfit_rho'],
                                     min_length=5,
                                     ntimestep_delay=0,
                                     use_delta=False,
                                     max_num_shots=None,
-                                    return_truth=False):
+                                    return_truth=False,
+                                    num_workers=None):
     h5_path=os.path.join(sim_dir,sim_name+'.h5')
-    name_map={'zipfit_etempfit_rho': 'TE', 'zipfit_itempfit_rho': 'TI', 'zipfit_trotfit_rho': 'UPAR', 'zipfit_edensfit_rho': 'NE', 'qpsi_EFIT01': 'MU',
-              'zeff_rho': 'ZEF'}
-    recorded_profile_astra_names=[name_map[profile] for profile in recorded_profiles]
-    experiment_names={'TE': 'TEX', 'TI': 'TIX', 'UPAR': 'VTORX', 'NE': 'NEX', 'MU': 'MUX', 'ZEF': 'ZEF'}
-    y=np.ones((MAX_NUMBER_OF_PREDICTIONS,len(recorded_profiles),MAX_NUMBER_OF_TIMES,dataSettings.nx))*np.nan
-    yhat=np.ones((MAX_NUMBER_OF_PREDICTIONS,len(recorded_profiles),MAX_NUMBER_OF_TIMES,dataSettings.nx))*np.nan
-    with h5py.File(h5_path) as f:
-        print('loading h5')
+    recorded_profile_astra_names=[ASTRA_NAME_MAP[profile] for profile in recorded_profiles]
+    print('loading h5')
+    with h5py.File(h5_path,'r') as f:
         shots=list(f.keys())
         if max_num_shots is not None:
             shots=shots[:max_num_shots]
-        print('h5 loaded, reading in simulation data')
-        key_ind=0
-        sim_times=[]
-        sim_shots=[]
-        trajectory_lengths=[]
-        for nshot,shot in enumerate(shots):
-            # in future might want to make this more lenient, for now force to have the right number of timesteps
-            _,indices=extract_chains(f[shot][f'TE_{sim_name}'][:,0],min_length=min_length)
-            for indices_index in range(len(indices)):
-                # start_index is the time from which the first prediction is made
-                # we also save 1 point before this hence +1 throughout
-                start_index=indices[indices_index][0]+ntimestep_delay
-                end_index=indices[indices_index][1]+1
-                trajectory_lengths.append(end_index-start_index)
-                start_time=int(start_index*dataSettings.DT*1e3)
-                sim_times.append(start_time)
-                sim_shots.append(int(shot))
-                num_available_prediction_times=end_index-(start_index+1)
-                for profile_ind, profile in enumerate(recorded_profile_astra_names):
-                    expt_profile=experiment_names[profile]
-                    if use_delta:
-                        # usually this is used for ntimestep_delay
-                        yhat[key_ind,profile_ind,:num_available_prediction_times]=f[shot][f'{expt_profile}_{sim_name}'][start_index]+\
-                            (f[shot][f'{profile}_{sim_name}'][start_index+1:end_index]-f[shot][f'{profile}_{sim_name}'][start_index])
-                    else:
-                        yhat[key_ind,profile_ind,:num_available_prediction_times]=f[shot][f'{profile}_{sim_name}'][start_index+1:end_index]
-                    if return_truth:
-                        y[key_ind,profile_ind,:num_available_prediction_times]=f[shot][f'{expt_profile}_{sim_name}'][start_index+1:end_index]
-                    #all_info[key]['truth']['profiles'][name_map[predicted_sig]]=f[shot][f'{experiment_names[predicted_sig]}_{sim_name}'][start_index:end_index]
-                    if profile=='MU':
-                        yhat[key_ind,profile_ind]=1./yhat[key_ind,profile_ind]
-                        if return_truth:
-                            y[key_ind,profile_ind]=1./yhat[key_ind,profile_ind]
-                    if profile=='UPAR':
-                        upar_scaling=1./(1.e3*f[shot][f'rgeo_{sim_name}'][start_index+1:end_index][:,None])
-                        yhat[key_ind,profile_ind,:len(upar_scaling)]=yhat[key_ind,profile_ind,:len(upar_scaling)]*upar_scaling
-                        if return_truth:
-                            y[key_ind,profile_ind,:len(upar_scaling)]=y[key_ind,profile_ind,:len(upar_scaling)]*upar_scaling
-                key_ind+=1
-        unique, counts = np.unique(trajectory_lengths, return_counts=True)
-        print(dict(zip(unique,counts)))
+        # in future might want to make this more lenient, for now force to have the right number of timesteps
+        # rollouts are where TE is set, found for all shots at once
+        shot_inds,all_chain_starts,all_chain_ends=get_batched_chain_bounds([f[shot][f'TE_{sim_name}'][:,0] for shot in shots],
+                                                                           min_length=min_length)
+    shot_chain_starts=np.split(all_chain_starts, np.searchsorted(shot_inds, np.arange(1,len(shots))))
+    shot_chain_ends=np.split(all_chain_ends, np.searchsorted(shot_inds, np.arange(1,len(shots))))
+    print('h5 loaded, reading in simulation data')
+    read_shot=functools.partial(read_sim_shot, h5_path,
+                                sim_name=sim_name, recorded_profile_astra_names=recorded_profile_astra_names,
+                                prediction_length=prediction_length,
+                                ntimestep_delay=ntimestep_delay, use_delta=use_delta, return_truth=return_truth)
+    if num_workers==0:
+        shot_results=list(map(read_shot, shots, shot_chain_starts, shot_chain_ends))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+            shot_results=list(executor.map(read_shot, shots, shot_chain_starts, shot_chain_ends,
+                                           chunksize=max(1,len(shots)//(4*(num_workers or os.cpu_count() or 1)))))
+    sim_shots=[]
+    sim_times=[]
+    trajectory_lengths=[]
+    num_times=[]
+    for shot,(start_indices,end_indices,shot_num_times,_,_) in zip(shots,shot_results):
+        sim_shots.extend([int(shot)]*len(start_indices))
+        sim_times.extend([int(start_index*dataSettings.DT*1e3) for start_index in start_indices])
+        trajectory_lengths.extend(end_indices-start_indices)
+        num_times.extend(shot_num_times)
+    unique, counts = np.unique(trajectory_lengths, return_counts=True)
+    print(dict(zip(unique,counts)))
     print(f'Read in {len(sim_shots)} simulation rollouts')
-    return yhat[:key_ind,:,:prediction_length], sim_shots, sim_times, y[:key_ind,:,:prediction_length]
+    # each rollout keeps its own length (time first) and is only padded to prediction_length at the end
+    offsets=np.insert(np.cumsum(num_times, dtype=int),0,0)
+    trailing_shape=(len(recorded_profiles),dataSettings.nx)
+    yhat=np.concatenate([result[3] for result in shot_results]+[np.zeros((0,)+trailing_shape)])
+    yhat=np.moveaxis(prediction_helpers.RaggedArray(yhat, offsets).to_padded(prediction_length),1,2)
+    if return_truth:
+        y=np.concatenate([result[4] for result in shot_results]+[np.zeros((0,)+trailing_shape)])
+        y=np.moveaxis(prediction_helpers.RaggedArray(y, offsets).to_padded(prediction_length),1,2)
+    else:
+        y=np.ones(yhat.shape)*np.nan
+    return yhat, sim_shots, sim_times, y
+
+def read_sim_info(sim_name, sim_dir, **read_kwargs):
+    sim_yhat, sim_shots, sim_times, _=get_sim_predictions_shots_times(sim_name, sim_dir, **read_kwargs)
+    return {'shots': sim_shots, 'times': sim_times, 'data': sim_yhat}
+
+# cache for read_sim_info's output
+def save_sim_cache(sim_info, filename):
+    np.savez(filename, shots=np.array(sim_info['shots'], dtype=np.int64), times=np.array(sim_info['times'], dtype=np.int64),
+             data=sim_info['data'])
+
+def load_sim_cache(filename):
+    with np.load(filename) as cache:
+        return {'shots': cache['shots'].tolist(), 'times': cache['times'].tolist(), 'data': cache['data']}
 
 # takes info of form {dataset: {shots: [...], times: [...], data: [...]}} where ... is over samples
-# updates all 3 arrays of each dataset (in place) to have shared shot_times across datasets and be sorted
+# updates all 3 arrays of each dataset (in place) to have shared shot_times across datasets and be sorted (by shot then time)
 def subsample_info_to_shared_keys(all_info):
     print('Subsampling data to match shots/times, lengths of each dataset are:')
     print({dataset: len(all_info[dataset]['data']) for dataset in all_info})
-    shot_time_keys={dataset: [f"{all_info[dataset]['shots'][ind]}_{all_info[dataset]['times'][ind]}"
-                             for ind in range(len(all_info[dataset]['shots']))]
-                    for dataset in all_info}
-    shared_keys=sorted(list(set.intersection(*[set(shot_time_keys[dataset]) for dataset in all_info])))
-    shots=[int(key.split('_')[0]) for key in shared_keys]
-    times=[int(key.split('_')[1]) for key in shared_keys]
-    new_indices={dataset: [shot_time_keys[dataset].index(key) for key in shared_keys] for dataset in shot_time_keys}
-    for dataset in all_info:
+    datasets=list(all_info.keys())
+    shots,times,shared_indices=prediction_helpers.get_shared_shot_time_indices([all_info[dataset]['shots'] for dataset in datasets],
+                                                                                [all_info[dataset]['times'] for dataset in datasets])
+    shots=shots.tolist()
+    times=times.tolist()
+    for dataset,indices in zip(datasets,shared_indices):
         all_info[dataset]['shots']=shots
         all_info[dataset]['times']=times
-        all_info[dataset]['data']=all_info[dataset]['data'][new_indices[dataset]]
+        all_info[dataset]['data']=all_info[dataset]['data'][indices]
+        if 'std' in all_info[dataset]:
+            all_info[dataset]['std']=all_info[dataset]['std'][indices]
     num_samples=len(shots)
     print(f'{num_samples} samples from {len(np.unique(shots))} unique shots shared between {all_info.keys()}')
     return shots,times
 
+# reads a NEWmodelRollout manifest: an INI file (see rollout_manifests/) saying which ML models and
+# simulations to compare, on what data, and what to plot; anything left out takes the default below
+# [blend NAME] sections add model blends, and [colors]/[labels] set plot colors/legend labels per model
+# (write \n for a newline in a label)
+def read_rollout_manifest(manifest_filename):
+    config=configparser.ConfigParser(interpolation=None)
+    # model names are used as keys, so keep their case
+    config.optionxform=str
+    if len(config.read(manifest_filename))==0:
+        raise ValueError(f'Could not read manifest {manifest_filename}')
+    def get_list(section, option, fallback):
+        if config.has_option(section, option):
+            return config[section][option].split()
+        return fallback
+    # empty or None gives None (e.g. no ip cut)
+    def get_optional_float(section, option, fallback):
+        value=config.get(section, option, fallback=None)
+        if value is None:
+            return fallback
+        if value.strip() in ['','None']:
+            return None
+        return float(value)
+    manifest={}
+    manifest['raw_data_filename']=config.get('logistics','raw_data_filename',
+                                             fallback='/projects/EKOLEMEN/profile_predictor/raw_data/diiid_data.h5')
+    # stage outputs go in cache_dir under a hash of their inputs, with the least recently used
+    # deleted past cache_max_size (in GB); *_cache_filename put a stage's output at a fixed path instead
+    manifest['cache_dir']=config.get('logistics','cache_dir',fallback='rollout_cache')
+    manifest['cache_max_size']=get_optional_float('logistics','cache_max_size',100.)
+    manifest['data_cache_filename']=config.get('logistics','data_cache_filename',fallback=None)
+    manifest['blend_cache_filename']=config.get('logistics','blend_cache_filename',fallback=None)
+    manifest['metrics_cache_filename']=config.get('logistics','metrics_cache_filename',fallback=None)
+    manifest['ml_model_dir']=config.get('logistics','ml_model_dir',
+                                        fallback='/projects/EKOLEMEN/profile_predictor/final_paper_models/')
+    manifest['sim_dir']=config.get('logistics','sim_dir',fallback='/projects/EKOLEMEN/profile_predictor/sim_data/')
+
+    manifest['profiles']=get_list('data','profiles',['zipfit_etempfit_rho', 'zipfit_itempfit_rho', 'zipfit_trotfit_rho',
+                                                     'zipfit_edensfit_rho', 'zipfit_zdensfit_rho', 'qpsi_EFIT01'])
+    manifest['scalars']=get_list('data','scalars',['pinj','tinj','ech_pwr_total','ip','tribot_EFIT01','tritop_EFIT01','kappa_EFIT01','aminor_EFIT01',
+                                                   'rmaxis_EFIT01','volume_EFIT01','bt','D_tot','H_tot','He_tot','N_tot','Ne_tot',
+                                                   'dssdenest'])
+    manifest['ip_minimum']=get_optional_float('data','ip_minimum',1.0e6)
+    manifest['ip_maximum']=get_optional_float('data','ip_maximum',1.2e6)
+    # shots used when there are no simulations to take shots/times from
+    manifest['min_shot']=config.getint('data','min_shot',fallback=140000)
+    manifest['max_shot']=config.getint('data','max_shot',fallback=200000)
+    manifest['test_index']=config.getint('data','test_index',fallback=0)
+
+    manifest['nwarmup']=config.getint('settings','nwarmup',fallback=3)
+    manifest['prediction_length']=config.getint('settings','prediction_length',fallback=15)
+    manifest['recorded_profiles']=get_list('settings','recorded_profiles',['zipfit_etempfit_rho','zipfit_itempfit_rho','zipfit_trotfit_rho',
+                                                                           'zipfit_edensfit_rho', 'qpsi_EFIT01','zeff_rho'])
+    manifest['recorded_actuators']=get_list('settings','recorded_actuators',['pinj','ip','volume_EFIT01','rmaxis_EFIT01','aminor_EFIT01'])
+
+    # JANK: pop a "EPOCH***" on the end of an ML config name to use a specific epoch of a config file
+    manifest['ml_configs']=get_list('models','ml_configs',[])
+    # the truth everything is compared against comes from the ML configs' samples
+    if len(manifest['ml_configs'])==0:
+        raise ValueError(f'{manifest_filename} has no [models] ml_configs, which are needed for the truth to compare against')
+    manifest['considered_sims']=get_list('models','considered_sims',[])
+    manifest['use_ensemble']=config.getboolean('models','use_ensemble',fallback=False)
+    # 'script' or 'compile' to trace or torch.compile the models' autoregressive step
+    manifest['compile_mode']=config.get('models','compile_mode',fallback=None)
+    manifest['include_const_predictions']=config.getboolean('models','include_const_predictions',fallback=False)
+    manifest['model_blends']={}
+    for section in config.sections():
+        if section.startswith('blend '):
+            blend=section[len('blend '):]
+            manifest['model_blends'][blend]={'model_type': config[section].get('model_type',blend),
+                                             'model_filename': config[section].get('model_filename',None),
+                                             'relevant_models': config[section]['relevant_models'].split(),
+                                             'relevant_profiles': config[section]['relevant_profiles'].split(),
+                                             'retrain': config[section].getboolean('retrain',False)}
+
+    manifest['plotted_profiles']=get_list('plots','plotted_profiles',manifest['recorded_profiles'])
+    manifest['plotted_actuators']=get_list('plots','plotted_actuators',manifest['recorded_actuators'])
+    for plot in ['plot_sigma_bar','plot_sigma_time','plot_over_rho','plot_over_time']:
+        manifest[plot]=config.getboolean('plots',plot,fallback=False)
+    manifest['sigma_bar_title']=config.get('plots','sigma_bar_title',fallback=r'$\sigma$ error on $1.0MA<I_p<1.2MA$')
+    manifest['model_colors']={}
+    manifest['model_name_map']={}
+    for section,key in [('colors','model_colors'),('labels','model_name_map')]:
+        if config.has_section(section):
+            manifest[key]={model.replace('\\n','\n'): value.replace('\\n','\n') for model,value in config[section].items()}
+    return manifest
+
+# preprocesses the data to compare on into filename: the shots/times all the simulations
+# share if there are any, otherwise the test shots between min_shot and max_shot
+def make_rollout_data(*sim_infos, filename, sim_names, raw_data_filename, profiles, scalars,
+                      ip_minimum, ip_maximum, nwarmup, prediction_length, min_shot, max_shot, test_index):
+    if len(sim_infos)>0:
+        print('Computing dataset with simulation shots/timebounds')
+        # copies since subsampling is in place
+        shots_to_preprocess,sim_times=subsample_info_to_shared_keys({sim_name: dict(sim_info) for sim_name,sim_info in zip(sim_names,sim_infos)})
+        time_bounds_to_preprocess=[]
+        # ML's first output is 20ms ahead of the start time
+        # similarly if we want the last prediction we have to get one extra
+        for sample_ind in range(len(sim_times)):
+            time_bounds_to_preprocess.append([sim_times[sample_ind]-nwarmup*dataSettings.DT*1.e3,
+                                              sim_times[sample_ind]+prediction_length*dataSettings.DT*1.e3])
+    else:
+        shots_to_preprocess=[shot for shot in range(min_shot,max_shot) if shot%10 in [test_index]]
+        time_bounds_to_preprocess=None
+    customDatasetMakers.preprocess_data(filename,
+                                        raw_data_filename,profiles,scalars,
+                                        shots=shots_to_preprocess, time_bounds=time_bounds_to_preprocess,
+                                        exclude_ech=False,
+                                        ip_minimum=ip_minimum,ip_maximum=ip_maximum,
+                                        zero_fill_signals=['ech_pwr_total','pinj','tinj'])
+
+# super jank: an ML config name like basenameconfigEPOCH500 means that config's model at epoch 500
+def split_ml_config(ml_config, ml_model_dir):
+    config_name_info=ml_config.split('EPOCH')
+    if len(config_name_info)>1:
+        return os.path.join(ml_model_dir, config_name_info[0]), int(config_name_info[1])
+    return os.path.join(ml_model_dir, ml_config), None
+
+# contents of an ML config and the checkpoints it loads, so changing or retraining a model
+# changes its stage's signature (normalization settings are in the config)
+def get_ml_config_version(ml_config, ml_model_dir, use_ensemble):
+    config_filename,epoch=split_ml_config(ml_config, ml_model_dir)
+    model_files=prediction_helpers.get_model_files(config_filename, ensemble=use_ensemble, epoch=epoch)
+    return {'config': pipeline_helpers.get_file_hash(config_filename),
+            'checkpoints': [pipeline_helpers.get_file_hash(model_file) for model_file in model_files]}
+
+# the signals an ML config's models take and how they're normalized
+def get_ml_input_settings(ml_config, ml_model_dir):
+    config_filename,_=split_ml_config(ml_config, ml_model_dir)
+    config=configparser.ConfigParser()
+    config.read(config_filename)
+    return {'profiles': config['inputs']['profiles'].split(),
+            'parameters': config['inputs'].get('parameters','').split(),
+            'calculations': config['inputs'].get('calculations','').split(),
+            'actuators': config['inputs']['actuators'].split(),
+            'use_fancy_normalization': config['preprocess'].getboolean('use_fancy_normalization',False)}
+
+# every signal any of input_settings_list (see get_ml_input_settings) takes, so the samples read
+# with them are shared by all; fancy normalization only if they all use it
+def get_shared_input_settings(input_settings_list):
+    shared_settings={key: sorted(set(signal for settings in input_settings_list for signal in settings[key]))
+                     for key in ['profiles','parameters','calculations','actuators']}
+    shared_settings['use_fancy_normalization']=all(settings['use_fancy_normalization'] for settings in input_settings_list)
+    return shared_settings
+
+# (normalized) samples with the signals in input_settings (see get_ml_input_settings) from the
+# preprocessed data in data_filename
+def get_ml_inputs(data_filename, input_settings, nwarmup):
+    profiles=input_settings['profiles']
+    parameters=input_settings['parameters']
+    calculations=input_settings['calculations']
+    actuators=input_settings['actuators']
+    use_fancy_normalization=input_settings['use_fancy_normalization']
+    min_sample_length=nwarmup+1 #num_rollout_steps+nwarmup
+    x_test, y_test, ml_shots, times =customDatasetMakers.ian_dataset(data_filename,profiles,parameters,calculations,actuators,sort_by_size=True,
+                                                                     min_sample_length=min_sample_length,
+                                                                     use_fancy_normalization=use_fancy_normalization)
+    if False:
+        state_indices=get_state_indices_dic(profiles,parameters,calculations=calculations,actuators=actuators)
+        for i in range(len(x_test)):
+            for actuator in actuators:
+                index_0=state_indices[actuator][0]
+                index_1=state_indices[actuator][1]
+                x_test[i][:,index_0]=x_test[i][nwarmup,index_0]
+                x_test[i][:,index_1]=x_test[i][nwarmup,index_0]
+            for profile in profiles:
+                indices=state_indices[profile]
+                x_test[i][:nwarmup,indices]=x_test[i][nwarmup,indices]
+                x_test[i][:nwarmup,indices]=x_test[i][nwarmup,indices]
+    ml_times=np.array(times)+nwarmup*dataSettings.DT*1.e3
+    ml_times=ml_times.astype(int)
+    return {'x': x_test, 'y': y_test, 'shots': np.array(ml_shots, dtype=np.int64), 'times': ml_times, **input_settings}
+
+# rolls out the models of each of ml_configs on the preprocessed data in data_filename, sharing the work:
+# configs with the same normalization read their samples once, with every signal any of them takes,
+# and each bucket is padded once and rolled out by every config's models (over their own columns of it,
+# a view when they're contiguous, e.g. for configs with the same inputs) before the next is padded
+# gives {'data': predictions, 'shots': [...], 'times': [...]} for each of ml_configs
+def make_ml_rollouts(data_filename, ml_configs, ml_model_dir, use_ensemble,
+                     recorded_profiles, prediction_length, nwarmup, bucket_size=10000, compile_mode=None):
+    all_input_settings={ml_config: get_ml_input_settings(ml_config, ml_model_dir) for ml_config in ml_configs}
+    results={}
+    for use_fancy_normalization in sorted(set(settings['use_fancy_normalization'] for settings in all_input_settings.values())):
+        group=[ml_config for ml_config in ml_configs if all_input_settings[ml_config]['use_fancy_normalization']==use_fancy_normalization]
+        superset_settings=get_shared_input_settings([all_input_settings[ml_config] for ml_config in group])
+        print(f'Rolling out {group} over {superset_settings}')
+        inputs=get_ml_inputs(data_filename, superset_settings, nwarmup)
+        superset_outputs={key: superset_settings[key] for key in ['profiles','parameters']}
+        all_considered_models={}
+        all_columns={}
+        for ml_config in group:
+            settings=all_input_settings[ml_config]
+            config_filename,epoch=split_ml_config(ml_config, ml_model_dir)
+            all_considered_models[ml_config]=prediction_helpers.get_considered_models(config_filename, ensemble=use_ensemble, epoch=epoch,
+                                                                                   compile_mode=compile_mode)
+            all_columns[ml_config]=(prediction_helpers.get_column_selection(settings, superset_settings),
+                                    prediction_helpers.get_column_selection({key: settings[key] for key in ['profiles','parameters']},
+                                                                            superset_outputs))
+        num_result_times=prediction_helpers.get_num_result_times(max([len(arr) for arr in inputs['x']], default=0)-nwarmup,
+                                                                 prediction_length)
+        all_predictions={ml_config: np.ones((len(inputs['x']),len(recorded_profiles),num_result_times,dataSettings.nx))*np.nan
+                         for ml_config in group}
+        # the spread over an ensemble's members is kept next to its mean
+        all_stds={ml_config: np.ones_like(all_predictions[ml_config])*np.nan for ml_config in group} if use_ensemble else {}
+        sample_ind=0
+        for padded_bucket in prediction_helpers.pad_buckets(make_bucket(inputs['x'], bucket_size), make_bucket(inputs['y'], bucket_size)):
+            bucket_samples=slice(sample_ind, sample_ind+len(padded_bucket[2]))
+            for ml_config in group:
+                settings=all_input_settings[ml_config]
+                input_columns,output_columns=all_columns[ml_config]
+                bucket_predictions=get_ml_predictions(None, None,
+                                                      settings['profiles'], settings['parameters'], settings['calculations'], settings['actuators'],
+                                                      all_considered_models[ml_config],
+                                                      recorded_profiles=recorded_profiles,
+                                                      prediction_length=prediction_length,
+                                                      nwarmup=nwarmup, use_fancy_normalization=use_fancy_normalization,
+                                                      num_rollout_steps=400,
+                                                      return_uncertainty=use_ensemble,
+                                                      padded_buckets=[padded_bucket],
+                                                      input_columns=input_columns, output_columns=output_columns)
+                if use_ensemble:
+                    bucket_predictions,bucket_stds=bucket_predictions
+                    all_stds[ml_config][bucket_samples,:,:bucket_stds.shape[2]]=bucket_stds
+                all_predictions[ml_config][bucket_samples,:,:bucket_predictions.shape[2]]=bucket_predictions
+            sample_ind=bucket_samples.stop
+        for ml_config in group:
+            results[ml_config]={'data': all_predictions[ml_config], 'shots': inputs['shots'], 'times': inputs['times']}
+            if use_ensemble:
+                results[ml_config]['std']=all_stds[ml_config]
+    return [results[ml_config] for ml_config in ml_configs]
+
+# the truth, profile warmup and actuators to compare against, from the samples read with input_settings
+# (NEWmodelRollout uses get_shared_input_settings of all the ml_configs)
+def make_ml_truth(data_filename, input_settings,
+                  recorded_profiles, recorded_actuators, prediction_length, nwarmup):
+    inputs=get_ml_inputs(data_filename, input_settings, nwarmup)
+    truth=get_ml_truth(inputs['x'],inputs['y'],
+                       inputs['profiles'], inputs['parameters'],
+                       recorded_profiles=recorded_profiles,
+                       prediction_length=prediction_length,
+                       nwarmup=nwarmup, use_fancy_normalization=inputs['use_fancy_normalization'],
+                       calculations=inputs['calculations'], actuators=inputs['actuators'])
+    profile_warmup,actuator_trajectory=get_ml_profile_warmup_and_actuator_trajectory(inputs['x'],
+                                                                                     inputs['profiles'], inputs['parameters'], inputs['calculations'], inputs['actuators'],
+                                                                                     recorded_profiles=recorded_profiles, recorded_actuators=recorded_actuators,
+                                                                                     prediction_length=prediction_length,
+                                                                                     nwarmup=nwarmup, use_fancy_normalization=inputs['use_fancy_normalization'])
+    return {'truth': truth, 'profile_warmup': profile_warmup, 'actuator_trajectory': actuator_trajectory,
+            'shots': inputs['shots'], 'times': inputs['times']}
+
+# lines up the ML, simulation and truth data on their shared shots/times, then adds the blended
+# (and constant) predictions; infos are make_ml_rollouts' output for each of ml_configs, then
+# read_sim_info's for each of sim_names
+# everything is written into the directory filename: the result, the retrained blend models and the
+# blend_info.pkl aggregate.py trains from (see load_blended_predictions)
+def make_blended_predictions(truth_info, *infos, filename, ml_configs, sim_names, model_blends, include_const_predictions,
+                             profiles, recorded_profiles, prediction_length):
+    os.makedirs(filename)
+    ml_infos=infos[:len(ml_configs)]
+    sim_infos=infos[len(ml_configs):]
+    all_info={}
+    # copies since subsampling is in place
+    all_info.update({sim_name: dict(sim_info) for sim_name,sim_info in zip(sim_names,sim_infos)})
+    all_info.update({ml_config: dict(info) for ml_config,info in zip(ml_configs,ml_infos)})
+    all_info.update({key: {'shots': truth_info['shots'], 'times': truth_info['times'], 'data': truth_info[key]}
+                     for key in ['truth','profile_warmup','actuator_trajectory']})
+    shots,times=subsample_info_to_shared_keys(all_info)
+    num_samples=len(shots)
+    extra_predictions=[]
+    extra_prediction_names=[]
+    tmp_model_blend_info={}
+    # names of the files written next to the result
+    artifacts={}
+    for blend in model_blends:
+        relevant_profiles=model_blends[blend]['relevant_profiles']
+        model_type=model_blends[blend]['model_type']
+        profile_inds=[profiles.index(profile) for profile in relevant_profiles]
+        ensemble_sims=np.array([all_info[model]['data'][:,profile_inds,:,:] for model in model_blends[blend]['relevant_models']])
+        truth=all_info['truth']['data'][:,profile_inds,:,:]
+        # normalize for the sake of training
+        for profile in relevant_profiles:
+            profile_ind=relevant_profiles.index(profile)
+            ensemble_sims[:,:,profile_ind,:,:]/=normalizations[profile]['std']
+            truth[:,profile_ind,:,:]/=normalizations[profile]['std']
+        model_filename=model_blends[blend]['model_filename']
+        if model_blends[blend]['retrain'] and model_type!='SimpleAverage':
+            # train and save it
+            artifacts[blend]=f'{blend}.tar'
+            model_filename=os.path.join(filename, artifacts[blend])
+            ensemble_model=train_model(ensemble_sims,truth,
+                                       profiles,relevant_profiles,
+                                       model_filename,
+                                       model_blends[blend]['model_type'])
+        if model_type=='SimpleAverage':
+            yhat=np.mean(ensemble_sims,axis=0)
+        else:
+            yhat=inference_model(model_filename,ensemble_sims).detach().numpy()
+        blended_predictions=np.zeros_like(all_info['truth']['data'])
+        for i,profile in enumerate(relevant_profiles):
+            profile_ind=relevant_profiles.index(profile)
+            blended_predictions[:,profile_ind,:,:]=yhat[:,i,:,:]*normalizations[profile]['std']
+        extra_predictions+=[blended_predictions]
+        extra_prediction_names+=[blend]
+    if include_const_predictions:
+        const_predictions=np.ones((num_samples,len(recorded_profiles),prediction_length,dataSettings.nx))
+        for time_ind in range(const_predictions.shape[-2]):
+            const_predictions[:,:,time_ind,:]=all_info['profile_warmup']['data'][:,:,-1,:]
+        extra_predictions+=[const_predictions]
+        extra_prediction_names+=['const']
+    tmp_model_blend_info['truth']=all_info['truth']['data']
+    tmp_model_blend_info['profiles']=profiles
+    artifacts['blend_info']='blend_info.pkl'
+    pipeline_helpers.save_pickle(tmp_model_blend_info, os.path.join(filename, artifacts['blend_info']))
+    pipeline_helpers.save_pickle({'all_info': all_info, 'shots': shots, 'times': times,
+                                  'extra_predictions': extra_predictions, 'extra_prediction_names': extra_prediction_names,
+                                  'artifacts': artifacts},
+                                 os.path.join(filename, 'result.pkl'))
+
+# make_blended_predictions' result from the directory it wrote, with 'artifacts' giving the paths
+# of the files written next to it (the retrained model of each retrained blend, and 'blend_info')
+def load_blended_predictions(dirname):
+    blend_info=pipeline_helpers.load_pickle(os.path.join(dirname, 'result.pkl'))
+    blend_info['artifacts']={name: os.path.join(dirname, artifact) for name,artifact in blend_info['artifacts'].items()}
+    return blend_info
+
+# sigma errors of every model (ML configs, then sims, then blends) against the truth
+def get_rollout_metrics(blend_info, ml_configs, sim_names, recorded_profiles, prediction_length):
+    all_info=blend_info['all_info']
+    model_names=[*ml_configs,*sim_names,*blend_info['extra_prediction_names']]
+    model_predictions=np.stack([*[all_info[model]['data'] for model in ml_configs],
+                                *[all_info[model]['data'] for model in sim_names],
+                                *blend_info['extra_predictions']])
+    min_prediction_steps=evaluation_helpers.get_min_prediction_steps(model_predictions, prediction_length)
+    all_sigmas=evaluation_helpers.get_all_sigmas(model_predictions, all_info['truth']['data'],
+                                                 recorded_profiles, prediction_length)
+    # per shot (and model, profile, horizon) statistics of the sigmas
+    _,all_sigmas_by_shot=evaluation_helpers.grouped_nanmean(all_sigmas, blend_info['shots'])
+    _,median_sigmas_by_shot,iqr_sigmas_by_shot=evaluation_helpers.grouped_median_and_iqr(all_sigmas, blend_info['shots'])
+    return {'model_names': model_names, 'model_predictions': model_predictions, 'min_prediction_steps': min_prediction_steps,
+            'all_sigmas': all_sigmas, 'all_sigmas_by_shot': all_sigmas_by_shot,
+            'median_sigmas_by_shot': median_sigmas_by_shot, 'iqr_sigmas_by_shot': iqr_sigmas_by_shot}
+
 if __name__ == "__main__":
-    raw_data_filename='/projects/EKOLEMEN/profile_predictor/raw_data/diiid_data.h5' #small_test.h5'
-    use_ensemble=False
-    profiles=['zipfit_etempfit_rho', 'zipfit_itempfit_rho', 'zipfit_trotfit_rho',
-              'zipfit_edensfit_rho', 'zipfit_zdensfit_rho', 'qpsi_EFIT01']
-    ip_minimum=1.0e6
-    ip_maximum=1.2e6
-    nwarmup=3
-    recorded_profiles=['zipfit_etempfit_rho','zipfit_itempfit_rho','zipfit_trotfit_rho',
-                       'zipfit_edensfit_rho', 'qpsi_EFIT01','zeff_rho']
-    recorded_actuators=['pinj','ip','volume_EFIT01','rmaxis_EFIT01','aminor_EFIT01']
-    prediction_length=15
-    include_const_predictions=False
-    plotted_profiles=recorded_profiles
-    plotted_actuators=recorded_actuators
-    plot_sigma_bar=False
-    plot_sigma_time=False
-    plot_over_rho=False
-    plot_over_time=False
-    model_blends={}
-    model_colors={}
-    model_name_map={}
+    # which models/simulations to compare on what data, see read_rollout_manifest and rollout_manifests/
+    if len(sys.argv)>1:
+        manifest_filename=sys.argv[1]
+    else:
+        manifest_filename=os.path.join(os.path.dirname(os.path.abspath(__file__)),'rollout_manifests','curriculum.cfg')
+    manifest=read_rollout_manifest(manifest_filename)
+    raw_data_filename=manifest['raw_data_filename']
+    use_ensemble=manifest['use_ensemble']
+    profiles=manifest['profiles']
+    nwarmup=manifest['nwarmup']
+    recorded_profiles=manifest['recorded_profiles']
+    recorded_actuators=manifest['recorded_actuators']
+    prediction_length=manifest['prediction_length']
+    ml_configs=manifest['ml_configs']
+    considered_sims=manifest['considered_sims']
+    model_blends=manifest['model_blends']
+    plotted_profiles=manifest['plotted_profiles']
+    plotted_actuators=manifest['plotted_actuators']
+    plot_sigma_bar=manifest['plot_sigma_bar']
+    plot_sigma_time=manifest['plot_sigma_time']
+    plot_over_rho=manifest['plot_over_rho']
+    plot_over_time=manifest['plot_over_time']
+    sigma_bar_title=manifest['sigma_bar_title']
+    model_colors={'Blender': 'm'}
     model_linestyles={'const': '--'} #, 'ip_0_1200NOdssdenest_RESUMEDconfig': '--'}
     model_name_map={'const': 'constant',
                     #'ip_0_1200NOdssdenest_RESUMED3config': 'ML (ip<1200kA)',
@@ -312,184 +660,9 @@ if __name__ == "__main__":
                     'astrapredictFULLYandCurrentZIPFIT': 'tglfnn+eped+NE+q',
                     'astrapredictTGLFNNandCurrentZIPFIT': 'tglfnn+q',
                     'astrapredictTGLFNNZIPFIT': 'tglfnn'}
-    sigma_bar_title=r'$\sigma$ error on $1.0MA<I_p<1.2MA$'
-
-    common_blend_info={}
-    #common_blend_info['BlenderNonlinear']={'model_type': 'BlenderNonlinear', 'model_filename': 'blenderNonlinear.tar'}
-    # common_blend_info['SimpleAverage']={'model_type': 'SimpleAverage'}
-    common_blend_info['Blender']={'model_type': 'Blender', 'model_filename': 'blender.tar'}
-    # common_blend_info['BlenderProfiles']={'model_type': 'BlenderProfiles', 'model_filename': 'blenderProfiles.tar'}
-    # common_blend_info['BlenderProfilesTimes']={'model_type': 'BlenderProfilesTimes', 'model_filename': 'blenderProfilesTimes.tar'}
-    for blend in common_blend_info:
-        common_blend_info[blend]['relevant_models']=['astrapredictTGLFNNZIPFIT','astrapredictFIXEDTGLFNNZIPFIT','astrapredictFIXEDGBZIPFIT']
-        common_blend_info[blend]['relevant_profiles']=['zipfit_etempfit_rho','zipfit_itempfit_rho','zipfit_trotfit_rho']
-    model_colors['Blender']='m'
     model_name_map['Blender']='meta'
-    # comparing d3d to aug to gyrobohm normalized
-    if False:
-        plotted_profiles=['zipfit_itempfit_rho','zipfit_trotfit_rho','zipfit_edensfit_rho'] #'zipfit_etempfit_rho',
-        sigma_bar_title='Error (%)'
-        plot_sigma_bar=True
-        considered_sims=[]
-        #'augip_0_1200NOdssdenestconfig', 'aug900_d3d900NOdssdenestconfig',
-        ml_configs=[#'ip_0_1200NOdssdenest_RESUMED3config',
-            'ip_0_900NOdssdenest_RESUMED3config',
-            'augall_d3d900NOdssdenestUNNORMEDconfig',
-            'augall_d3d900NOdssdenestNORMEDconfig']
-                    #'augallNOdssdenestnoGBnormalizationconfig',
-                    #'augallNOdssdenestwithGBnormalizationconfig']
-        model_name_map.update({'ip_0_900NOdssdenest_RESUMED3config': 'D3D',#r'$I_p$<0.9MA',
-                               #'augall_d3d900NOdssdenestconfig': r'D3D+AUG',
-                               'augall_d3d900NOdssdenestNORMEDconfig': 'Normed\nD3D+AUG',
-                               'augall_d3d900NOdssdenestUNNORMEDconfig': r'D3D+AUG', #r'$I_p$<0.9MA'+'\n+AUG',
-                               'augallNOdssdenestwithGBnormalizationconfig': 'AUG normed',
-                               'augallNOdssdenestnoGBnormalizationconfig': 'AUG',
-                               'ip_0_1200NOdssdenest_RESUMED3config': r'$I_p$<1.2MA'})
-        ml_cache_filename='/scratch/gpfs/jabbate/ml_aug_comparison.pkl'
-        data_cache_filename='/scratch/gpfs/jabbate/data_1000_1200.pkl'
-    # surrogate hybrid (tuning on simulation outputs)
-    elif False:
-        sigma_bar_title='Error (%)'
-        plot_sigma_bar=True
-        model_name_map.update({'ip_0_900NOdssdenest_RESUMED3config': 'ML', #r'$I_p$<0.9MA',
-                               'ip_0_1200NOdssdenest_RESUMED3config': r'$I_p$<1.2MA'})
-        plotted_profiles=['zipfit_etempfit_rho','zipfit_itempfit_rho']
-        considered_sims=[]
-        #'augip_0_1200NOdssdenestconfig', 'aug900_d3d900NOdssdenestconfig',
-        ml_configs=['ip_0_900NOdssdenest_RESUMED3config',
-                    #'surrogateHybrid_tuned_on_data_only_ip_0_900frozenEncodersconfig',
-                    'surrogateHybridip_0_900frozenEncodersconfig',
-                    #'surrogateHybrid_tuned_on_data_only_ip_0_900frozenRNNconfig',
-                    'surrogateHybridip_0_900frozenRNNconfig',
-                    #'surrogateHybrid_tuned_on_data_only_ip_0_900unfrozenconfig',
-                    'surrogateHybridip_0_900unfrozenconfig']
-        ml_cache_filename='/scratch/gpfs/jabbate/ml_surrogate_hybrid.pkl'
-        data_cache_filename='/scratch/gpfs/jabbate/data_1000_1200.pkl'
-    # comparing sims for 1.0 to 1.2, extracting file to train coefficients on
-    elif False:
-        plot_sigma_bar=True
-        plotted_profiles=recorded_profiles[:3]
-        plotted_actuators=recorded_actuators[:1]
-        #considered_sims=[]
-        considered_sims=['astrapredictTGLFNNZIPFIT', #'astrapredictTGLFNNEPEDNNZIPFIT',
-                         'astrapredictFIXEDGBZIPFIT','astrapredictFIXEDTGLFNNZIPFIT']
-                         #'astrapredictTGLFNNandScaleDensityZIPFIT']
-                         #'astrapredictFULLYZIPFIT',
-                         #'astrapredictTGLFNNandScaleDensityZIPFIT', 'astrapredictFULLYandCurrentZIPFIT']
-        ml_configs=['ip_0_1200NOdssdenest_RESUMED3config','ip_0_900NOdssdenest_RESUMED3config']
-        train_blends=copy.deepcopy(common_blend_info)
-        for blend in train_blends:
-            train_blends[blend]['retrain']=True
-            train_blends[blend]['relevant_models'].append('ip_0_900NOdssdenest_RESUMED3config')
-        model_blends.update(train_blends)
-        ip_minimum=1.0e6
-        ip_maximum=1.2e6
-        data_cache_filename='/scratch/gpfs/jabbate/data_sim_1000_1200.pkl' #+'_'.join(considered_sims)+'.pkl'
-        ml_cache_filename='/scratch/gpfs/jabbate/ml_sim_1000_1200.pkl' #+'_'.join(considered_sims)+'.pkl'
-        raw_data_filename='/projects/EKOLEMEN/profile_predictor/raw_data/diiid_data.h5' #small_test.h5'
-        model_colors['ensemble\n(average)']='r'
-        model_colors['Blender']='m'
-    # comparing for 1.3 and up, using trained coefficients
-    elif False:
-        model_name_map.update({'ip_0_1200NOdssdenest_RESUMED3config': 'ML'})
-        sigma_bar_title='Error (%)' #r'$\sigma$ error on $1.3MA<I_p$'
-        plotted_profiles=recorded_profiles[:3]
-        plotted_actuators=[] #recorded_actuators[:1]
-        #considered_sims=[]
-        considered_sims=['astrapredictTGLFNNZIPFIT', #'astrapredictTGLFNNEPEDNNZIPFIT',
-                         'astrapredictFIXEDGBZIPFIT','astrapredictFIXEDTGLFNNZIPFIT']
-                         #'astrapredictTGLFNNandScaleDensityZIPFIT']
-                         #'astrapredictFULLYZIPFIT',
-                         #'astrapredictTGLFNNandScaleDensityZIPFIT', 'astrapredictFULLYandCurrentZIPFIT']
-        # for individual example cases
-        test_blends=copy.deepcopy(common_blend_info)
-        for blend in test_blends:
-            print('Make sure you already ran this code for the case that trains the weights in the blend')
-            test_blends[blend]['retrain']=False
-            test_blends[blend]['relevant_models'].append('ip_0_1200NOdssdenest_RESUMED3config')
-        model_blends.update(test_blends)
-        if True:
-            plotted_profiles=['zipfit_etempfit_rho','zipfit_trotfit_rho']
-            model_name_map.update({'ip_0_900NOdssdenest_RESUMED3config': 'ML',
-                                   'ip_0_1200NOdssdenest_RESUMED3config': 'ML'})
-            ml_configs=['ip_0_1200NOdssdenest_RESUMED3config']
-            plot_over_time=True
-            plot_over_rho=True
-            plot_sigma_bar=False
-        # for sigma error comparison
-        else:
-            plot_over_time=False
-            plot_over_rho=False
-            plot_sigma_bar=True
-            ml_configs=['ip_0_1200NOdssdenest_RESUMED3config'] #['allNOdssdenest_RESUMED3config','ip_0_1200NOdssdenest_RESUMED3config']
-        ip_minimum=1.3e6
-        ip_maximum=10e6
-        data_cache_filename='/scratch/gpfs/jabbate/data_sim_1300.pkl' #+'_'.join(considered_sims)+'.pkl'
-        ml_cache_filename='/scratch/gpfs/jabbate/ml_sim_1300.pkl' #+'_'.join(considered_sims)+'.pkl'
-        raw_data_filename='/projects/EKOLEMEN/profile_predictor/raw_data/diiid_data.h5' #small_test.h5'
-        # Take this from running the block above this to dump the thing to train on, then aggregate.py
-        model_colors['ensemble\n(average)']='tab:pink'
-        model_colors['ensemble\n(optimized)']='m'
-    # seeing whether adding ASTRA calculations helps
-    elif False:
-        plotted_profiles=['zipfit_etempfit_rho','zipfit_itempfit_rho','qpsi_EFIT01']
-        sigma_bar_title='Error (%)' #r'$\sigma$ error on all data'
-        plot_sigma_bar=True
-        legend_fontsize=10
-        ml_configs=['astraInterpretiveAndTGLFNNallnoCalcsconfig','astraInterpretiveAndTGLFNNallwithPredictiveconfig',
-                    'astraInterpretiveAndTGLFNNallwithInterpretiveconfig']
-        considered_sims=[] #['astrapredictFIXEDGBZIPFIT', 'astrapredictFIXEDTGLFNNZIPFIT','astrapredictTGLFNNlowipZIPFIT']
-        data_cache_filename='/scratch/gpfs/jabbate/data_calculations.pkl'
-        ip_minimum=None
-        ip_maximum=None
-        raw_data_filename='/projects/EKOLEMEN/profile_predictor/sim_data/astraTrainData.h5'
-        profiles=['zipfit_etempfit_rho', 'zipfit_itempfit_rho', 'zipfit_trotfit_rho',
-                  'zipfit_edensfit_rho', 'zipfit_zdensfit_rho', 'qpsi_EFIT01',
-                  'PETOT_astrainterpretZIPFIT','PITOT_astrainterpretZIPFIT','CD_astrainterpretZIPFIT',
-                  'TE_astrapredictTGLFNNZIPFIT','TI_astrapredictTGLFNNZIPFIT']
-        ml_cache_filename='/scratch/gpfs/jabbate/ml_calcs_comparison.pkl'
-    # ensemble stuff for explaining ensembling
-    elif False:
-        considered_sims=[]
-        plotted_profiles=recorded_profiles
-        # JANK: pop a "EPOCH***" on the end to use a specific epoch of a config file
-        ml_configs=['alldiiid_ensembleconfig0','alldiiid_ensembleconfig1','alldiiid_ensembleconfig2',
-                    'alldiiid_ensembleconfig0EPOCH250','alldiiid_ensembleconfig1EPOCH250','alldiiid_ensembleconfig2EPOCH250']
-        ml_cache_filename='/scratch/gpfs/jabbate/ml_ensemble.pkl'
-        data_cache_filename='/scratch/gpfs/jabbate/data_1000_1200.pkl'
-        model_blends={'200ms': {'coefficients': [0.5, 0.5], 'models': ['alldiiid_ensembleconfig0','alldiiid_ensembleconfig1']},
-                      '20ms': {'coefficients': [0.5, 0.5], 'models': ['alldiiid_ensembleconfig0EPOCH250','alldiiid_ensembleconfig1EPOCH250']}}
-        model_colors.update({'alldiiid_ensembleconfig0': 'r','alldiiid_ensembleconfig1': 'r','alldiiid_ensembleconfig2':'r',
-                             'alldiiid_ensembleconfig0EPOCH250':'b','alldiiid_ensembleconfig1EPOCH250':'b','alldiiid_ensembleconfig2EPOCH250':'b',
-                             '200ms': 'r', '20ms': 'b'})
-        prediction_length=25
-        plotted_actuators=recorded_actuators[:1]
-    # ensemble stuff for explaining curriculum learning
-    elif True:
-        #plotted_profiles=recorded_profiles
-        plotted_profiles=['zipfit_etempfit_rho']
-        plot_sigma_bar=False
-        plot_sigma_time=True
-        plot_over_rho=False
-        plot_over_time=False
-        considered_sims=[]
-        # JANK: pop a "EPOCH***" on the end to use a specific epoch of a config file
-        ml_configs=['alldiiid_ensembleconfig0EPOCH250',#'alldiiid_ensembleconfig0EPOCH500',
-                    #'alldiiid_ensembleconfig0EPOCH750',
-                    'alldiiid_ensembleconfig0']
-        use_ensemble=False
-        ml_cache_filename='/scratch/gpfs/jabbate/ml_curriculum.pkl'
-        data_cache_filename='/scratch/gpfs/jabbate/data_1000_1200.pkl'
-        # model_blends={'200ms': {'coefficients': [0.5, 0.5], 'models': ['alldiiid_ensembleconfig0','alldiiid_ensembleconfig1']},
-        #               '20ms': {'coefficients': [0.5, 0.5], 'models': ['alldiiid_ensembleconfig0EPOCH250','alldiiid_ensembleconfig1EPOCH250']}}
-        # model_colors.update({'alldiiid_ensembleconfig0': 'r','alldiiid_ensembleconfig1': 'r','alldiiid_ensembleconfig2':'r',
-        #                      'alldiiid_ensembleconfig0EPOCH250':'b','alldiiid_ensembleconfig1EPOCH250':'b','alldiiid_ensembleconfig2EPOCH250':'b',
-        #                      '200ms': 'r', '20ms': 'b'})
-        model_colors.update({'alldiiid_ensembleconfig0EPOCH250': 'r','alldiiid_ensembleconfig0EPOCH500': 'b',
-                             'alldiiid_ensembleconfig0EPOCH750': 'b','alldiiid_ensembleconfig0': 'b'})
-        prediction_length=15
-        plotted_actuators=recorded_actuators[:1]
-        #model_linestyles.update({'alldiiid_ensembleconfig0': '--'})
+    model_colors.update(manifest['model_colors'])
+    model_name_map.update(manifest['model_name_map'])
     sim_color_map=matplotlib.colormaps['winter'](np.linspace(0,1,len(considered_sims)))
     ml_color_map=matplotlib.colormaps['autumn'](np.linspace(0,1,len(ml_configs)))
     for i,model_name in enumerate(considered_sims):
@@ -503,261 +676,104 @@ if __name__ == "__main__":
     sig_name_map={'zipfit_etempfit_rho': r'$T_e$', 'zipfit_itempfit_rho': r'$T_i$', 'zipfit_trotfit_rho': r'$\Omega$',
                   'zipfit_edensfit_rho': r'$n_e$', 'zeff_rho': r'$Z_{eff}$', 'qpsi_EFIT01': '$q$',
                   'pinj': r'$P_{inj}$', 'ip': r'$I_p$'}
-    sim_dir="/projects/EKOLEMEN/profile_predictor/sim_data/"
-    all_sim_info={}
+
+    # each stage is only recomputed if its inputs (settings, files it reads, code it runs, or
+    # those of a stage it depends on) changed
+    cache=pipeline_helpers.StageCache(manifest['cache_dir'],
+                                      max_size=None if manifest['cache_max_size'] is None else int(manifest['cache_max_size']*1e9))
+    pipeline=pipeline_helpers.StagePipeline(cache=cache)
+    sim_stages=[]
+    sim_code_version=pipeline_helpers.get_code_version(read_sim_info, get_sim_predictions_shots_times, read_sim_shot,
+                                                         get_chain_bounds, get_batched_chain_bounds)
     for sim_name in considered_sims:
-        sim_cache_filename=f'tmp_{sim_name}.pkl'
-        if not os.path.exists(sim_cache_filename):
-            print(f'making {sim_name} dataset, caching in {sim_cache_filename}')
-            if sim_name in ['astrapredictTGLFNNEPEDNNZIPFIT','astrapredictFULLYtglfnnZIPFIT']:
-                ntimestep_delay=5
-                use_delta=True
-            else:
-                ntimestep_delay=0
-                use_delta=False
-            sim_yhat, sim_shots, sim_times, sim_y=get_sim_predictions_shots_times(sim_name, sim_dir, prediction_length=prediction_length,
-                                                                                  recorded_profiles=recorded_profiles,
-                                                                                  ntimestep_delay=ntimestep_delay,
-                                                                                  min_length=15,
-                                                                                  use_delta=use_delta)
-            sim_info={'shots': sim_shots, 'times': sim_times, 'data': sim_yhat}
-            sim_truth_info={'shots': sim_shots, 'times': sim_times, 'data': sim_y}
-            all_sim_info[sim_name]=sim_info
-            with open(sim_cache_filename,'wb') as f:
-                pickle.dump(sim_info,f)
-        else:
-            print(f'drawing {sim_name} from {sim_cache_filename}, delete to remake')
-            with open(sim_cache_filename,'rb') as f:
-                all_sim_info[sim_name]=pickle.load(f)
-    if True:
-        if len(considered_sims)>0:
-            print('Computing dataset with simulation shots/timebounds')
-            shots_to_preprocess,sim_times=subsample_info_to_shared_keys(all_sim_info)
-            time_bounds_to_preprocess=[]
-            # ML's first output is 20ms ahead of the start time
-            # similarly if we want the last prediction we have to get one extra
-            for sample_ind in range(len(sim_times)):
-                time_bounds_to_preprocess.append([sim_times[sample_ind]-nwarmup*dataSettings.DT*1.e3,
-                                                  sim_times[sample_ind]+prediction_length*dataSettings.DT*1.e3])
+        if sim_name in ['astrapredictTGLFNNEPEDNNZIPFIT','astrapredictFULLYtglfnnZIPFIT']:
+            ntimestep_delay=5
+            use_delta=True
         else:
-            min_shot=140000
-            max_shot=200000
-            test_index=0
-            shots_to_preprocess=[shot for shot in range(min_shot,max_shot) if shot%10 in [test_index]]
-            time_bounds_to_preprocess=None
-        scalars=['pinj','tinj','ech_pwr_total','ip','tribot_EFIT01','tritop_EFIT01','kappa_EFIT01','aminor_EFIT01',
-                 'rmaxis_EFIT01','volume_EFIT01','bt','D_tot','H_tot','He_tot','N_tot','Ne_tot',
-                 'dssdenest']
-        if os.path.exists(data_cache_filename):
-            print(f'{data_cache_filename} already written, delete to remake')
-        else:
-            customDatasetMakers.preprocess_data(data_cache_filename,
-                                                raw_data_filename,profiles,scalars,
-                                                shots=shots_to_preprocess, time_bounds=time_bounds_to_preprocess,
-                                                exclude_ech=False,
-                                                ip_minimum=ip_minimum,ip_maximum=ip_maximum,
-                                                zero_fill_signals=['ech_pwr_total','pinj','tinj'])
-    # now get the models and dump the predictions
-    if not os.path.exists(ml_cache_filename):
-        ml_model_dirname='/projects/EKOLEMEN/profile_predictor/final_paper_models/'
-        all_ml_info={}
-        for ml_config in ml_configs:
-            # super jank: name it like basenameconfigEPOCH500
-            config_name_info=ml_config.split('EPOCH')
-            if len(config_name_info)>1:
-                epoch=int(config_name_info[1])
-                base_ml_config=config_name_info[0]
-            else:
-                epoch=None
-                base_ml_config=ml_config
-            ensemble=use_ensemble
-            config_filename=os.path.join(ml_model_dirname, base_ml_config)
-            config=configparser.ConfigParser()
-            config.read(config_filename)
-            profiles=config['inputs']['profiles'].split()
-            actuators=config['inputs']['actuators'].split()
-            parameters=config['inputs'].get('parameters','').split()
-            calculations=config['inputs'].get('calculations','').split()
-            use_fancy_normalization=config['preprocess'].getboolean('use_fancy_normalization',False)
-            fake_actuators=False
-            num_rollout_steps=400
-            min_sample_length=nwarmup+1 #num_rollout_steps+nwarmup
-            x_test, y_test, ml_shots, times =customDatasetMakers.ian_dataset(data_cache_filename,profiles,parameters,calculations,actuators,sort_by_size=True,
-                                                                             min_sample_length=min_sample_length,
-                                                                             use_fancy_normalization=use_fancy_normalization)
-            if False:
-                state_indices=get_state_indices_dic(profiles,parameters,calculations=calculations,actuators=actuators)
-                for i in range(len(x_test)):
-                    for actuator in actuators:
-                        index_0=state_indices[actuator][0]
-                        index_1=state_indices[actuator][1]
-                        x_test[i][:,index_0]=x_test[i][nwarmup,index_0]
-                        x_test[i][:,index_1]=x_test[i][nwarmup,index_0]
-                    for profile in profiles:
-                        indices=state_indices[profile]
-                        x_test[i][:nwarmup,indices]=x_test[i][nwarmup,indices]
-                        x_test[i][:nwarmup,indices]=x_test[i][nwarmup,indices]                        
-            ml_times=np.array(times)+nwarmup*dataSettings.DT*1.e3
-            ml_times=ml_times.astype(int)
-            start_times=ml_times
-            # ml prediction stuff
-            considered_models=prediction_helpers.get_considered_models(config_filename, ensemble=ensemble, epoch=epoch)
-            considered_models=considered_models
-            ml_predictions=get_ml_predictions(x_test,y_test,
-                                              profiles, parameters, calculations, actuators,
-                                              considered_models,
-                                              recorded_profiles=recorded_profiles,
-                                              prediction_length=prediction_length,
-                                              nwarmup=nwarmup, use_fancy_normalization=use_fancy_normalization,
-                                              num_rollout_steps=num_rollout_steps)
-            all_ml_info[ml_config]={'data': ml_predictions, 'shots': ml_shots, 'times': ml_times}
-        # #### HOPEFULLY SECOND ML MODEL JUST RUNS
-        # config_filename='/projects/EKOLEMEN/profile_predictor/final_paper_models/ip_0_1200WITHdssdenest_RESUMEDconfig'
-        # considered_models=prediction_helpers.get_considered_models(config_filename, ensemble=ensemble, epoch=epoch)
-        # ml_2_predictions=get_ml_predictions(x_test,
-        #                                     profiles, parameters, calculations, actuators,
-        #                                     considered_models,
-        #                                     nwarmup=nwarmup,
-        #                                     num_rollout_steps=num_rollout_steps)
-        ####
-        # truth stuff -- right now it's jank just uses the stuff from the last model in the ml_configs list
-        truth=get_ml_truth(x_test,y_test,
-                           profiles, parameters,
-                           recorded_profiles=recorded_profiles,
-                           prediction_length=prediction_length,
-                           nwarmup=nwarmup, use_fancy_normalization=use_fancy_normalization)
-        profile_warmup,actuator_trajectory=get_ml_profile_warmup_and_actuator_trajectory(x_test,
-                                                                                         profiles, parameters, calculations, actuators,
-                                                                                         recorded_profiles=recorded_profiles, recorded_actuators=recorded_actuators,
-                                                                                         prediction_length=prediction_length,
-                                                                                         nwarmup=nwarmup, use_fancy_normalization=use_fancy_normalization)
-        with open(ml_cache_filename,'wb') as f:
-            pickle.dump({'all_ml_info': all_ml_info, 'truth': truth, 'profile_warmup': profile_warmup, 'actuator_trajectory': actuator_trajectory,
-                         'ml_shots': ml_shots, 'ml_times': ml_times},f)
-    else:
-        with open(ml_cache_filename,'rb') as f:
-            ml_info=pickle.load(f)
-            all_ml_info=ml_info['all_ml_info']
-            truth=ml_info['truth']
-            profile_warmup=ml_info['profile_warmup']
-            actuator_trajectory=ml_info['actuator_trajectory']
-            ml_shots=ml_info['ml_shots']
-            ml_times=ml_info['ml_times']
-    all_info={}
-    all_info.update(all_sim_info)
-    all_info.update(all_ml_info)
-    all_info.update({'truth': {'shots': ml_shots, 'times': ml_times, 'data': truth},
-                     'profile_warmup': {'shots': ml_shots, 'times': ml_times, 'data': profile_warmup},
-                     'actuator_trajectory': {'shots': ml_shots, 'times': ml_times, 'data': actuator_trajectory}})
-    shots,times=subsample_info_to_shared_keys(all_info)
-    num_samples=len(shots)
-    extra_predictions=[]
-    extra_prediction_names=[]
-    tmp_model_blend_info={}
+            ntimestep_delay=0
+            use_delta=False
+        sim_kwargs={'sim_name': sim_name, 'sim_dir': manifest['sim_dir'], 'prediction_length': prediction_length,
+                    'recorded_profiles': recorded_profiles, 'ntimestep_delay': ntimestep_delay, 'min_length': 15, 'use_delta': use_delta}
+        sim_inputs={'sim_file': pipeline_helpers.get_file_fingerprint(os.path.join(manifest['sim_dir'],f'{sim_name}.h5')),
+                    'code': sim_code_version}
+        pipeline.add_stage(f'sim {sim_name}', functools.partial(read_sim_info, **sim_kwargs), params=(sim_kwargs,sim_inputs),
+                           suffix='.npz', save=save_sim_cache, load=load_sim_cache)
+        sim_stages.append(f'sim {sim_name}')
+    data_kwargs={'sim_names': considered_sims, 'raw_data_filename': raw_data_filename,
+                 'profiles': profiles, 'scalars': manifest['scalars'],
+                 'ip_minimum': manifest['ip_minimum'], 'ip_maximum': manifest['ip_maximum'],
+                 'nwarmup': nwarmup, 'prediction_length': prediction_length,
+                 'min_shot': manifest['min_shot'], 'max_shot': manifest['max_shot'], 'test_index': manifest['test_index']}
+    # with simulations, the shot range isn't used; without, the time bounds (nwarmup, prediction_length) aren't
+    unused_data_kwargs=['min_shot','max_shot','test_index'] if len(considered_sims)>0 else ['nwarmup','prediction_length']
+    data_inputs={'raw_data_file': pipeline_helpers.get_file_fingerprint(raw_data_filename),
+                 'code': pipeline_helpers.get_code_version(make_rollout_data, subsample_info_to_shared_keys,
+                                                           customDatasetMakers, prediction_helpers, dataSettings)}
+    pipeline.add_stage('data', functools.partial(make_rollout_data, **data_kwargs),
+                       params=({key: value for key,value in data_kwargs.items() if key not in unused_data_kwargs},data_inputs),
+                       dependencies=sim_stages, filename=manifest['data_cache_filename'], save=None, load=None)
+    # each ML config's predictions are cached separately (keyed by its config and checkpoints, the data,
+    # prediction_length and nwarmup), so adding or removing a model only computes what's missing,
+    # and the missing ones are rolled out together over the same padded data
+    ml_code_version=pipeline_helpers.get_code_version(get_ml_inputs, make_ml_rollouts, make_ml_truth, get_ml_predictions, get_ml_truth,
+                                                      get_ml_profile_warmup_and_actuator_trajectory,
+                                                      customDatasetMakers, prediction_helpers, customModels, dataSettings)
+    ml_kwargs={'use_ensemble': use_ensemble, 'recorded_profiles': recorded_profiles,
+               'prediction_length': prediction_length, 'nwarmup': nwarmup}
+    # compiling doesn't change the predictions, so isn't part of their signature
+    pipeline.add_batch('ml', lambda data_filename, keys: make_ml_rollouts(data_filename, keys, ml_model_dir=manifest['ml_model_dir'],
+                                                                         compile_mode=manifest['compile_mode'], **ml_kwargs))
+    ml_stages=[]
+    for ml_config in ml_configs:
+        ml_inputs={'model': get_ml_config_version(ml_config, manifest['ml_model_dir'], use_ensemble), 'code': ml_code_version}
+        pipeline.add_stage(f'ml {ml_config}', None, params=(dict(ml_kwargs, ml_config=ml_config),ml_inputs), dependencies=['data'],
+                           suffix='', save=pipeline_helpers.save_arrays, load=pipeline_helpers.load_arrays,
+                           batch='ml', batch_key=ml_config)
+        ml_stages.append(f'ml {ml_config}')
+    # the truth comes from the samples read with every signal the ML configs take
+    truth_kwargs={'input_settings': get_shared_input_settings([get_ml_input_settings(ml_config, manifest['ml_model_dir'])
+                                                               for ml_config in ml_configs]),
+                  'recorded_profiles': recorded_profiles, 'recorded_actuators': recorded_actuators,
+                  'prediction_length': prediction_length, 'nwarmup': nwarmup}
+    truth_inputs={'code': ml_code_version}
+    pipeline.add_stage('truth', functools.partial(make_ml_truth, **truth_kwargs),
+                       params=(truth_kwargs,truth_inputs), dependencies=['data'], suffix='',
+                       save=pipeline_helpers.save_arrays, load=pipeline_helpers.load_arrays)
+    blend_kwargs={'ml_configs': ml_configs, 'sim_names': considered_sims, 'model_blends': model_blends,
+                  'include_const_predictions': manifest['include_const_predictions'],
+                  'profiles': profiles, 'recorded_profiles': recorded_profiles, 'prediction_length': prediction_length}
+    # blends that aren't retrained use whatever model is already saved
+    blend_inputs={'models': {blend: pipeline_helpers.get_file_hash(model_blends[blend]['model_filename'])
+                             for blend in model_blends
+                             if not model_blends[blend]['retrain'] and model_blends[blend]['model_type']!='SimpleAverage'},
+                  'code': pipeline_helpers.get_code_version(make_blended_predictions, subsample_info_to_shared_keys,
+                                                            prediction_helpers, aggregate)}
+    pipeline.add_stage('blends', functools.partial(make_blended_predictions, **blend_kwargs), params=(blend_kwargs,blend_inputs),
+                       dependencies=['truth',*ml_stages,*sim_stages], filename=manifest['blend_cache_filename'],
+                       suffix='', save=None, load=load_blended_predictions)
+    metrics_kwargs={'ml_configs': ml_configs, 'sim_names': considered_sims,
+                    'recorded_profiles': recorded_profiles, 'prediction_length': prediction_length}
+    metrics_inputs={'code': pipeline_helpers.get_code_version(get_rollout_metrics, evaluation_helpers)}
+    pipeline.add_stage('metrics', functools.partial(get_rollout_metrics, **metrics_kwargs), params=(metrics_kwargs,metrics_inputs),
+                       dependencies=['blends'], filename=manifest['metrics_cache_filename'])
+    print(f"Stages to compute: {pipeline.plan('metrics')}")
+    blend_info=pipeline.get('blends')
+    print(f"Blend training info in {blend_info['artifacts']['blend_info']}")
+    # retrained blends are kept in the blends stage's entry, and copied to their model_filename
+    # (if given) for later manifests to use
     for blend in model_blends:
-        ### NEW
-        # make mask
-        # make x
-        # make extra_x
-        # make y
-        # normalize
-        relevant_profiles=model_blends[blend]['relevant_profiles']
-        model_type=model_blends[blend]['model_type']
-        #relevant_extra_info=['']
-        profile_inds=[profiles.index(profile) for profile in relevant_profiles]
-        ensemble_sims=np.array([all_info[model]['data'][:,profile_inds,:,:] for model in model_blends[blend]['relevant_models']])
-        truth=all_info['truth']['data'][:,profile_inds,:,:]
-        #extra_info=np.array([all_info['truth']['data'][profile][:,profile_inds,:,:] for profile in relevant_profiles])
-        # normalize for the sake of training
-        for profile in relevant_profiles:
-            profile_ind=relevant_profiles.index(profile)
-            ensemble_sims[:,:,profile_ind,:,:]/=normalizations[profile]['std']
-            truth[:,profile_ind,:,:]/=normalizations[profile]['std']
-        if model_blends[blend]['retrain'] and model_type!='SimpleAverage':
-            # train and save it
-            ensemble_model=train_model(ensemble_sims,truth,
-                                       profiles,relevant_profiles,
-                                       model_blends[blend]['model_filename'],
-                                       model_blends[blend]['model_type'])
-        if model_type=='SimpleAverage':
-            yhat=np.mean(ensemble_sims,axis=0)
-        else:
-            yhat=inference_model(model_blends[blend]['model_filename'],ensemble_sims).detach().numpy()
-        blended_predictions=np.zeros_like(all_info['truth']['data'])
-        for i,profile in enumerate(relevant_profiles):
-            profile_ind=relevant_profiles.index(profile)
-            blended_predictions[:,profile_ind,:,:]=yhat[:,i,:,:]*normalizations[profile]['std']
-        extra_predictions+=[blended_predictions]
-        extra_prediction_names+=[blend]
-        # for profile in relevant_profiles:
-        #     profile_ind=relevant_profiles.index(profile)
-        #     ensemble_sims[:,:,profile_ind,:,:]/=normalizations[profile]['std']
-        #     truth[:,profile_ind,:,:]/=normalizations[profile]['std']
-        ###
-    # if False: #for blend in model_blends:
-    #     coefficients=np.array(model_blends[blend]['coefficients'])
-    #     relevant_model_info=np.array([all_info[model]['data'] for model in model_blends[blend]['models']])
-    #     relevant_model_names=model_blends[blend]['models']
-    #     tmp_model_blend_info[blend]={'names': relevant_model_names, 'data': relevant_model_info}
-    #     blended_predictions=np.sum(coefficients[:,np.newaxis,np.newaxis,np.newaxis,np.newaxis]*relevant_model_info,axis=0)
-    #     extra_predictions+=[blended_predictions]
-    #     extra_prediction_names+=[blend]
-    if include_const_predictions:
-        const_predictions=np.ones((num_samples,len(recorded_profiles),prediction_length,dataSettings.nx))
-        for time_ind in range(const_predictions.shape[-2]):
-            const_predictions[:,:,time_ind,:]=all_info['profile_warmup']['data'][:,:,-1,:]
-        extra_predictions+=[const_predictions]
-        extra_prediction_names+=['const']
-    tmp_model_blend_info['truth']=all_info['truth']['data']
-    tmp_model_blend_info['profiles']=profiles
-    with open('tmp_blend_info.pkl','wb') as f:
-        pickle.dump(tmp_model_blend_info,f)
-    # if include_blended_predictions:
-    #     models_for_blend=['ip_0_900NOdssdenest_RESUMED3config', *considered_sims]
-    #     blended_predictions=np.sum([all_info[model]['data'] for model in models_for_blend],axis=0)/len(models_for_blend)
-    #     extra_predictions+=[blended_predictions]
-    #     extra_prediction_names+=['blended']
-    ##### edit these 2 lines to change what gets plotted
-    model_names=[*ml_configs,*considered_sims,*extra_prediction_names]
-    model_predictions=np.stack([*[all_info[model]['data'] for model in ml_configs],
-                                *[all_info[model]['data'] for model in considered_sims],
-                                *extra_predictions])
-    #####
-    min_prediction_steps=np.zeros(num_samples).astype(int)
-    for sample_ind in range(num_samples):
-        for time_ind in reversed(range(prediction_length)):
-            if not np.any(np.isnan(model_predictions[:,sample_ind,:,time_ind,:])):
-                min_prediction_steps[sample_ind]=time_ind
-                break
-    def sigma(sim_prof, exp_prof):
-        numerator = sim_prof - exp_prof
-        numerator = np.square(numerator)
-        numerator = np.sum(numerator)
-        numerator = numerator / len(exp_prof)
-        numerator = np.sqrt(numerator)
-        denominator = exp_prof
-        denominator = np.square(denominator)
-        denominator = np.sum(denominator)
-        denominator = denominator / len(exp_prof)
-        denominator = np.sqrt(denominator)
-        return 100 * (numerator / denominator)
-    all_sigmas=np.ones((num_samples,len(model_names),len(recorded_profiles),prediction_length))*np.nan
-    for sample_ind in range(num_samples):
-        for model_ind,model_name in enumerate(model_names):
-            for profile_ind,profile in enumerate(recorded_profiles):
-                for time_ind in range(min_prediction_steps[sample_ind]):
-                    if profile=='qpsi_EFIT01':
-                        all_sigmas[sample_ind,model_ind,profile_ind,time_ind]=sigma(1./model_predictions[model_ind,sample_ind,profile_ind,time_ind],
-                                                                                    1./all_info['truth']['data'][sample_ind,profile_ind,time_ind])
-                    else:
-                        all_sigmas[sample_ind,model_ind,profile_ind,time_ind]=sigma(model_predictions[model_ind,sample_ind,profile_ind,time_ind],
-                                                                                    all_info['truth']['data'][sample_ind,profile_ind,time_ind])
-    all_sigmas_by_shot=[]
-    for shot in np.unique(shots):
-        inds=np.where(np.array(shots)==shot)
-        if len(inds)>0:
-            all_sigmas_by_shot.append(np.nanmean(all_sigmas[inds],axis=0))
-    all_sigmas_by_shot=np.array(all_sigmas_by_shot)
+        if blend in blend_info['artifacts'] and model_blends[blend]['model_filename'] is not None:
+            shutil.copyfile(blend_info['artifacts'][blend], model_blends[blend]['model_filename'])
+    all_info=blend_info['all_info']
+    shots=blend_info['shots']
+    times=blend_info['times']
+    num_samples=len(shots)
+    metrics=pipeline.get('metrics')
+    model_names=metrics['model_names']
+    model_predictions=metrics['model_predictions']
+    min_prediction_steps=metrics['min_prediction_steps']
+    all_sigmas=metrics['all_sigmas']
+    all_sigmas_by_shot=metrics['all_sigmas_by_shot']
     font = {'weight' : 'bold',
             'size'   : 16}
     matplotlib.rc('font', **font)
@@ -948,6 +964,12 @@ if __name__ == "__main__":
                         c=model_colors.get(model_names[model_ind],'k'),
                         linestyle=model_linestyles.get(model_names[model_ind],None),
                         label=model_name_map.get(model_names[model_ind],model_names[model_ind]))
+                # +-1 std over the members of ML ensembles
+                if 'std' in all_info.get(model_names[model_ind],{}):
+                    mean=model_predictions[model_ind,sample_ind,profile_ind,:,0]
+                    std=all_info[model_names[model_ind]]['std'][sample_ind,profile_ind,:,0]
+                    ax.fill_between(predicted_times,mean-std,mean+std,
+                                    color=model_colors.get(model_names[model_ind],'k'),alpha=0.2)
             ax.set_ylabel(sig_name_map.get(profile,profile))
             #ax.plot(predicted_times,sim_yhat[sample_ind,profile_ind,:,0],c='b')
             #ax.set_ylim((0,None))
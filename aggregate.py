@@ -8,7 +8,8 @@ from dataSettings import normalizations
 # which_blend='blend'
 # relevant_profiles=['zipfit_etempfit_rho','zipfit_itempfit_rho'] #['zipfit_edensfit_rho','zeff_rho','qpsi_EFIT01']
 
-# with open('tmp_blend_info.pkl','rb') as f:
+# blend_info.pkl is written into NEWmodelRollout's blends stage entry, which it prints
+# with open('blend_info.pkl','rb') as f:
 #     info=pickle.load(f)
 # truth=torch.Tensor(info['truth'])
 # ensemble_sims=torch.Tensor(info[which_blend]['data'])
@@ -96,30 +96,42 @@ for actuator in blocked_actuators:
     umin[controller_actuators.index(actuator)] = true_value
     umax[controller_actuators.index(actuator)] = true_value
 
-Ad = sparse.csc_matrix(linear_model.A.weight.data)
-Bd = sparse.csc_matrix(linear_model.B.weight.data)
-[nx, nu] = Bd.shape
-
-q = np.hstack([np.kron(np.ones(N), -Q@(target_z_t[0,nwarmup,:])), -QN@(target_z_t[0,nwarmup,:]), np.zeros(N*nu)])
-P = sparse.block_diag([sparse.kron(sparse.eye(N), Q), QN,
-                       sparse.kron(sparse.eye(N), R)], format='csc')
-Ax = sparse.kron(sparse.eye(N+1),-sparse.eye(nx)) + sparse.kron(sparse.eye(N+1, k=-1), Ad)
-Bu = sparse.kron(sparse.vstack([sparse.csc_matrix((1, N)), sparse.eye(N)]), Bd)
-Aeq = sparse.hstack([Ax, Bu])
-leq = np.hstack([-simulated_z_t[0], np.zeros(N*nx)])
-ueq = leq
-Aineq = sparse.eye((N+1)*nx + N*nu)
-lineq = np.hstack([np.kron(np.ones(N+1), xmin), np.kron(np.ones(N), umin)])
-uineq = np.hstack([np.kron(np.ones(N+1), xmax), np.kron(np.ones(N), umax)])
-A = sparse.vstack([Aeq, Aineq], format='csc')
-l = np.hstack([leq, lineq])
-u = np.hstack([ueq, uineq])
+# condensed QP over the stacked actuators U=[u_1..u_N] only: the latent trajectory over the horizon
+# is Z = Phi z_0 + Gamma U, using the prediction matrices cached on the linear model
+with torch.no_grad():
+    Phi, Gamma = linear_model.get_prediction_matrices(N)
+Phi = Phi.numpy().astype(float)
+Gamma = Gamma.numpy().astype(float)
+nx = latent_dim
+nu = len(controller_actuators)
+Qbar = sparse.block_diag([sparse.kron(sparse.eye(N-1), Q), QN], format='csc')
+Rbar = sparse.kron(sparse.eye(N), R, format='csc')
+P = sparse.csc_matrix(Gamma.T @ (Qbar @ Gamma)) + Rbar
+# state constraints become constraints on Gamma U, then the input bounds
+A = sparse.vstack([sparse.csc_matrix(Gamma), sparse.eye(N*nu)], format='csc')
+
+def condensed_q(z_0, target_z):
+    return Gamma.T @ (Qbar @ (Phi @ z_0 - np.tile(target_z, N)))
+
+def condensed_bounds(z_0):
+    free_response = Phi @ z_0
+    l = np.hstack([np.kron(np.ones(N), xmin) - free_response, np.kron(np.ones(N), umin)])
+    u = np.hstack([np.kron(np.ones(N), xmax) - free_response, np.kron(np.ones(N), umax)])
+    return l, u
+
+q = condensed_q(simulated_z_t[0], target_z_t[0,nwarmup,:])
+l, u = condensed_bounds(simulated_z_t[0])
 
 prob = osqp.OSQP()
 prob.setup(P, q, A, l, u, warm_start=True, max_iter=10000)
 
 latent_trajectory = []
 
+# the model steps forward one row of simulated_state per iteration, carrying its hidden state;
+# row nwarmup+i-1 is final once the controller sets its future actuators on iteration i
+lstm_predictor = prediction_helpers.IncrementalPredictor(lstm_model)
+lstm_predictor.warmup(simulated_state[:, :nwarmup-1, :])
+
 for i in range(nsim):
     # Solve
     res = prob.solve()
@@ -128,7 +140,7 @@ for i in range(nsim):
     if res.info.status != 'solved':
         raise ValueError('OSQP did not solve the problem!')
     
-    ctrl = torch.tensor(res.x[-N*nu:-(N-1)*nu]).float()
+    ctrl = torch.tensor(res.x[:nu]).float()
 
     #x=res.x
     #obj_val = 0.5 * np.dot(x, P.dot(x)) + np.dot(q, x)
@@ -139,7 +151,7 @@ for i in range(nsim):
     # change future actuator, and the current actuator of future timestep
     simulated_state[0,nwarmup+i-1,future_controller_indices] = ctrl
     simulated_state[0, nwarmup+i, current_controller_indices] = ctrl
-    predicted_state = prediction_helpers.get_fast_profile_prediction(simulated_state[:,:nwarmup + i, :], lstm_model)
+    predicted_state = lstm_predictor.predict(simulated_state[:, nwarmup + i - 1, :])
     if nwarmup + i < len(wanted_sample): # if I'm not at the end of the simulation
         simulated_state[:, nwarmup + i, 0:len(profiles)*33 + len(parameters)] = predicted_state
 
@@ -152,17 +164,11 @@ for i in range(nsim):
         umin[controller_actuators.index(actuator)] = true_value
         umax[controller_actuators.index(actuator)] = true_value
 
-    lineq = np.hstack([np.kron(np.ones(N+1), xmin), np.kron(np.ones(N), umin)])
-    uineq = np.hstack([np.kron(np.ones(N+1), xmax), np.kron(np.ones(N), umax)])
-    l = np.hstack([leq, lineq])
-    u = np.hstack([ueq, uineq])
-
-    l[:nx] = -predicted_z_t
-    u[:nx] = -predicted_z_t
+    l, u = condensed_bounds(predicted_z_t.reshape(-1))
 
     # Update targets
-    q = np.hstack([np.kron(np.ones(N), -Q@(target_z_t[0,nwarmup + i,:])), -QN@(target_z_t[0,nwarmup + i,:]), np.zeros(N*nu)])
-    
+    q = condensed_q(predicted_z_t.reshape(-1), target_z_t[0,nwarmup + i,:])
+
     prob.update(l=l, u=u, q=q)
     print(f'timestep {i} done')
 
@@ -25,6 +25,29 @@ def allTimesInBounds(arr, cutoff):
     return np.all(np.abs(arr[~np.isnan(arr)])<cutoff)
 def check_signal_off(signal, threshold=0.1):
     return (np.all(np.isnan(signal)) or np.nanmax(signal)<threshold)
+# start and (inclusive) end indices of the runs of non-NaN values in a 1d array,
+# keeping runs at least min_length long, plus the one running to the end of the array
+# whatever its length (as the old extract_chains did)
+def get_chain_bounds(array, min_length=1):
+    valid=~np.isnan(np.asarray(array, dtype=float))
+    edges=np.diff(np.concatenate(([False],valid,[False])).astype(np.int8))
+    starts=np.flatnonzero(edges==1)
+    ends=np.flatnonzero(edges==-1)-1
+    keep=((ends-starts+1)>=min_length) | (ends==len(valid)-1)
+    return starts[keep], ends[keep]
+# same over a list of 1d arrays (e.g. one per shot) at once, returning which array
+# each run is in alongside its start and end indices within that array
+def get_batched_chain_bounds(arrays, min_length=1):
+    lengths=np.array([len(array) for array in arrays], dtype=int)
+    # a NaN after each array so runs can't continue into the next one
+    offsets=np.insert(np.cumsum(lengths+1),0,0)
+    joined=np.concatenate([np.append(np.asarray(array, dtype=float),np.nan) for array in arrays]+[np.zeros(0)])
+    starts,ends=get_chain_bounds(joined)
+    array_inds=np.searchsorted(offsets, starts, side='right')-1
+    starts=starts-offsets[array_inds]
+    ends=ends-offsets[array_inds]
+    keep=((ends-starts+1)>=min_length) | (ends==lengths[array_inds]-1)
+    return array_inds[keep], starts[keep], ends[keep]
 
 # to get excluded_runs for list of shots, run the following in OMFIT:
 #
@@ -3,6 +3,39 @@ import copy
 import torch
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
+# reduced precision options for the (wide) encoder/decoder matmuls, set via
+# [optimization] precision in the config; recurrent state stays in float32
+precision_dtypes={'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def set_model_precision(model, precision='fp32'):
+    if precision not in precision_dtypes:
+        raise ValueError(f"precision must be one of {list(precision_dtypes.keys())}, got '{precision}'")
+    model.autocast_dtype=precision_dtypes[precision]
+
+# run module under autocast (if autocast_dtype is set) and hand back the input's dtype
+def autocast_apply(module, x, autocast_dtype=None):
+    if autocast_dtype is None:
+        return module(x)
+    with torch.autocast(device_type=x.device.type, dtype=autocast_dtype):
+        output=module(x)
+    return output.to(x.dtype)
+
+# which (sample, time) steps predict from the true input rather than the model's previous output,
+# drawn for the whole sequence up front so rollouts don't sync with the host every step
+# steps t<=nwarmup always use the true input; if deterministic, reset every int(1./reset_probability)
+# steps after warmup, otherwise each sample resets independently with probability reset_probability
+def get_reset_mask(batch_size, seq_len, reset_probability=0, nwarmup=0, deterministic=False, device=None):
+    times=torch.arange(seq_len, device=device)
+    if deterministic:
+        if reset_probability>0:
+            reset_mask=((times-nwarmup) % int(1./reset_probability))==0
+        else:
+            reset_mask=torch.zeros(seq_len, dtype=torch.bool, device=device)
+        reset_mask=reset_mask.unsqueeze(0).expand(batch_size, -1)
+    else:
+        reset_mask=torch.rand(batch_size, seq_len, device=device) < reset_probability
+    return reset_mask | (times<=nwarmup)
+
 class IanMLP(torch.nn.Module):
     def __init__(self, input_dim, output_dim,
                  hidden_dim=100, extra_layers=1):
@@ -17,7 +50,89 @@ class IanMLP(torch.nn.Module):
     def forward(self, padded_input):
         return self.mlp(padded_input)
 
-class IanRNN(torch.nn.Module):
+# autoregressive rollout shared by IanRNN and EnsembleIanRNN, which provide the encoder, rnn
+# and decoder, rollout_step (one timestep on (..., nsamples, nstates) inputs) and compiled_steps
+class AutoregressiveRNN(torch.nn.Module):
+    # optionally use torch.compile ('compile') or a TorchScript trace ('script') of
+    # rollout_step in the autoregressive loop, None goes back to eager
+    # the trace freezes the current weights so it's only used without autograd, call
+    # this again after loading new weights
+    def compile_rollout_step(self, mode='compile'):
+        self.compiled_steps.clear()
+        if mode=='compile':
+            self.compiled_steps['compile']=torch.compile(self.rollout_step, dynamic=True)
+        elif mode=='script':
+            # traced lazily since tracing needs example inputs
+            self.compiled_steps['script']=None
+        elif mode is not None:
+            raise ValueError(f"mode must be 'compile', 'script' or None, got '{mode}'")
+    def _get_rollout_step(self, this_input, hidden_state):
+        if 'script' in self.compiled_steps:
+            if self.compiled_steps['script'] is None:
+                self.compiled_steps['script']=self._trace_rollout_step(this_input, hidden_state)
+            return self.compiled_steps['script']
+        return self.compiled_steps.get('compile', self.rollout_step)
+    def _trace_rollout_step(self, this_input, hidden_state):
+        if hidden_state is None:
+            traced_step=torch.jit.trace(IanRNNStep(self), (this_input,), check_trace=False)
+            return lambda x, hidden_state=None: (traced_step(x), None)
+        traced_step=torch.jit.trace(IanRNNStep(self), (this_input,)+tuple(hidden_state), check_trace=False)
+        return lambda x, hidden_state: traced_step(x, *hidden_state)
+    # reset_probability is the probability we use the true input
+    # rather than autoregressed input for the next step
+    # nwarmup is number of steps for which it won't autoregress
+    # padded_input is like (..., nsamples, ntimes, nstates)
+    # if deterministic, take exactly (1./reset_probability) steps at a time
+    def forward(self, padded_input, reset_probability=0, nwarmup=0, deterministic=False):
+        # inference without autoregression (20x faster)
+        if reset_probability>=1:
+            embedding=autocast_apply(self.encoder, padded_input, self.autocast_dtype)
+            if self.rnn_type=='lstm':
+                embedding_evolved,_=self.rnn(embedding)
+            else:
+                embedding_evolved=self.rnn(embedding)
+            padded_output=autocast_apply(self.decoder, embedding_evolved, self.autocast_dtype)
+        # inference with probabilistic autoregression
+        else:
+            # number of times
+            batch_size,seq_len=padded_input.size()[-3:-1]
+            # padded_output dim is padded_input without actuator chunk
+            padded_output=padded_input.new_zeros(padded_input.size()[:-1]+(self.output_dim,))
+            reset_mask=get_reset_mask(batch_size, seq_len, reset_probability, nwarmup, deterministic,
+                                      device=padded_input.device)
+            # note hidden state has both state and memory, (h,c), starting from 0
+            hidden_state=None
+            if self.rnn_type=='lstm':
+                hidden_state=(padded_input.new_zeros(padded_input.size()[:-2]+(self.rnn_dim,)),
+                              padded_input.new_zeros(padded_input.size()[:-2]+(self.rnn_dim,)))
+            if torch.is_grad_enabled():
+                # maintain previous output for autoregression (start at true t=0 state)
+                prev_output=padded_input[...,0,:self.output_dim]
+                for t_ind in range(seq_len):
+                    # predict from true state where reset (don't autoregress this timestep),
+                    # otherwise autoregress: use previous output with actuators
+                    true_input=padded_input[...,t_ind,:]
+                    autoregressed_input=torch.cat((prev_output,true_input[...,self.output_dim:]),dim=-1)
+                    this_input=torch.where(reset_mask[:,t_ind,None], true_input, autoregressed_input)
+                    step=self.compiled_steps.get('compile', self.rollout_step)
+                    prev_output,hidden_state=step(this_input, hidden_state)
+                    padded_output[...,t_ind,:]=prev_output
+            else:
+                # without autograd we can reuse a single input buffer, writing the
+                # previous output into its state slice in place
+                this_input=padded_input[...,0,:].clone()
+                state_input=this_input[...,:self.output_dim]
+                for t_ind in range(seq_len):
+                    this_input[...,self.output_dim:]=padded_input[...,t_ind,self.output_dim:]
+                    if t_ind>0:
+                        torch.where(reset_mask[:,t_ind,None], padded_input[...,t_ind,:self.output_dim],
+                                    padded_output[...,t_ind-1,:], out=state_input)
+                    step=self._get_rollout_step(this_input, hidden_state)
+                    this_output,hidden_state=step(this_input, hidden_state)
+                    padded_output[...,t_ind,:]=this_output
+        return padded_output
+
+class IanRNN(AutoregressiveRNN):
     def __init__(self, input_dim, output_dim,
                  encoder_dim=100, encoder_extra_layers=1,
                  rnn_dim=100, rnn_num_layers=1,
@@ -50,62 +165,215 @@ class IanRNN(torch.nn.Module):
         self.rnn_num_layers=rnn_num_layers
         self.rnn_dim=rnn_dim
         self.output_dim=output_dim
-    # reset_probability is the probability we use the true input
-    # rather than autoregressed input for the next step
-    # nwarmup is number of steps for which it won't autoregress
-    # padded_input is like (nsamples, ntimes, nstates)
-    # if deterministic, take exactly (1./reset_probability) steps at a time
-    def forward(self, padded_input, reset_probability=0, nwarmup=0, deterministic=False):
-        # inference without autoregression (20x faster)
-        if reset_probability>=1:
-            embedding=self.encoder(padded_input)
-            if self.rnn_type=='lstm':
-                embedding_evolved,_=self.rnn(embedding)
-            else:
-                embedding_evolved=self.rnn(embedding)
-            padded_output=self.decoder(embedding_evolved)
-        # inference with probabilistic autoregression
+        self.autocast_dtype=None
+        # compiled versions of rollout_step, see compile_rollout_step
+        self.compiled_steps={}
+    # one autoregressive timestep on (nsamples, nstates) inputs, hidden_state is (h,c) for lstm
+    # uses lstm_cell directly on the LSTM's weights rather than running the LSTM on length-1 sequences
+    def rollout_step(self, this_input, hidden_state=None):
+        embedding=autocast_apply(self.encoder, this_input, self.autocast_dtype)
+        if self.rnn_type=='lstm':
+            hidden_state=torch.lstm_cell(embedding, hidden_state,
+                                         self.rnn.weight_ih_l0, self.rnn.weight_hh_l0,
+                                         self.rnn.bias_ih_l0, self.rnn.bias_hh_l0)
+            embedding_evolved=hidden_state[0]
         else:
-            # number of times
-            seq_len=padded_input.size()[-2]
-            # padded_output dim is padded_input without actuator chunk
-            padded_output=torch.zeros(padded_input[:,:,:self.output_dim].size())
-            # maintain previous output for autoregression (start at true t=0 state)
-            prev_output=padded_input[:,0,:self.output_dim].unsqueeze(1)
-            # only used for deterministic stepping
-            prev_tind=0
-            for t_ind in range(seq_len):
-                reset_flag=False
-                if deterministic:
-                    reset_flag = ( (t_ind-prev_tind) >= int(1./reset_probability) )
-                else:
-                     reset_flag = (torch.rand(1).item() < reset_probability)
-                reset_flag=( (t_ind<=nwarmup) or reset_flag )
-                if reset_flag:
-                    prev_tind=t_ind
-                if reset_flag:
-                    # predict from true state (don't autoregress this timestep)
-                    this_input=padded_input[:,t_ind,:].unsqueeze(1)
-                else:
-                    # autoregress: use previous output with actuators
-                    actuator_array=padded_input[:,t_ind,self.output_dim:].unsqueeze(1)
-                    this_input=torch.cat((prev_output,actuator_array),dim=-1)
-                ####### EVOLVE THE STATE
-                embedding=self.encoder(this_input)
-                # note hidden state has both state and memory, (h,c)
-                # on first timestep initialize hidden state to 0 by not passing it in
-                if self.rnn_type=='lstm':
-                    if t_ind==0:
-                        embedding_evolved,hidden_state=self.rnn(embedding)
-                    else:
-                        embedding_evolved,hidden_state=self.rnn(embedding,hidden_state)
-                else:
-                    embedding_evolved=self.rnn(embedding)
-                this_output=self.decoder(embedding_evolved)
-                ####### SAVE THE OUTPUT
-                prev_output = this_output
-                padded_output[:,t_ind,:] = prev_output.squeeze(1)
-        return padded_output
+            embedding_evolved=self.rnn(embedding)
+        return autocast_apply(self.decoder, embedding_evolved, self.autocast_dtype), hidden_state
+    # stepwise inference: output,hidden=step(state_input,hidden) advances one timestep from
+    # state_input like (nsamples, nstates), giving the same outputs as a teacher-forced
+    # (reset_probability=1) forward over the whole history at O(1) cost per step
+    def init_state(self, batch_size, device=None, dtype=torch.float):
+        if self.rnn_type!='lstm':
+            return None
+        return (torch.zeros((batch_size,self.rnn_dim), device=device, dtype=dtype),
+                torch.zeros((batch_size,self.rnn_dim), device=device, dtype=dtype))
+    def step(self, state_input, hidden=None):
+        if hidden is None:
+            hidden=self.init_state(state_input.size()[0], device=state_input.device, dtype=state_input.dtype)
+        return self.rollout_step(state_input, hidden)
+
+# a model's rollout_step as a module taking only tensors, which is what torch.jit.trace needs
+class IanRNNStep(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model=model
+    def forward(self, this_input, *hidden_state):
+        if len(hidden_state)==0:
+            return self.model.rollout_step(this_input)[0]
+        return self.model.rollout_step(this_input, hidden_state)
+
+# linear layer for num_members independent models evaluated in one batched matmul
+# weight is (num_members, out_features, in_features) so that indexing the first
+# dimension gives back the state of a torch.nn.Linear
+class StackedLinear(torch.nn.Module):
+    def __init__(self, num_members, in_features, out_features):
+        super().__init__()
+        self.weight=torch.nn.Parameter(torch.empty(num_members, out_features, in_features))
+        self.bias=torch.nn.Parameter(torch.empty(num_members, out_features))
+    # x is like (num_members, ..., in_features)
+    def forward(self, x):
+        dims=x.size()
+        output=torch.baddbmm(self.bias.unsqueeze(1),
+                             x.reshape(dims[0], -1, dims[-1]),
+                             self.weight.transpose(1,2))
+        return output.reshape(*dims[:-1], -1)
+
+# single layer batch_first LSTM for num_members independent models, parameters are
+# named and ordered like torch.nn.LSTM's with an extra leading member dimension
+class StackedLSTM(torch.nn.Module):
+    def __init__(self, num_members, input_size, hidden_size):
+        super().__init__()
+        self.hidden_size=hidden_size
+        self.weight_ih_l0=torch.nn.Parameter(torch.empty(num_members, 4*hidden_size, input_size))
+        self.weight_hh_l0=torch.nn.Parameter(torch.empty(num_members, 4*hidden_size, hidden_size))
+        self.bias_ih_l0=torch.nn.Parameter(torch.empty(num_members, 4*hidden_size))
+        self.bias_hh_l0=torch.nn.Parameter(torch.empty(num_members, 4*hidden_size))
+    # x is like (num_members, nsamples, ntimes, input_size), hidden is (h,c) each
+    # like (num_members, nsamples, hidden_size)
+    def forward(self, x, hidden=None):
+        num_members,num_samples,seq_len,input_size=x.size()
+        # input contribution to the gates for all timesteps at once
+        input_gates=torch.baddbmm((self.bias_ih_l0+self.bias_hh_l0).unsqueeze(1),
+                                  x.reshape(num_members, -1, input_size),
+                                  self.weight_ih_l0.transpose(1,2))
+        input_gates=input_gates.reshape(num_members, num_samples, seq_len, -1)
+        if hidden is None:
+            h=x.new_zeros((num_members, num_samples, self.hidden_size))
+            c=x.new_zeros((num_members, num_samples, self.hidden_size))
+        else:
+            h,c=hidden
+        outputs=[]
+        for t_ind in range(seq_len):
+            h,c=self.update_state(input_gates[:,:,t_ind,:], (h,c))
+            outputs.append(h)
+        return torch.stack(outputs, dim=2), (h,c)
+    # one timestep like torch.lstm_cell, x is like (num_members, nsamples, input_size)
+    def cell(self, x, hidden):
+        input_gates=torch.baddbmm((self.bias_ih_l0+self.bias_hh_l0).unsqueeze(1), x, self.weight_ih_l0.transpose(1,2))
+        return self.update_state(input_gates, hidden)
+    def update_state(self, input_gates, hidden):
+        h,c=hidden
+        gates=torch.baddbmm(input_gates, h, self.weight_hh_l0.transpose(1,2))
+        # same gate ordering as torch.nn.LSTM
+        i,f,g,o=gates.chunk(4, dim=-1)
+        c=torch.sigmoid(f)*c + torch.sigmoid(i)*torch.tanh(g)
+        h=torch.sigmoid(o)*torch.tanh(c)
+        return h,c
+
+# num_members IanRNNs with identical hyperparameters trained/evaluated at once with
+# stacked weights, so an ensemble shares data loading and bucket padding
+# output is like (num_members, nsamples, ntimes, output_dim)
+class EnsembleIanRNN(AutoregressiveRNN):
+    def __init__(self, input_dim, output_dim, num_members=1,
+                 encoder_dim=100, encoder_extra_layers=1,
+                 rnn_dim=100, rnn_num_layers=1,
+                 decoder_dim=100, decoder_extra_layers=1,
+                 rnn_type='lstm'
+                 ):
+        super().__init__()
+        self.num_members=num_members
+        self.encoder = torch.nn.Sequential()
+        self.encoder.append(StackedLinear(num_members, input_dim, encoder_dim))
+        self.encoder.append(torch.nn.ReLU())
+        for i in range(encoder_extra_layers):
+            self.encoder.append(StackedLinear(num_members, encoder_dim, encoder_dim))
+            self.encoder.append(torch.nn.ReLU())
+        self.rnn_type=rnn_type
+        if self.rnn_type=='lstm':
+            self.rnn=StackedLSTM(num_members, encoder_dim, rnn_dim)
+        elif self.rnn_type=='linear':
+            self.rnn=StackedLinear(num_members, encoder_dim, rnn_dim)
+        self.decoder = torch.nn.Sequential()
+        self.decoder.append(StackedLinear(num_members, rnn_dim, decoder_dim))
+        self.decoder.append(torch.nn.ReLU())
+        for i in range(decoder_extra_layers):
+            self.decoder.append(StackedLinear(num_members, decoder_dim, decoder_dim))
+            self.decoder.append(torch.nn.ReLU())
+        self.decoder.append(StackedLinear(num_members, decoder_dim, output_dim))
+        self.rnn_num_layers=rnn_num_layers
+        self.rnn_dim=rnn_dim
+        self.output_dim=output_dim
+        self.autocast_dtype=None
+        # compiled versions of rollout_step, see compile_rollout_step
+        self.compiled_steps={}
+        # initialize each member exactly like a standalone IanRNN
+        for member in range(num_members):
+            self.load_member_state_dict(member, IanRNN(input_dim, output_dim,
+                                                       encoder_dim=encoder_dim, encoder_extra_layers=encoder_extra_layers,
+                                                       rnn_dim=rnn_dim, rnn_num_layers=rnn_num_layers,
+                                                       decoder_dim=decoder_dim, decoder_extra_layers=decoder_extra_layers,
+                                                       rnn_type=rnn_type).state_dict())
+    # stack already trained IanRNNs (e.g. from get_considered_models) into one ensemble,
+    # members have to share the same hyperparameters
+    @classmethod
+    def from_members(cls, models):
+        if not cls.can_stack(models):
+            raise ValueError('EnsembleIanRNN members must all be IanRNNs with the same hyperparameters')
+        first_model=models[0]
+        ensemble=cls(input_dim=first_model.encoder[0].in_features, output_dim=first_model.output_dim,
+                     num_members=len(models),
+                     encoder_dim=first_model.encoder[0].out_features, encoder_extra_layers=len(first_model.encoder)//2-1,
+                     rnn_dim=first_model.rnn_dim, rnn_num_layers=first_model.rnn_num_layers,
+                     decoder_dim=first_model.decoder[0].out_features, decoder_extra_layers=len(first_model.decoder)//2-1,
+                     rnn_type=first_model.rnn_type)
+        for member,model in enumerate(models):
+            ensemble.load_member_state_dict(member, model.state_dict())
+        ensemble.autocast_dtype=first_model.autocast_dtype
+        ensemble=ensemble.to(first_model.encoder[0].weight.device)
+        # compile the stacked step the same way as the members' (see compile_rollout_step)
+        ensemble.compile_rollout_step(next(iter(first_model.compiled_steps), None))
+        return ensemble
+    # whether from_members can stack models, i.e. they're all IanRNNs with the same hyperparameters
+    @staticmethod
+    def can_stack(models):
+        if len(models)==0 or not all(type(model)==IanRNN for model in models):
+            return False
+        member_shapes={key: value.size() for key,value in models[0].state_dict().items()}
+        return all(model.rnn_type==models[0].rnn_type and
+                   {key: value.size() for key,value in model.state_dict().items()}==member_shapes
+                   for model in models)
+    # mean and standard deviation over members of a single batched rollout, same arguments as forward
+    # if return_members also hand back the (num_members, nsamples, ntimes, nstates) member outputs
+    def predict(self, padded_input, reset_probability=0, nwarmup=0, deterministic=False, return_members=False):
+        member_outputs=self(padded_input, reset_probability=reset_probability, nwarmup=nwarmup, deterministic=deterministic)
+        std,mean=torch.std_mean(member_outputs, dim=0, unbiased=False)
+        if return_members:
+            return mean, std, member_outputs
+        return mean, std
+    # state dict of a single member, loadable into an IanRNN
+    def member_state_dict(self, member):
+        return {key: value[member].clone() for key,value in self.state_dict().items()}
+    def load_member_state_dict(self, member, state_dict):
+        own_state=self.state_dict()
+        with torch.no_grad():
+            for key,value in state_dict.items():
+                own_state[key][member].copy_(value)
+    # slice an optimizer state dict (e.g. Adam moments) down to a single member, since
+    # parameters are ordered like IanRNN's the result can be loaded for an IanRNN
+    def member_optimizer_state_dict(self, optimizer_state_dict, member):
+        member_state={}
+        for param_id,param_state in optimizer_state_dict['state'].items():
+            member_state[param_id]={key: (value[member].clone() if torch.is_tensor(value) and value.dim()>0 else value)
+                                    for key,value in param_state.items()}
+        return {'state': member_state, 'param_groups': optimizer_state_dict['param_groups']}
+    # IanRNN.rollout_step with every member at once, this_input is like (num_members, nsamples, nstates)
+    def rollout_step(self, this_input, hidden_state=None):
+        embedding=autocast_apply(self.encoder, this_input, self.autocast_dtype)
+        if self.rnn_type=='lstm':
+            hidden_state=self.rnn.cell(embedding, hidden_state)
+            embedding_evolved=hidden_state[0]
+        else:
+            embedding_evolved=self.rnn(embedding)
+        return autocast_apply(self.decoder, embedding_evolved, self.autocast_dtype), hidden_state
+    # same arguments as IanRNN.forward, padded_input is like (nsamples, ntimes, nstates)
+    # (shared by all members) or (num_members, nsamples, ntimes, nstates)
+    def forward(self, padded_input, reset_probability=0, nwarmup=0, deterministic=False):
+        if padded_input.dim()==3:
+            padded_input=padded_input.unsqueeze(0).expand(self.num_members, -1, -1, -1)
+        # all members see the same resets
+        return super().forward(padded_input, reset_probability=reset_probability, nwarmup=nwarmup,
+                               deterministic=deterministic)
 
 class InverseLeakyReLU(torch.nn.Module):
     def __init__(self, slope=0.01):
@@ -138,8 +406,6 @@ class InverseLinear(torch.nn.Module):
 
     def forward(self, x):
         # Apply the inverse transformation
-        if torch.cuda.is_available():
-            x=x.to('cuda') # fixes issue of tensors being in CPU and cuda when autoregressively training
         result = torch.matmul(x, self.inverse_matrix.t())  # Transpose for proper matrix multiplication
 
         # Add biases if they exist
@@ -158,6 +424,7 @@ class HiroLRAN(torch.nn.Module):
         self.input_dim = input_dim
         self.latent_dim = latent_dim
         self.output_dim = output_dim
+        self.autocast_dtype = None
         state_dim = output_dim
         # see if this fixes issue with model.to(device) not sending all layers to cuda
         self.LeakyReLU = torch.nn.LeakyReLU(0.01)
@@ -215,15 +482,77 @@ class HiroLRAN(torch.nn.Module):
         self.decoder.add_module('decoding_last_layer', torch.nn.Sequential(
             torch.nn.Linear(encoder_dim, state_dim),
         ))
-        
-    def forward(self, padded_input, reset_probability=0, nwarmup=0):
+        # see get_prediction_matrices
+        self.prediction_matrices_cache={}
+
+    # lifted prediction matrices over a horizon of N steps, so the stacked latent states z_1..z_N
+    # are Phi z_0 + Gamma u for stacked actuators u_1..u_N, with Phi=[A; A^2; ...; A^N] and
+    # Gamma block lower triangular Toeplitz with blocks A^(i-j) B
+    # without autograd the result is cached until the A or B weights change (e.g. optimizer step
+    # or load_state_dict), device or dtype; only the longest horizon is kept, since the leading
+    # blocks of its matrices are those of any shorter horizon (e.g. buckets of different lengths)
+    def get_prediction_matrices(self, horizon):
+        A=self.A.weight
+        B=self.B.weight
+        key=(A._version, B._version, A.data_ptr(), B.data_ptr(), A.device, A.dtype)
+        use_cache=not torch.is_grad_enabled()
+        if use_cache and self.prediction_matrices_cache.get('key')==key and self.prediction_matrices_cache['horizon']>=horizon:
+            Phi,Gamma=self.prediction_matrices_cache['matrices']
+            if self.prediction_matrices_cache['horizon']==horizon:
+                return Phi, Gamma
+            return Phi[:horizon*self.latent_dim], Gamma[:horizon*self.latent_dim,:horizon*B.size()[1]]
+        # A^0 ... A^N
+        A_powers=[torch.eye(self.latent_dim, device=A.device, dtype=A.dtype)]
+        for k in range(horizon):
+            A_powers.append(torch.matmul(A, A_powers[-1]))
+        Phi=torch.cat(A_powers[1:], dim=0)
+        AB=[torch.matmul(A_powers[k], B) for k in range(horizon)]
+        zero_block=torch.zeros_like(B)
+        Gamma=torch.cat([torch.cat([AB[i-j] if j<=i else zero_block for j in range(horizon)], dim=1)
+                         for i in range(horizon)], dim=0)
+        if use_cache:
+            self.prediction_matrices_cache={'key': key, 'horizon': horizon, 'matrices': (Phi, Gamma)}
+        return Phi, Gamma
+
+    # latent trajectory (nsamples, N, latent_dim) from z_0 (nsamples, latent_dim) with no resets,
+    # given future_actuators (nsamples, N, actuator_length) i.e. u_1..u_N
+    def predict_latent(self, z_0, future_actuators):
+        horizon=future_actuators.size()[1]
+        Phi,Gamma=self.get_prediction_matrices(horizon)
+        z=torch.matmul(z_0, Phi.t()) + torch.matmul(future_actuators.reshape(z_0.size()[0],-1), Gamma.t())
+        return z.reshape(z_0.size()[0], horizon, self.latent_dim)
+
+    # latent rollout z_{t+1} = A in_t + B u_{t+1}, with in_t the true z_t where reset_mask is set
+    # and the previous output otherwise, as a parallel (Hillis-Steele) scan: after the stage with
+    # offset d each step holds the sum over its last 2d steps, so it takes log2(ntimes) stages
+    # of batched matmuls rather than ntimes sequential steps
+    def latent_scan(self, z_t, u_t1, reset_mask):
+        seq_len=z_t.size()[1]
+        z_t1=self.B(u_t1) + torch.where(reset_mask.unsqueeze(-1), self.A(z_t), 0)
+        # whether a reset happens within the window summed so far, which cuts off earlier steps
+        blocked=reset_mask
+        A_power=self.A.weight
+        offset=1
+        while offset<seq_len:
+            # selected rather than multiplied by the mask, since A_power can overflow to inf where
+            # it isn't needed (A with eigenvalues above 1) and inf*0 is nan
+            contribution=torch.where(blocked[:,offset:].unsqueeze(-1), 0, torch.matmul(z_t1[:,:-offset], A_power.t()))
+            z_t1=torch.cat((z_t1[:,:offset], z_t1[:,offset:]+contribution), dim=1)
+            blocked=torch.cat((blocked[:,:offset], blocked[:,offset:] | blocked[:,:-offset]), dim=1)
+            offset*=2
+            if offset<seq_len:
+                A_power=torch.matmul(A_power, A_power)
+        return z_t1
+
+    # parallel_scan=False steps through time in python instead of using latent_scan
+    def forward(self, padded_input, reset_probability=0, nwarmup=0, parallel_scan=True):
         state_dim = self.output_dim
         #state_dim = state_dim.cuda()
         x_t = padded_input[:, :, :state_dim]
         actuator_length = (self.input_dim - state_dim) // 2 # divide by 2 cuz input has u_t and u_t+1
         u_t = padded_input[:, :, state_dim:state_dim+actuator_length]
         u_t1 = padded_input[:, :, state_dim+actuator_length:]
-        z_t = self.encoder(x_t)
+        z_t = autocast_apply(self.encoder, x_t, self.autocast_dtype)
         # inference without autoregression (20x faster)
         if reset_probability>=1:
             z_t1=self.A(z_t) + self.B(u_t1)
@@ -231,33 +560,44 @@ class HiroLRAN(torch.nn.Module):
         else:
             # number of times
             seq_len=padded_input.size()[-2]
-            # padded_output dim is padded_input without actuator chunk
-            z_t1=torch.zeros(z_t.size())
-            # maintain previous output for autoregression (start at true t=0 state)
-            prev_output=z_t[:,0,:].unsqueeze(1)
-            for t_ind in range(seq_len):
-                if (t_ind<=nwarmup) or (torch.rand(1).item() < reset_probability):
-                    # predict from true state (don't autoregress this timestep)
-                    this_input = z_t[:, t_ind, :].unsqueeze(1)
-                else:
-                    # autoregress: use previous output with actuators
-                    this_input=prev_output
-                ####### EVOLVE THE STATE
-                this_output=self.A(this_input) + self.B(u_t1[:, t_ind, :].unsqueeze(1))
-                ####### SAVE THE OUTPUT
-                prev_output = this_output
-                z_t1[:,t_ind,:] = prev_output.squeeze(1)
-        if torch.cuda.is_available():
-            z_t1=z_t1.to('cuda')
-        x_t1 = self.decoder(z_t1)
+            reset_mask=get_reset_mask(z_t.size()[0], seq_len, reset_probability, nwarmup, device=z_t.device)
+            if parallel_scan and reset_probability==0 and seq_len>nwarmup+1 and not torch.is_grad_enabled():
+                # inference without resets after warmup: the steps after it are the lifted
+                # prediction from the last warmup step, reusing the cached prediction matrices
+                z_warmup=self.A(z_t[:,:nwarmup+1]) + self.B(u_t1[:,:nwarmup+1])
+                z_t1=torch.cat((z_warmup, self.predict_latent(z_warmup[:,-1], u_t1[:,nwarmup+1:])), dim=1)
+            elif parallel_scan:
+                z_t1=self.latent_scan(z_t, u_t1, reset_mask)
+            else:
+                # padded_output dim is padded_input without actuator chunk
+                z_t1=z_t.new_zeros(z_t.size())
+                # maintain previous output for autoregression (start at true t=0 state)
+                prev_output=z_t[:,0,:].unsqueeze(1)
+                for t_ind in range(seq_len):
+                    # predict from true state where reset (don't autoregress this timestep),
+                    # otherwise autoregress from the previous output
+                    this_input=torch.where(reset_mask[:,t_ind,None,None], z_t[:, t_ind, :].unsqueeze(1), prev_output)
+                    ####### EVOLVE THE STATE
+                    this_output=self.A(this_input) + self.B(u_t1[:, t_ind, :].unsqueeze(1))
+                    ####### SAVE THE OUTPUT
+                    prev_output = this_output
+                    z_t1[:,t_ind,:] = prev_output.squeeze(1)
+        x_t1 = autocast_apply(self.decoder, z_t1, self.autocast_dtype)
         return x_t1
     
+    # same stepwise interface as IanRNN, though the model has no memory
+    # so the hidden state is always None
+    def init_state(self, batch_size, device=None, dtype=torch.float):
+        return None
+    def step(self, state_input, hidden=None):
+        return self(state_input.unsqueeze(1), reset_probability=1)[:,0], hidden
+
     def encode_decode(self, padded_input):
         state_dim = self.output_dim
         x_t = padded_input[:, :, :state_dim]
         u_t = padded_input[:,:, state_dim:]
-        z_t = self.encoder(x_t)
-        x_t_hat = self.decoder(z_t)
+        z_t = autocast_apply(self.encoder, x_t, self.autocast_dtype)
+        x_t_hat = autocast_apply(self.decoder, z_t, self.autocast_dtype)
         return x_t_hat
 
 # simple mapping, given just actuators over time try to predict profiles
@@ -0,0 +1,77 @@
+import numpy as np
+import warnings
+
+# model_predictions is (model, sample, profile, time, rho) and truth is (sample, profile, time, rho)
+
+# for each sample, the last time (within prediction_length) at which no model's prediction has a NaN,
+# 0 if there is none; errors are evaluated for the times before this (the time itself not included)
+def get_min_prediction_steps(model_predictions, prediction_length):
+    valid=~np.isnan(model_predictions[:,:,:,:prediction_length]).any(axis=(0,2,4))
+    last_valid=valid.shape[1]-1-np.argmax(valid[:,::-1],axis=1)
+    return np.where(valid.any(axis=1), last_valid, 0)
+
+# percent RMS (over rho, the last axis) error of predictions, relative to the RMS of truth
+def sigma(predictions, truth):
+    numerator=np.sqrt(np.mean(np.square(predictions-truth),axis=-1))
+    denominator=np.sqrt(np.mean(np.square(truth),axis=-1))
+    return 100*(numerator/denominator)
+
+# sigma for every (sample, model, profile, time) at once, NaN from each sample's min_prediction_steps on
+# inverted_profiles (q) are compared as their inverse
+def get_all_sigmas(model_predictions, truth, profiles, prediction_length,
+                   inverted_profiles=['qpsi_EFIT01']):
+    min_prediction_steps=get_min_prediction_steps(model_predictions, prediction_length)
+    predictions=model_predictions[:,:,:,:prediction_length]
+    truth=truth[:,:,:prediction_length]
+    inverted=np.isin(profiles, inverted_profiles)[:,None,None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        predictions=np.where(inverted, 1./predictions, predictions)
+        truth=np.where(inverted, 1./truth, truth)
+        all_sigmas=np.moveaxis(sigma(predictions, truth[None]),0,1)
+    evaluated=np.arange(all_sigmas.shape[-1])[None,:]<min_prediction_steps[:,None]
+    return np.where(evaluated[:,None,None,:], all_sigmas, np.nan)
+
+# sorts once by key (e.g. shot) for the grouped statistics below: the order that sorts samples into
+# their groups, plus each group's key, start in the sorted samples and number of samples
+def sort_by_group(keys):
+    keys=np.asarray(keys)
+    order=np.argsort(keys, kind='stable')
+    unique_keys,starts,counts=np.unique(keys[order], return_index=True, return_counts=True)
+    return order, unique_keys, starts, counts
+
+# nanmean over the samples (first axis) of values within each group, as (group, ...)
+def grouped_nanmean(values, keys):
+    order,unique_keys,starts,_=sort_by_group(keys)
+    values=np.asarray(values, dtype=float)[order]
+    if len(unique_keys)==0:
+        return unique_keys, np.zeros((0,)+values.shape[1:])
+    finite=~np.isnan(values)
+    sums=np.add.reduceat(np.where(finite,values,0),starts,axis=0)
+    counts=np.add.reduceat(finite,starts,axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return unique_keys, sums/counts
+
+# nanpercentile over the samples of values within each group, as (percentile, group, ...)
+# groups are padded with NaN to the largest group so this is a single nanpercentile call
+def grouped_nanpercentile(values, keys, percentiles):
+    order,unique_keys,starts,counts=sort_by_group(keys)
+    values=np.asarray(values, dtype=float)[order]
+    padded=np.full((len(unique_keys),max(counts, default=0))+values.shape[1:], np.nan)
+    group_inds=np.repeat(np.arange(len(unique_keys)),counts)
+    padded[group_inds,np.arange(len(values))-starts[group_inds]]=values
+    with warnings.catch_warnings():
+        # all-NaN groups just give NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return unique_keys, np.nanpercentile(padded, percentiles, axis=1)
+
+# get_median_and_iqr within each group (e.g. of (sample, ..., horizon) errors per shot), as (group, ...)
+def grouped_median_and_iqr(values, keys):
+    unique_keys,(lower,median,upper)=grouped_nanpercentile(values, keys, [25,50,75])
+    return unique_keys, median, upper-lower
+
+# median and interquartile range over samples (axis), ignoring NaNs, e.g. of (sample, horizon) errors
+def get_median_and_iqr(values, axis=0):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        lower,median,upper=np.nanpercentile(values, [25,50,75], axis=axis)
+    return median, upper-lower
@@ -1,20 +1,39 @@
 import torch
 from torch.nn.utils.rnn import pack_padded_sequence, pad_sequence
 from customDatasetMakers import preprocess_data, ian_dataset, get_state_indices_dic
-from customModels import IanRNN, IanMLP, HiroLRAN
+from customModels import IanRNN, IanMLP, HiroLRAN, EnsembleIanRNN, set_model_precision
 from train_helpers import make_bucket, \
-    get_state_mask, get_sample_time_state_mask, masked_loss
+    get_state_mask, get_sample_time_state_mask, masked_loss, \
+    shard_indices, distributed_mean, get_rng_state, set_rng_state, CheckpointWriter
+from torch.nn.parallel import DistributedDataParallel
+import torch.distributed as dist
 
 from dataSettings import nx
 
+import numpy as np
+import random
 import configparser
 import os
 import sys
-import shutil
 import time
+import signal
 
 models={'IanRNN': IanRNN, 'IanMLP': IanMLP, 'HiroLRAN': HiroLRAN}
 
+# launching with torchrun (e.g. torchrun --standalone --nproc_per_node=4 ian_train.py model.cfg)
+# sets these environment variables, in which case we train with DistributedDataParallel:
+# each rank gets a disjoint shard of the buckets each epoch and gradients are all-reduced
+distributed=int(os.environ.get('WORLD_SIZE',1))>1
+if distributed:
+    rank=int(os.environ['RANK'])
+    world_size=int(os.environ['WORLD_SIZE'])
+    local_rank=int(os.environ.get('LOCAL_RANK',0))
+    # gloo works on CPU-only nodes
+    dist.init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo')
+else:
+    rank,world_size,local_rank=0,1,0
+is_main_process=(rank==0)
+
 if (len(sys.argv)-1) > 0:
     config_filename=sys.argv[1]
 else:
@@ -36,6 +55,22 @@ l1_lambda=config['optimization'].getfloat('l1_lambda')
 l2_lambda=config['optimization'].getfloat('l2_lambda')
 pcs_normalize=config['optimization'].getboolean('pcs_normalize',False)
 inverting_weight=config['optimization'].getfloat('inverting_weight')
+# fp32 (default), bf16 or fp16 autocasting of encoder/decoder; fp16 only makes sense on GPU
+precision=config['optimization'].get('precision','fp32')
+# 0 means use torch's default number of threads
+num_threads=config['optimization'].getint('num_threads',0)
+# >1 trains that many IanRNNs at once with stacked weights (sharing data loading and
+# bucket padding), writing {output_filename_base}0.tar, {output_filename_base}1.tar, ...
+ensemble_size=config['optimization'].getint('ensemble_size',1)
+# every this many epochs write {output_filename_base}RESUME.tar with everything needed to continue
+# training exactly where it left off (if it exists when starting, training resumes from it); 0 to disable
+checkpoint_every=config['optimization'].getint('checkpoint_every',0)
+# optional, for reproducible runs
+seed=config['optimization'].getint('seed',None)
+if seed is not None:
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    random.seed(seed)
 profiles=config['inputs']['profiles'].split()
 actuators=config['inputs']['actuators'].split()
 parameters=config['inputs'].get('parameters','').split()
@@ -71,21 +106,49 @@ model_hyperparams={key: int(val) for key,val in dict(config[model_type]).items()
 state_length=len(profiles)*nx+len(parameters)
 actuator_length=len(actuators)
 calculation_length=len(calculations)*33
-model=models[model_type](input_dim=state_length+calculation_length+2*actuator_length, output_dim=state_length,
-                         **model_hyperparams)
+if ensemble_size>1:
+    if model_type!='IanRNN':
+        raise Exception(f"ensemble_size>1 only supported for IanRNN, not {model_type}")
+    model=EnsembleIanRNN(input_dim=state_length+calculation_length+2*actuator_length, output_dim=state_length,
+                         num_members=ensemble_size, **model_hyperparams)
+    member_labels=[str(member) for member in range(ensemble_size)]
+else:
+    model=models[model_type](input_dim=state_length+calculation_length+2*actuator_length, output_dim=state_length,
+                             **model_hyperparams)
+    member_labels=['']
+if precision!='fp32':
+    set_model_precision(model, precision)
+    print(f'Autocasting encoder/decoder to {precision}')
+if num_threads>0:
+    torch.set_num_threads(num_threads)
+elif distributed and not torch.cuda.is_available():
+    # torchrun defaults to 1 thread per process, so split the node's cores among local ranks instead
+    torch.set_num_threads(max(1, os.cpu_count()//int(os.environ.get('LOCAL_WORLD_SIZE',1))))
 # dump to same location as the config filename, with .tar instead of .cfg
-output_filename=os.path.join(config['model']['output_dir'],f"{config['model']['output_filename_base']}.tar")
-epoch_output_filename = lambda epoch : os.path.join(config['model']['output_dir'],f"{config['model']['output_filename_base']}EPOCH{epoch}.tar")
+# (one file per ensemble member, labeled like launch_ensemble does)
+output_filenames=[os.path.join(config['model']['output_dir'],f"{config['model']['output_filename_base']}{label}.tar")
+                  for label in member_labels]
+resume_filename=os.path.join(config['model']['output_dir'],f"{config['model']['output_filename_base']}RESUME.tar")
+epoch_output_filename = lambda epoch, member=0 : os.path.join(config['model']['output_dir'],f"{config['model']['output_filename_base']}{member_labels[member]}EPOCH{epoch}.tar")
 # you probably want to use the same config file you had used for the original model, though you might swap
 # out signals like for data+sim
 if tune_model:
-    untuned_output_filename=os.path.join(config['model']['output_dir'],f"{model_to_tune_filename_base}.tar")
-    # note that if you run on a different computer, you might need map_location=torch.device('cpu') for loading
-    saved_state=torch.load(untuned_output_filename)
-    model.load_state_dict(saved_state['model_state_dict'])
-    if resume_training:
-        start_epoch=saved_state['epoch']
-    print(f'Starting from model state stored in {untuned_output_filename}, from epoch {start_epoch}; saving new model to {output_filename}')
+    if ensemble_size>1:
+        if resume_training:
+            raise Exception("resume_training not supported for ensemble_size>1, tune from the member files instead")
+        for member,label in enumerate(member_labels):
+            untuned_output_filename=os.path.join(config['model']['output_dir'],f"{model_to_tune_filename_base}{label}.tar")
+            saved_state=torch.load(untuned_output_filename, map_location=torch.device('cpu'))
+            model.load_member_state_dict(member, saved_state['model_state_dict'])
+            print(f'Starting member {member} from model state stored in {untuned_output_filename}; saving new model to {output_filenames[member]}')
+    else:
+        untuned_output_filename=os.path.join(config['model']['output_dir'],f"{model_to_tune_filename_base}.tar")
+        # note that if you run on a different computer, you might need map_location=torch.device('cpu') for loading
+        saved_state=torch.load(untuned_output_filename, map_location=torch.device('cpu'))
+        model.load_state_dict(saved_state['model_state_dict'])
+        if resume_training:
+            start_epoch=saved_state['epoch']
+        print(f'Starting from model state stored in {untuned_output_filename}, from epoch {start_epoch}; saving new model to {output_filenames[0]}')
     for name, child in model.named_children():
         if name in frozen_layers:
             print(f"Freezing '{name}' layer for tuning procedure")
@@ -117,14 +180,26 @@ state_mask=get_state_mask(profiles, parameters,
                           masked_outputs, rho_bdry_index)
 print('Training...')
 if torch.cuda.is_available():
-    device='cuda'
-    if torch.cuda.device_count() > 1:
-        model = torch.nn.DataParallel(model)
+    if distributed:
+        device=f'cuda:{local_rank}'
+        torch.cuda.set_device(local_rank)
+    else:
+        device='cuda'
     print(f"Using {torch.cuda.device_count()} GPU(s)")
 else:
     device = 'cpu'
     print("Using CPU")
 model.to(device)
+# keep a handle on the underlying model for saving state and calling
+# methods like encode_decode that the DDP wrapper doesn't expose
+unwrapped_model=model
+if distributed:
+    model=DistributedDataParallel(model, device_ids=[local_rank] if torch.cuda.is_available() else None)
+    print(f'Rank {rank}/{world_size} ready')
+if precision=='fp16' and device=='cpu':
+    raise Exception("precision=fp16 is only supported on GPU, use bf16 on CPU")
+# loss scaling only needed for fp16 (bf16 has the same exponent range as fp32)
+scaler=torch.cuda.amp.GradScaler(enabled=(precision=='fp16'))
 param_size = 0
 for param in model.parameters():
     param_size += param.nelement() * param.element_size()
@@ -150,12 +225,39 @@ optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters(
 #scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, lr_gamma, last_epoch=lr_stop_epoch)
 if tune_model and resume_training:
     optimizer.load_state_dict(saved_state['optimizer_state_dict'])
-    avg_train_losses=saved_state['train_losses']
-    avg_val_losses=saved_state['val_losses']
+    avg_train_losses=[saved_state['train_losses']]
+    avg_val_losses=[saved_state['val_losses']]
 else:
-    avg_train_losses=[]
-    avg_val_losses=[]
-for epoch in range(start_epoch, n_epochs):
+    # loss histories for each ensemble member (just one list unless ensembling)
+    avg_train_losses=[[] for label in member_labels]
+    avg_val_losses=[[] for label in member_labels]
+# epoch the loop starts from, differs from start_epoch (which affects checkpoint selection) when resuming
+first_epoch=start_epoch
+if checkpoint_every>0 and os.path.exists(resume_filename):
+    resume_state=torch.load(resume_filename, map_location=torch.device('cpu'))
+    unwrapped_model.load_state_dict(resume_state['model_state_dict'])
+    optimizer.load_state_dict(resume_state['optimizer_state_dict'])
+    scaler.load_state_dict(resume_state['scaler_state_dict'])
+    avg_train_losses=resume_state['train_losses']
+    avg_val_losses=resume_state['val_losses']
+    start_epoch=resume_state['start_epoch']
+    first_epoch=resume_state['epoch']+1
+    if len(resume_state['rng_states'])!=world_size:
+        print(f"Warning: checkpoint was written with {len(resume_state['rng_states'])} processes, not {world_size}; resumed run won't exactly match")
+    # restore RNG last, after anything else that might draw random numbers
+    set_rng_state(resume_state['rng_states'][rank % len(resume_state['rng_states'])])
+    print(f'Resuming from {resume_filename} at epoch {first_epoch}')
+# checkpoints are written in the background, the most recent snapshot
+# for each member is kept around for save_epochs copies
+checkpoint_writer=CheckpointWriter()
+last_checkpoints=[None for label in member_labels]
+# schedulers send SIGTERM before killing a job (e.g. at its time limit), get what's
+# already been saved onto disk before going down (exit code as if killed by the signal)
+def flush_and_exit(signum, frame):
+    checkpoint_writer.close()
+    sys.exit(128+signum)
+signal.signal(signal.SIGTERM, flush_and_exit)
+for epoch in range(first_epoch, n_epochs):
     if autoregression_num_steps<=1 or epoch<autoregression_start_epoch:
         reset_probability=1
     else:
@@ -168,10 +270,17 @@ for epoch in range(start_epoch, n_epochs):
             x1=float(autoregression_start_epoch)
             avg_steps=(y2-y1)/(x2-x1) * (epoch-x1) + y1
         reset_probability=1./avg_steps
-        print(f'Autoregression on, average timestep {avg_steps:0.1f}')
+        if is_main_process:
+            print(f'Autoregression on, average timestep {avg_steps:0.1f}')
     model.train()
     train_losses=[]
-    for which_bucket in torch.randperm(len(train_x_buckets)):
+    bucket_order=torch.randperm(len(train_x_buckets))
+    if distributed:
+        # all ranks use rank 0's shuffle, then each takes its own shard
+        bucket_order_list=[bucket_order]
+        dist.broadcast_object_list(bucket_order_list, src=0)
+        bucket_order=shard_indices(bucket_order_list[0].tolist(), rank, world_size)
+    for which_bucket in bucket_order:
         random_order=torch.randperm(len(train_x_buckets[which_bucket]))
         x_bucket=[train_x_buckets[which_bucket][i] for i in random_order]
         y_bucket=[train_y_buckets[which_bucket][i] for i in random_order]
@@ -185,11 +294,20 @@ for epoch in range(start_epoch, n_epochs):
         optimizer.zero_grad()
         model_output=model(padded_x,reset_probability=reset_probability,nwarmup=nwarmup)
         model_output=model_output.to(device)
-        mask=get_sample_time_state_mask(state_mask, model_output.size(), length_bucket, nwarmup)
+        mask=get_sample_time_state_mask(state_mask, padded_y.size(), length_bucket, nwarmup)
         mask=mask.to(device)
-        train_loss=masked_loss(loss_fn,
-                               model_output, padded_y,
-                               mask)
+        if ensemble_size>1:
+            # sum (not mean) over members so each member's gradient is what it would be on its own
+            member_losses=torch.stack([masked_loss(loss_fn,
+                                                   model_output[member], padded_y,
+                                                   mask)
+                                       for member in range(ensemble_size)])
+            train_loss=member_losses.sum()
+        else:
+            train_loss=masked_loss(loss_fn,
+                                   model_output, padded_y,
+                                   mask)
+            member_losses=train_loss.unsqueeze(0)
         # L1 regularization
         '''l1_reg = torch.tensor(0.0, device=device)
         for param in model.parameters():
@@ -202,19 +320,23 @@ for epoch in range(start_epoch, n_epochs):
             l2_reg += torch.norm(param, p=2).sum()
         train_loss += l2_lambda * l2_reg'''
         if (model_type=='HiroLRAN' and inverting_weight!=0):
-            padded_x_hat = model.encode_decode(padded_x)
+            padded_x_hat = unwrapped_model.encode_decode(padded_x)
             inverting_loss = masked_loss(loss_fn, padded_x[:,:,:state_length], padded_x_hat, mask)
             train_loss += inverting_weight * inverting_loss
         # Backpropagation
-        train_loss.backward()
-        optimizer.step()
-        train_losses.append(train_loss.item())
+        scaler.scale(train_loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        train_losses.append(member_losses.tolist())
     #scheduler.step()
-    avg_train_losses.append(sum(train_losses)/len(train_losses)) # now divide by total number of samples to get mean over steps/batches
+    for member in range(ensemble_size):
+        # now divide by total number of samples to get mean over steps/batches
+        avg_train_losses[member].append(distributed_mean([losses[member] for losses in train_losses], device))
     model.eval()
     val_losses=[]
     with torch.no_grad():
-        for which_bucket in range(len(val_x_buckets)):
+        # validation is sharded across ranks (and not padded, so every bucket counts once)
+        for which_bucket in range(rank, len(val_x_buckets), world_size):
             x_bucket=val_x_buckets[which_bucket]
             y_bucket=val_y_buckets[which_bucket]
             length_bucket=val_length_buckets[which_bucket]
@@ -222,50 +344,95 @@ for epoch in range(start_epoch, n_epochs):
             padded_y=pad_sequence(y_bucket, batch_first=True)
             padded_x=padded_x.to(device)
             padded_y=padded_y.to(device)
-            model_output = model(padded_x,reset_probability=reset_probability,nwarmup=nwarmup)
+            model_output = unwrapped_model(padded_x,reset_probability=reset_probability,nwarmup=nwarmup)
             model_output = model_output.to(device)
-            mask=get_sample_time_state_mask(state_mask, model_output.size(), length_bucket, nwarmup)
+            mask=get_sample_time_state_mask(state_mask, padded_y.size(), length_bucket, nwarmup)
             mask=mask.to(device)
-            val_loss=masked_loss(loss_fn,
-                                 model_output, padded_y,
-                                 mask)
-            val_losses.append(val_loss.item())
-        avg_val_losses.append(sum(val_losses)/len(val_losses))
-    print(f'{epoch+1:4d}/{n_epochs}({(time.time()-prev_time):0.2f}s)... train: {avg_train_losses[-1]:0.2e}, val: {avg_val_losses[-1]:0.2e};')
-    # the task gets harder for curriculum learning during the ramp
-    # before the ramp, consider only the best model so far
-    if autoregression_num_steps<=1 or epoch<=autoregression_start_epoch:
-        relevant_val_losses=avg_val_losses
-    else:
-        # if during the ramp always save
-        if epoch<=autoregression_end_epoch:
-            relevant_val_losses=[avg_val_losses[-1]]
-        # after ramp consider only losses after ramp
+            if ensemble_size>1:
+                val_losses.append([masked_loss(loss_fn,
+                                               model_output[member], padded_y,
+                                               mask).item()
+                                   for member in range(ensemble_size)])
+            else:
+                val_loss=masked_loss(loss_fn,
+                                     model_output, padded_y,
+                                     mask)
+                val_losses.append([val_loss.item()])
+        for member in range(ensemble_size):
+            avg_val_losses[member].append(distributed_mean([losses[member] for losses in val_losses], device))
+    write_resume_checkpoint=(checkpoint_every>0 and (epoch+1)%checkpoint_every==0)
+    if write_resume_checkpoint:
+        # each rank draws its own random numbers (e.g. autoregression resets), so keep all of them
+        rng_states=[get_rng_state()]
+        if distributed:
+            rng_states=[None for i in range(world_size)]
+            dist.all_gather_object(rng_states, get_rng_state())
+    if not is_main_process:
+        prev_time=time.time()
+        continue
+    for member in range(ensemble_size):
+        member_prefix=f'member {member}: ' if ensemble_size>1 else ''
+        print(f'{epoch+1:4d}/{n_epochs}({(time.time()-prev_time):0.2f}s)... {member_prefix}train: {avg_train_losses[member][-1]:0.2e}, val: {avg_val_losses[member][-1]:0.2e};')
+        # the task gets harder for curriculum learning during the ramp
+        # before the ramp, consider only the best model so far
+        if autoregression_num_steps<=1 or epoch<=autoregression_start_epoch:
+            relevant_val_losses=avg_val_losses[member]
         else:
-            # and if we're e.g. tuning a model on a different task only consider new loss regime
-            relevant_val_losses=avg_val_losses[max(start_epoch,autoregression_end_epoch):]
-    best_epoch= ( avg_val_losses[-1]==min(relevant_val_losses) )
-    # in weird case we don't yet have a .tar file, e.g. if we're resuming training into a new filename,
-    # be sure to save the first step
-    if not os.path.exists(output_filename):
-        best_epoch=True
-    if (not early_saving) or best_epoch:
-        print(f"Checkpoint")
-        torch.save({
+            # if during the ramp always save
+            if epoch<=autoregression_end_epoch:
+                relevant_val_losses=[avg_val_losses[member][-1]]
+            # after ramp consider only losses after ramp
+            else:
+                # and if we're e.g. tuning a model on a different task only consider new loss regime
+                relevant_val_losses=avg_val_losses[member][max(start_epoch,autoregression_end_epoch):]
+        best_epoch= ( avg_val_losses[member][-1]==min(relevant_val_losses) )
+        # in weird case we don't yet have a .tar file, e.g. if we're resuming training into a new filename,
+        # be sure to save the first step
+        if not os.path.exists(output_filenames[member]) and last_checkpoints[member] is None:
+            best_epoch=True
+        if (not early_saving) or best_epoch:
+            print(f"Checkpoint")
+            if ensemble_size>1:
+                model_state_dict=unwrapped_model.member_state_dict(member)
+                optimizer_state_dict=unwrapped_model.member_optimizer_state_dict(optimizer.state_dict(), member)
+            else:
+                model_state_dict=unwrapped_model.state_dict()
+                optimizer_state_dict=optimizer.state_dict()
+            last_checkpoints[member]=checkpoint_writer.save({
+                'epoch': epoch,
+                'model_state_dict': model_state_dict,
+                'optimizer_state_dict': optimizer_state_dict,
+                #'scheduler_state_dict': scheduler.state_dict(),
+                'train_losses': avg_train_losses[member],
+                'val_losses': avg_val_losses[member],
+                'profiles': profiles,
+                'parameters': parameters,
+                'calculations': calculations,
+                'actuators': actuators,
+                'model_hyperparams': model_hyperparams,
+                'precision': precision,
+            }, output_filenames[member])
+        if epoch in save_epochs:
+            if last_checkpoints[member] is not None:
+                checkpoint_writer.save(last_checkpoints[member], epoch_output_filename(epoch, member), snapshot=False)
+            else:
+                checkpoint_writer.copy(output_filenames[member], epoch_output_filename(epoch, member))
+    if write_resume_checkpoint:
+        # so the resume file never points past the checkpoints on disk
+        checkpoint_writer.flush()
+        checkpoint_writer.save({
             'epoch': epoch,
-            'model_state_dict': model.state_dict(),
+            'start_epoch': start_epoch,
+            'model_state_dict': unwrapped_model.state_dict(),
             'optimizer_state_dict': optimizer.state_dict(),
-            #'scheduler_state_dict': scheduler.state_dict(),
+            'scaler_state_dict': scaler.state_dict(),
             'train_losses': avg_train_losses,
             'val_losses': avg_val_losses,
-            'profiles': profiles,
-            'parameters': parameters,
-            'calculations': calculations,
-            'actuators': actuators,
-            'model_hyperparams': model_hyperparams,
-        }, output_filename)
-    if epoch in save_epochs:
-        shutil.copyfile(output_filename, epoch_output_filename(epoch))
+            'rng_states': rng_states,
+        }, resume_filename)
     prev_time=time.time()
 
+checkpoint_writer.close()
 print(f'...took {(time.time()-start_time)/60:0.2f}min')
+if distributed:
+    dist.destroy_process_group()
@@ -2,12 +2,17 @@ import os
 import configparser
 import shutil
 
-def launch_ensemble(baseconfig_filename='model.cfg',submit_runs=False,n_models=1,hyperparam_adjustments=[{}]):
+# num_processes>1 trains each model with DistributedDataParallel over that many processes on the node
+def launch_ensemble(baseconfig_filename='model.cfg',submit_runs=False,n_models=1,hyperparam_adjustments=[{}],num_processes=1):
     if n_models==1:
         ensemble_labels=['']
     else:
         ensemble_labels=[str(i) for i in range(n_models)]
     root_dir=os.path.dirname(os.path.realpath(__file__))
+    if num_processes>1:
+        train_command=f'torchrun --standalone --nproc_per_node={num_processes} ian_train.py'
+    else:
+        train_command='python -u ian_train.py'
     config=configparser.ConfigParser()
     config.read(baseconfig_filename)
     for hyperparam_adjustment in hyperparam_adjustments:
@@ -49,7 +54,7 @@ root_dir={root_dir}
 module load anaconda3/2022.5
 conda activate torch
 cd $root_dir
-python -u ian_train.py {config_filename}
+{train_command} {config_filename}
 
 exit'''
             slurm_filename=os.path.join(output_dir,f'{output_filename_base}job{ensemble_label}.slurm')
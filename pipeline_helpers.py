@@ -0,0 +1,244 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import shutil
+import numpy as np
+
+# For multi-step analyses (e.g. NEWmodelRollout: read sims -> preprocess data -> ML predictions
+# -> blends -> metrics) where each step is expensive and usually unchanged between runs.
+# Each stage has parameters and the stages it depends on; its signature is a hash of its
+# parameters and its dependencies' signatures, so changing anything upstream changes it.
+# Parameters should include fingerprints of whatever the stage reads besides its dependencies
+# (get_file_fingerprint for big data files, get_file_hash for configs and checkpoints,
+# get_code_version for the code it runs) so that changing those also changes the signature.
+# A stage's result is saved either
+#  - in a StageCache, under its signature (content-addressed, so a changed input just gives a new entry), or
+#  - at an explicit filename next to its signature (filename+'.signature')
+# and later runs load it instead of recomputing if there is one for the current signature.
+# Stages that are cheaper to compute together (e.g. several models rolled out over the same data)
+# can be put in a batch: when one is needed, all of the batch's out of date stages are computed by
+# one call, but each is still saved and loaded separately.
+
+def get_signature(params):
+    return hashlib.sha256(repr(params).encode()).hexdigest()
+
+# identifies a big file (e.g. raw h5 data) by path, size and modification time without reading it
+def get_file_fingerprint(filename):
+    if not os.path.exists(filename):
+        return None
+    stat=os.stat(filename)
+    return (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+file_hashes={}
+# hash of a file's contents, only reread when its fingerprint changes
+def get_file_hash(filename):
+    fingerprint=get_file_fingerprint(filename)
+    if fingerprint is None:
+        return None
+    if fingerprint not in file_hashes:
+        sha=hashlib.sha256()
+        with open(filename,'rb') as f:
+            for chunk in iter(lambda: f.read(1<<24), b''):
+                sha.update(chunk)
+        file_hashes[fingerprint]=sha.hexdigest()
+    return file_hashes[fingerprint]
+
+# hash of the source of the given functions/classes/modules
+def get_code_version(*code):
+    return get_signature([inspect.getsource(item) for item in code])
+
+def save_pickle(result, filename):
+    with open(filename,'wb') as f:
+        pickle.dump(result,f)
+
+def load_pickle(filename):
+    with open(filename,'rb') as f:
+        return pickle.load(f)
+
+# dict of arrays as a directory of .npy files, which load_arrays memory-maps so only
+# what is used gets read
+def save_arrays(result, dirname):
+    os.makedirs(dirname)
+    for key,value in result.items():
+        np.save(os.path.join(dirname, f'{key}.npy'), np.asarray(value))
+
+def load_arrays(dirname):
+    return {os.path.splitext(name)[0]: np.load(os.path.join(dirname, name), mmap_mode='r')
+            for name in sorted(os.listdir(dirname)) if name.endswith('.npy')}
+
+# bytes taken by a file, or all the files in a directory
+def get_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root,_,names in os.walk(path) for name in names)
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+# filename to write to before moving it into place, keeping the extension (np.savez adds .npz otherwise)
+def get_temporary_filename(filename):
+    root,extension=os.path.splitext(filename)
+    return f'{root}.tmp{os.getpid()}{extension}'
+
+# content-addressed store for stage results: each one is a file (or directory) named by the stage's signature
+# entries are touched when used, and the least recently used are deleted once the directory
+# holds more than max_size bytes (None to never evict)
+class StageCache:
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir=cache_dir
+        self.max_size=max_size
+        os.makedirs(cache_dir, exist_ok=True)
+    def get_filename(self, signature, suffix=''):
+        return os.path.join(self.cache_dir, f'{signature}{suffix}')
+    def touch(self, filename):
+        os.utime(filename)
+    # keep is the entries that are in use, which are never evicted
+    def evict(self, keep=[]):
+        if self.max_size is None:
+            return []
+        keep=[os.path.abspath(filename) for filename in keep]
+        entries=[]
+        for entry in os.scandir(self.cache_dir):
+            if '.tmp' not in entry.name:
+                entries.append((entry.stat().st_mtime_ns, get_size(entry.path), entry.path))
+        total_size=sum(size for _,size,_ in entries)
+        evicted=[]
+        for _,size,filename in sorted(entries):
+            if total_size<=self.max_size:
+                break
+            if os.path.abspath(filename) in keep:
+                continue
+            remove(filename)
+            total_size-=size
+            evicted.append(filename)
+        return evicted
+
+class StagePipeline:
+    def __init__(self, cache=None):
+        self.cache=cache
+        self.stages={}
+        self.batches={}
+        self.results={}
+    # run(*dependency results) gives the stage's result; params is anything whose repr
+    # identifies the stage's settings and inputs (usually the keyword arguments run was built with)
+    # the result goes to filename if given, otherwise the cache (with suffix), otherwise isn't saved
+    # save=None means run(*dependency results, filename=...) writes the file (or directory) itself,
+    # and load=None that the result is just the filename
+    # stages in a batch (see add_batch) are computed by the batch's run instead, with batch_key
+    # telling it which result to give
+    def add_stage(self, name, run, params=None, dependencies=[], filename=None, suffix='.pkl',
+                  save=save_pickle, load=load_pickle, batch=None, batch_key=None):
+        if name in self.stages:
+            raise ValueError(f'Stage {name} was already added')
+        # dependencies have to be added first, so there can't be cycles
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                raise ValueError(f'Stage {name} depends on {dependency}, which has not been added')
+        if batch is not None:
+            if batch not in self.batches:
+                raise ValueError(f'Stage {name} is in batch {batch}, which has not been added')
+            if save is None:
+                raise ValueError(f'Stage {name} is in batch {batch}, so has to return its result')
+            for other in self.batches[batch]['stages']:
+                if self.stages[other]['dependencies']!=list(dependencies):
+                    raise ValueError(f'Stage {name} has different dependencies from {other} in batch {batch}')
+            self.batches[batch]['stages'].append(name)
+        self.stages[name]={'run': run, 'params': params, 'dependencies': list(dependencies),
+                           'filename': filename, 'suffix': suffix, 'save': save, 'load': load,
+                           'batch': batch, 'batch_key': batch_key}
+    # run(*dependency results, keys=[...]) gives the results of the batch's stages with those batch_keys
+    def add_batch(self, batch, run):
+        if batch in self.batches:
+            raise ValueError(f'Batch {batch} was already added')
+        self.batches[batch]={'run': run, 'stages': []}
+    def get_signature(self, name):
+        stage=self.stages[name]
+        return get_signature((name, stage['params'],
+                              [self.get_signature(dependency) for dependency in stage['dependencies']]))
+    def get_filename(self, name):
+        stage=self.stages[name]
+        if stage['filename'] is not None:
+            return stage['filename']
+        if self.cache is not None:
+            return self.cache.get_filename(self.get_signature(name), stage['suffix'])
+        return None
+    def is_current(self, name):
+        filename=self.get_filename(name)
+        if filename is None or not os.path.exists(filename):
+            return False
+        if self.stages[name]['filename'] is None:
+            # named by its signature
+            return True
+        if not os.path.exists(f'{filename}.signature'):
+            return False
+        with open(f'{filename}.signature') as f:
+            return f.read()==self.get_signature(name)
+    # stages that getting name would (re)compute, dependencies first
+    def plan(self, name, planned=None):
+        if planned is None:
+            planned=[]
+        if name in self.results or name in planned or self.is_current(name):
+            return planned
+        for dependency in self.stages[name]['dependencies']:
+            self.plan(dependency, planned)
+        planned.append(name)
+        return planned
+    # run(**kwargs) gives name's result (kwargs being filename=... for save=None stages), which is saved if it has a filename
+    def compute(self, name, run):
+        stage=self.stages[name]
+        filename=self.get_filename(name)
+        if filename is not None and os.path.exists(f'{filename}.signature'):
+            os.remove(f'{filename}.signature')
+        if filename is None:
+            result=run()
+        else:
+            # written under a temporary name and moved into place, so an interrupted
+            # stage never leaves a file that looks finished
+            tmp_filename=get_temporary_filename(filename)
+            if os.path.exists(tmp_filename):
+                remove(tmp_filename)
+            if stage['save'] is None:
+                run(filename=tmp_filename)
+            else:
+                result=run()
+                stage['save'](result, tmp_filename)
+            # a directory can only replace an empty one
+            if os.path.isdir(filename):
+                remove(filename)
+            os.replace(tmp_filename, filename)
+            if stage['filename'] is not None:
+                with open(f'{filename}.signature','w') as f:
+                    f.write(self.get_signature(name))
+            if stage['save'] is None:
+                # same as when it's loaded later
+                result=stage['load'](filename) if stage['load'] is not None else filename
+        self.results[name]=result
+    def get(self, name):
+        if name not in self.results:
+            stage=self.stages[name]
+            filename=self.get_filename(name)
+            if self.is_current(name):
+                print(f'{name}: up to date, loading {filename}')
+                self.results[name]=stage['load'](filename) if stage['load'] is not None else filename
+            elif stage['batch'] is None:
+                print(f'{name}: computing')
+                dependency_results=[self.get(dependency) for dependency in stage['dependencies']]
+                self.compute(name, functools.partial(stage['run'], *dependency_results))
+            else:
+                batch=self.batches[stage['batch']]
+                names=[other for other in batch['stages'] if other not in self.results and not self.is_current(other)]
+                print(f'{", ".join(names)}: computing together')
+                dependency_results=[self.get(dependency) for dependency in stage['dependencies']]
+                batch_results=batch['run'](*dependency_results, keys=[self.stages[other]['batch_key'] for other in names])
+                for other,result in zip(names,batch_results):
+                    self.compute(other, lambda result=result: result)
+            if self.cache is not None and stage['filename'] is None and filename is not None:
+                self.cache.touch(filename)
+                self.cache.evict(keep=[self.get_filename(used_name) for used_name in self.results
+                                       if self.stages[used_name]['filename'] is None])
+        return self.results[name]
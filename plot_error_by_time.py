@@ -5,6 +5,7 @@ import plotting_helpers
 import pickle
 from dataSettings import nx, DT
 from plotting_helpers import label_map
+from evaluation_helpers import get_median_and_iqr
 
 min_step=0
 max_step=20
@@ -50,15 +51,8 @@ for file_index,pickle_filename in enumerate(['rollout_noECHwithSim.pkl', 'rollou
         fig,axes=plt.subplots(len(profiles+parameters),sharex=True)
     axes=np.atleast_1d(axes)
     for i,sig in enumerate(profiles+parameters):
-        errors_for_plot=[]
-        mean_error=[]
-        std_error=[]
-        for step_ind in range(num_steps):
-            error=errors[sig][:,step_ind]
-            error=error[~np.isnan(error)]
-            errors_for_plot.append(error)
-            mean_error.append(np.median(error))
-            std_error.append(np.subtract(*np.percentile(error, [75, 25])))
+        # median and IQR over samples at each step
+        mean_error,std_error=get_median_and_iqr(errors[sig], axis=0)
         #axes[i].boxplot(errors_for_plot)
         axes[i].errorbar([int((min_step+step_ind+1)*DT*1e3) for step_ind in range(num_steps)],
                          mean_error, std_error,
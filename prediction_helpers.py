@@ -5,17 +5,76 @@ import dataSettings
 import numpy as np
 import os
 from train_helpers import make_bucket
-from torch.nn.utils.rnn import pad_sequence, unpad_sequence
+from torch.nn.utils.rnn import pad_sequence
 import re
 import glob
-from customModels import IanRNN, IanMLP, HiroLRAN
+from customModels import IanRNN, IanMLP, HiroLRAN, EnsembleIanRNN
 from dataSettings import get_denormalized_dic,normalizations
-from customDatasetMakers import state_to_dic, dic_to_state
+from customDatasetMakers import state_to_dic, dic_to_state, get_state_indices_dic
 import time
+import warnings
+import functools
 
 models={'IanRNN': IanRNN, 'IanMLP': IanMLP, 'HiroLRAN': HiroLRAN}
 
-MAX_NUMBER_OF_TIMES=300
+# width of result arrays: prediction_length, or if that's negative (keep everything)
+# the longest sample's max_length, rather than a fixed maximum number of times
+def get_num_result_times(max_length, prediction_length):
+    if prediction_length<0:
+        return max(max_length,0)
+    return prediction_length
+
+# packs (shot, time in ms) pairs into single int64 keys, which sort by shot then time
+def get_shot_time_keys(shots, times):
+    return np.asarray(shots, dtype=np.int64)*(1<<32)+(np.asarray(times, dtype=np.int64)+(1<<31))
+
+def split_shot_time_keys(keys):
+    return keys//(1<<32), keys%(1<<32)-(1<<31)
+
+# for several datasets' (shots, times), the (shot, time) pairs shared by all of them (sorted by
+# shot then time) and for each dataset the indices of those pairs (first one if repeated)
+def get_shared_shot_time_indices(all_shots, all_times):
+    unique_keys=[]
+    first_indices=[]
+    for shots,times in zip(all_shots,all_times):
+        keys,indices=np.unique(get_shot_time_keys(shots,times), return_index=True)
+        unique_keys.append(keys)
+        first_indices.append(indices)
+    shared_keys=functools.reduce(lambda first,second: np.intersect1d(first,second,assume_unique=True), unique_keys)
+    shared_indices=[indices[np.searchsorted(keys,shared_keys)] for keys,indices in zip(unique_keys,first_indices)]
+    shots,times=split_shot_time_keys(shared_keys)
+    return shots, times, shared_indices
+
+# variable-length samples kept as one flat array plus offsets, sample i being values[offsets[i]:offsets[i+1]]
+# (ragged along the first axis of each sample), so memory scales with the data rather than a max length
+class RaggedArray:
+    def __init__(self, values, offsets):
+        self.values=values
+        self.offsets=np.asarray(offsets, dtype=int)
+    # trailing_shape is only needed if arrays can be empty
+    @classmethod
+    def from_list(cls, arrays, trailing_shape=None):
+        if len(arrays)==0:
+            return cls(np.zeros((0,)+tuple(trailing_shape)), [0])
+        offsets=np.insert(np.cumsum([len(arr) for arr in arrays]),0,0)
+        return cls(np.concatenate(arrays, axis=0), offsets)
+    def __len__(self):
+        return len(self.offsets)-1
+    def __getitem__(self, sample_ind):
+        return self.values[self.offsets[sample_ind]:self.offsets[sample_ind+1]]
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+    # (nsamples, length, ...) with samples cut or padded with fill_value to length, defaulting to the longest
+    def to_padded(self, length=None, fill_value=np.nan):
+        lengths=self.lengths
+        if length is None:
+            length=max(lengths, default=0)
+        padded=np.full((len(self),length)+self.values.shape[1:], fill_value, dtype=np.result_type(self.values, fill_value))
+        times=np.arange(length)
+        mask=times[None,:] < lengths[:,None]
+        padded[mask]=self.values[(self.offsets[:-1,None]+times[None,:])[mask]]
+        return padded
 
 ### recall x_test is the in_samples from customDatasetMakers.ian_dataset, y_test is the out_samples. 
 ### x_test contains normalized rofiles at t and actuators at t and t+1, y_test contains normalized profiles at t+1
@@ -27,9 +86,9 @@ def get_ml_truth(y_test,
                  prediction_length=-1, nwarmup=0, use_fancy_normalization=False):
     num_samples=len(y_test)
     num_profiles=len(profiles)
-    # just make this bigger than you think it needs to be
-    y=np.ones((num_samples,num_profiles,MAX_NUMBER_OF_TIMES,dataSettings.nx))*np.nan
-    y_params = np.ones((num_samples, len(parameters), MAX_NUMBER_OF_TIMES))*np.nan
+    num_result_times=get_num_result_times(max([len(arr) for arr in y_test], default=0)-nwarmup, prediction_length)
+    y=np.ones((num_samples,num_profiles,num_result_times,dataSettings.nx))*np.nan
+    y_params = np.ones((num_samples, len(parameters), num_result_times))*np.nan
     for sample_ind in range(num_samples):
         output_dic=state_to_dic(y_test[sample_ind], profiles, parameters)
         #### get input stuff (profile warmup and actuator trajectories
@@ -41,12 +100,12 @@ def get_ml_truth(y_test,
         ####
         denormed_dic=get_denormalized_dic(output_dic, use_fancy_normalization=use_fancy_normalization)
         for profile_ind,profile in enumerate(profiles):
-            num_times=len(denormed_dic[profile][nwarmup:])
-            y[sample_ind,profile_ind,:num_times]=denormed_dic[profile][nwarmup:]
+            num_times=len(denormed_dic[profile][nwarmup:nwarmup+num_result_times])
+            y[sample_ind,profile_ind,:num_times]=denormed_dic[profile][nwarmup:nwarmup+num_result_times]
         for param_ind,param in enumerate(parameters):
-            num_times=len(denormed_dic[param][nwarmup:])
-            y_params[sample_ind,param_ind,:num_times]=denormed_dic[param][nwarmup:]
-    return y[:,:,:prediction_length], y_params[:,:,:prediction_length]
+            num_times=len(denormed_dic[param][nwarmup:nwarmup+num_result_times])
+            y_params[sample_ind,param_ind,:num_times]=denormed_dic[param][nwarmup:nwarmup+num_result_times]
+    return y, y_params
 
 # get the profiles for warmup times from x_test
 def get_ml_profile_warmup(x_test,
@@ -73,17 +132,91 @@ def get_ml_actuator_trajectory(x_test,
                                nwarmup=0, 
                                use_fancy_normalization=False):
     num_samples=len(x_test)
-    actuator_trajectory=np.ones((num_samples,len(actuators),MAX_NUMBER_OF_TIMES))*np.nan
+    # each sample gives its actuators at every time plus the one after the last
+    num_result_times=get_num_result_times(max([len(arr) for arr in x_test], default=0)+1, prediction_length+nwarmup+1)
+    actuator_trajectory=np.ones((num_samples,len(actuators),num_result_times))*np.nan
     for sample_ind in range(num_samples):
         output_dic=state_to_dic(x_test[sample_ind], profiles, parameters, calculations, actuators)
         denormed_dic=get_denormalized_dic(output_dic, use_fancy_normalization=use_fancy_normalization)
         for actuator_ind,actuator in enumerate(actuators):
-            num_times=len(denormed_dic[actuator])
-            actuator_trajectory[sample_ind,actuator_ind,:num_times]=denormed_dic[actuator][:,0]
-            actuator_trajectory[sample_ind,actuator_ind,num_times]=denormed_dic[actuator][-1,1]
-    return actuator_trajectory[:,:,:prediction_length+nwarmup+1]
+            trajectory=np.append(denormed_dic[actuator][:,0], denormed_dic[actuator][-1,1])[:num_result_times]
+            actuator_trajectory[sample_ind,actuator_ind,:len(trajectory)]=trajectory
+    return actuator_trajectory
+
+# running mean and variance over ensemble members, merged a batch of members at a time
+# (Chan et al.'s parallel form of Welford's algorithm) so only two buffers are ever kept
+# the first axis is the sample, and each sample keeps its own count
+class RunningMoments:
+    def __init__(self, shape):
+        self.count=np.zeros(shape[0], dtype=int)
+        self.mean=np.ones(shape)*np.nan
+        self.m2=np.ones(shape)*np.nan
+    # values is (nmembers, ...) for the sample(s) index[0], merged in at index
+    def update(self, values, index):
+        values=np.asarray(values, dtype=float)
+        batch_count=len(values)
+        batch_mean=np.mean(values, axis=0)
+        batch_m2=np.sum((values-batch_mean)**2, axis=0)
+        count=np.asarray(self.count[index[0]])
+        count=count.reshape(count.shape+(1,)*(batch_mean.ndim-count.ndim))
+        total=count+batch_count
+        delta=batch_mean-self.mean[index]
+        self.mean[index]=np.where(count==0, batch_mean, self.mean[index]+delta*batch_count/total)
+        self.m2[index]=np.where(count==0, batch_m2, self.m2[index]+batch_m2+delta**2*count*batch_count/total)
+        self.count[index[0]]+=batch_count
+    # population variance (like np.var), nan where nothing was recorded
+    def variance(self):
+        count=self.count.reshape((-1,)+(1,)*(self.mean.ndim-1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.m2/count
+    def std(self):
+        return np.sqrt(self.variance())
+
+# denormalized signals from model outputs (..., ntimes, nstates), whose model inputs input_state
+# (ntimes, ninputs) or (nsamples, ntimes, ninputs) are needed for the fancy normalization
+# padding can denormalize to inf (e.g. 1/qpsi), which is left to the caller to mask
+def get_denormalized_output_dic(output, input_state,
+                                profiles, parameters, calculations, actuators,
+                                use_fancy_normalization=False):
+    output_dic=state_to_dic(output, profiles, parameters)
+    if use_fancy_normalization:
+        input_dic=state_to_dic(input_state, profiles, parameters, calculations, actuators)
+        for actuator in actuators:
+            output_dic[actuator]=np.broadcast_to(input_dic[actuator][...,-1], np.shape(output)[:-1])
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        return get_denormalized_dic(output_dic, use_fancy_normalization=use_fancy_normalization)
+
+# pads each bucket of samples (see make_bucket) as it's needed, with the samples' lengths
+def pad_buckets(x_buckets, y_buckets):
+    for x_bucket,y_bucket in zip(x_buckets,y_buckets):
+        yield pad_sequence(x_bucket, batch_first=True), pad_sequence(y_bucket, batch_first=True), [len(arr) for arr in x_bucket]
+
+# where a model's state columns are in a state with more signals (signals and superset_signals are dicts
+# of profiles/parameters/calculations/actuators lists, ordered like get_state_indices_dic), as a slice
+# when they're contiguous so that selecting them is a view, otherwise as an index tensor
+def get_column_selection(signals, superset_signals):
+    indices=get_state_indices_dic(*[superset_signals.get(key,[]) for key in ['profiles','parameters','calculations','actuators']])
+    columns=[]
+    for profile in signals.get('profiles',[]):
+        columns.extend(indices[profile])
+    for parameter in signals.get('parameters',[]):
+        columns.append(indices[parameter])
+    for calculation in signals.get('calculations',[]):
+        columns.extend(indices[calculation])
+    for time_index in [0,1]:
+        for actuator in signals.get('actuators',[]):
+            columns.append(indices[actuator][time_index])
+    if len(columns)==0 or columns==list(range(columns[0],columns[0]+len(columns))):
+        start=columns[0] if len(columns)>0 else 0
+        return slice(start,start+len(columns))
+    return torch.tensor(columns)
 
 # given an x_test, y_test, and a model, outputs the predictions for prediction_length, excluding nwarmup
+# with return_uncertainty also returns a dictionary with the spread over ensemble members in
+# physical units ('profiles_std', 'parameters_std', like np.std over each member's denormalized
+# predictions), plus 'profiles_quantiles' and 'parameters_quantiles' (quantile axis first) if quantiles are given
+# padded_buckets (a list of pad_buckets' (padded x, padded y, lengths)) are used instead of bucketing x_test/y_test, and
+# input_columns/output_columns (from get_column_selection) pick the model's state out of them
 def get_ml_predictions(x_test, y_test,
                 profiles, parameters, calculations, actuators,
                 considered_models,
@@ -92,60 +225,119 @@ def get_ml_predictions(x_test, y_test,
                 recorded_parameters=[],
                 prediction_length=20,nwarmup=0,
                 use_fancy_normalization=False,
-                bucket_size=10000):
-    test_x_buckets = make_bucket(x_test, bucket_size)
-    test_y_buckets = make_bucket(y_test, bucket_size)
-    test_length_buckets = [[len(arr) for arr in bucket] for bucket in test_x_buckets]
-    num_keys=len(x_test)
+                bucket_size=10000,
+                return_uncertainty=False,
+                quantiles=None,
+                padded_buckets=None,
+                input_columns=slice(None),
+                output_columns=slice(None)):
+    if padded_buckets is None:
+        test_x_buckets = make_bucket(x_test, bucket_size)
+        test_y_buckets = make_bucket(y_test, bucket_size)
+        test_length_buckets = [[len(arr) for arr in bucket] for bucket in test_x_buckets]
+        padded_buckets = pad_buckets(test_x_buckets, test_y_buckets)
+    else:
+        test_length_buckets = [lengths for _,_,lengths in padded_buckets]
+    num_keys=sum(len(lengths) for lengths in test_length_buckets)
     num_profiles=len(recorded_profiles)
     num_parameters=len(recorded_parameters)
-    yhat=np.ones((num_keys,num_profiles,MAX_NUMBER_OF_TIMES,dataSettings.nx))*np.nan
-    yhat_parameters = np.ones((num_keys, num_parameters, MAX_NUMBER_OF_TIMES))*np.nan
+    num_result_times=get_num_result_times(max([max(lengths) for lengths in test_length_buckets], default=0)-nwarmup, prediction_length)
+    yhat=np.ones((num_keys,num_profiles,num_result_times,dataSettings.nx))*np.nan
+    yhat_parameters = np.ones((num_keys, num_parameters, num_result_times))*np.nan
+    if return_uncertainty:
+        profile_moments=RunningMoments(yhat.shape)
+        parameter_moments=RunningMoments(yhat_parameters.shape)
+        if quantiles is not None:
+            profile_quantiles=np.ones((len(quantiles),)+yhat.shape)*np.nan
+            parameter_quantiles=np.ones((len(quantiles),)+yhat_parameters.shape)*np.nan
+    # denormalize a whole padded bucket of outputs (..., nsamples, ntimes, nstates) at once and pick out
+    # the recorded profiles (..., nsamples, nprofiles, ntimes-nwarmup, nx) and parameters, nan past each length
+    def get_recorded_values(outputs, padded_x, lengths):
+        denormed_dic=get_denormalized_output_dic(outputs, padded_x,
+                                                 profiles, parameters, calculations, actuators,
+                                                 use_fancy_normalization=use_fancy_normalization)
+        num_times=min(max(outputs.shape[-2]-nwarmup,0), num_result_times)
+        valid_times=np.arange(num_times)[None,:] < (np.array(lengths)-nwarmup)[:,None]
+        profile_values=np.stack([denormed_dic[sig][...,nwarmup:nwarmup+num_times,:] for sig in recorded_profiles], axis=-3) \
+            if num_profiles>0 else np.zeros(outputs.shape[:-2]+(0,num_times,dataSettings.nx))
+        parameter_values=np.stack([denormed_dic[sig][...,nwarmup:nwarmup+num_times] for sig in recorded_parameters], axis=-2) \
+            if num_parameters>0 else np.zeros(outputs.shape[:-2]+(0,num_times))
+        profile_values=np.where(valid_times[:,None,:,None], profile_values, np.nan)
+        parameter_values=np.where(valid_times[:,None,:], parameter_values, np.nan)
+        return profile_values, parameter_values
+    # member_outputs is (nmembers, nsamples, ntimes, nstates) for the samples starting at first_sample_ind
+    def record_members(member_outputs, padded_x, first_sample_ind, lengths):
+        profile_values,parameter_values=get_recorded_values(np.array(member_outputs), padded_x, lengths)
+        samples=slice(first_sample_ind, first_sample_ind+len(lengths))
+        profile_index=(samples, slice(None), slice(0,profile_values.shape[-2]))
+        parameter_index=(samples, slice(None), slice(0,parameter_values.shape[-1]))
+        profile_moments.update(profile_values, profile_index)
+        parameter_moments.update(parameter_values, parameter_index)
+        if quantiles is not None:
+            with warnings.catch_warnings():
+                # all-nan slices past the end of each sample
+                warnings.simplefilter('ignore', RuntimeWarning)
+                profile_quantiles[(slice(None),)+profile_index]=np.nanquantile(profile_values, quantiles, axis=0)
+                parameter_quantiles[(slice(None),)+parameter_index]=np.nanquantile(parameter_values, quantiles, axis=0)
     begin_time=time.time()
     prev_time=begin_time
     evaluation_begin_time=time.time()
     prev_time=evaluation_begin_time
+    # run all members of an IanRNN ensemble in one batched rollout, other mixes of models
+    # (including IanRNNs with different hyperparameters) go through them one at a time
+    ensemble=None
+    if len(considered_models)>1 and EnsembleIanRNN.can_stack(considered_models):
+        ensemble=EnsembleIanRNN.from_members(considered_models)
     with torch.no_grad():
         sample_ind=0
-        for which_bucket in range(len(test_x_buckets)):
-            x_bucket=test_x_buckets[which_bucket]
-            y_bucket=test_y_buckets[which_bucket]
-            length_bucket=torch.tensor(test_length_buckets[which_bucket])
-            padded_x=pad_sequence(x_bucket, batch_first=True)
-            padded_y=pad_sequence(y_bucket, batch_first=True)
+        for which_bucket,(padded_x,padded_y,_) in enumerate(padded_buckets):
+            padded_x=padded_x[...,input_columns]
+            padded_y=padded_y[...,output_columns]
             #padded_x=padded_x.to(device)
             #padded_y=padded_y.to(device)
             # only save simulations after warmup is over
             # see note above, taking out ability to ensemble models
             # since the ethos should be considering different ML and sim
             # models on equal footing
-            model_output=torch.zeros_like(padded_y)
-            for model in considered_models:
-                #model=considered_models[0]
-                model_output+=model(padded_x, reset_probability=0, nwarmup=nwarmup)
-            model_output/=len(considered_models)
-            unpadded_output=unpad_sequence(model_output, length_bucket, batch_first=True)
-            for which_output,output in enumerate(unpadded_output):
-                output_dic=state_to_dic(output, profiles, parameters)
-                #### get input stuff (profile warmup and actuator trajectories
-                # only needed for 
-                input_dic=state_to_dic(x_test[sample_ind], profiles, parameters, calculations, actuators)
-                if use_fancy_normalization:
-                    for actuator in actuators:
-                        output_dic[actuator]=input_dic[actuator][:,-1]
-                ####
-                denormed_dic=get_denormalized_dic(output_dic, use_fancy_normalization=use_fancy_normalization)
-                for profile_ind,profile in enumerate(recorded_profiles):
-                    num_times=len(denormed_dic[profile][nwarmup:])
-                    yhat[sample_ind,profile_ind,:num_times]=denormed_dic[profile][nwarmup:]
-                for parameter_ind, parameter in enumerate(recorded_parameters):
-                    num_times=len(denormed_dic[parameter][nwarmup:])
-                    yhat_parameters[sample_ind,parameter_ind,:num_times]=denormed_dic[parameter][nwarmup:]
-                sample_ind+=1
-            print(f'Bucket {which_bucket+1}/{len(test_x_buckets)} took {time.time()-prev_time:0.0f}s')
+            if ensemble is not None:
+                # members are only handed back when their spread is recorded
+                ensemble_outputs=ensemble.predict(padded_x, reset_probability=0, nwarmup=nwarmup, return_members=return_uncertainty)
+                model_output=ensemble_outputs[0]
+                if return_uncertainty:
+                    record_members(ensemble_outputs[2], padded_x, sample_ind, test_length_buckets[which_bucket])
+            else:
+                model_output=torch.zeros_like(padded_y)
+                all_member_outputs=[]
+                for model in considered_models:
+                    #model=considered_models[0]
+                    this_output=model(padded_x, reset_probability=0, nwarmup=nwarmup)
+                    model_output+=this_output
+                    # quantiles need all members at once, otherwise stream them into the moments
+                    if return_uncertainty and quantiles is not None:
+                        all_member_outputs.append(this_output)
+                    elif return_uncertainty:
+                        record_members(this_output.unsqueeze(0), padded_x, sample_ind, test_length_buckets[which_bucket])
+                model_output/=len(considered_models)
+                if len(all_member_outputs)>0:
+                    record_members(torch.stack(all_member_outputs), padded_x, sample_ind, test_length_buckets[which_bucket])
+            # buckets hold consecutive samples, so the whole bucket is written in one go
+            profile_values,parameter_values=get_recorded_values(np.array(model_output), padded_x, test_length_buckets[which_bucket])
+            bucket_samples=slice(sample_ind, sample_ind+len(test_length_buckets[which_bucket]))
+            yhat[bucket_samples,:,:profile_values.shape[-2]]=profile_values
+            yhat_parameters[bucket_samples,:,:parameter_values.shape[-1]]=parameter_values
+            sample_ind+=len(test_length_buckets[which_bucket])
+            print(f'Bucket {which_bucket+1}/{len(test_length_buckets)} took {time.time()-prev_time:0.0f}s')
             prev_time=time.time()
     print(f'Took {time.time()-begin_time:.2f} s')
-    return yhat[:,:,:prediction_length], yhat_parameters[:,:,:prediction_length]
+    if return_uncertainty:
+        uncertainty={'profiles_std': profile_moments.std(),
+                     'parameters_std': parameter_moments.std()}
+        if quantiles is not None:
+            uncertainty['quantiles']=quantiles
+            uncertainty['profiles_quantiles']=profile_quantiles
+            uncertainty['parameters_quantiles']=parameter_quantiles
+        return yhat, yhat_parameters, uncertainty
+    return yhat, yhat_parameters
 
 def get_ml_profiles_with_warmup(profiles, warmup_ups):
     return np.concatenate((warmup_ups, profiles), axis=2)
@@ -156,11 +348,49 @@ def get_fast_profile_prediction(x_test_sample, model):
         model_output = model(x_test_sample, reset_probability=1)
     return model_output[:,-1:, :]
 
-def get_considered_models(config_filename, ensemble=True, epoch=None):
+# keeps the model's hidden state between calls so each new timestep costs a single model.step,
+# rather than rerunning the whole history like get_fast_profile_prediction
+# rows must be final when passed in, the output matches get_fast_profile_prediction on the history so far
+class IncrementalPredictor:
+    def __init__(self, model):
+        self.model=model
+        self.hidden=None
+    # run through (nsamples, ntimes, nstates) history whose outputs aren't needed
+    def warmup(self, x_history):
+        for t_ind in range(x_history.size()[1]):
+            self.predict(x_history[:,t_ind,:])
+    # x_t is (nsamples, nstates), returns the normalized prediction for the next timestep as (nsamples, 1, nstates)
+    def predict(self, x_t):
+        with torch.no_grad():
+            output,self.hidden=self.model.step(x_t, self.hidden)
+        return output.unsqueeze(1)
+
+# checkpoint files get_considered_models loads for a config: all the ensemble members'
+# (output_filename_base followed by a number) or just the one model, at epoch if given
+def get_model_files(config_filename, ensemble=True, epoch=None):
     config=configparser.ConfigParser()
     config.read(config_filename)
     output_filename_base=config['model']['output_filename_base']
     output_dir=config['model']['output_dir']
+    epoch_specification=''
+    if epoch is not None:
+        epoch_specification=f'EPOCH{epoch}'
+    if ensemble:
+        regex=f'{output_filename_base}[0-9]*{epoch_specification}.tar'
+        all_model_files=glob.glob(os.path.join(output_dir, regex))
+        # glob is not as powerful, the star is for everything - so whittle down further so it only
+        # accepts repeats of numbers
+        return sorted(model_file for model_file in all_model_files if re.match(regex,os.path.basename(model_file)))
+    return [os.path.join(output_dir, f'{output_filename_base}{epoch_specification}.tar')]
+
+# compile_mode None gives back eager models, 'script' or 'compile' traces or torch.compiles the
+# autoregressive step of the models that have one (see IanRNN.compile_rollout_step), which
+# EnsembleIanRNN.from_members carries over to the stacked ensemble
+def get_considered_models(config_filename, ensemble=True, epoch=None, compile_mode=None):
+    if compile_mode not in [None,'script','compile']:
+        raise ValueError(f"compile_mode must be 'script', 'compile' or None, got '{compile_mode}'")
+    config=configparser.ConfigParser()
+    config.read(config_filename)
     model_type=config['model']['model_type']
     profiles=config['inputs']['profiles'].split()
     actuators=config['inputs']['actuators'].split()
@@ -170,38 +400,19 @@ def get_considered_models(config_filename, ensemble=True, epoch=None):
     actuator_length=len(actuators)
     calculation_length=len(calculations)*dataSettings.nx
     considered_models=[]
-    epoch_specification=''
-    if epoch is not None:
-        epoch_specification=f'EPOCH{epoch}'
-    if ensemble:
-        regex=f'{output_filename_base}[0-9]*{epoch_specification}.tar'
-        all_model_files=glob.glob(os.path.join(output_dir, regex))
-        # glob is not as powerful, the star is for everything - so whittle down further so it only
-        # accepts repeats of numbers
-        all_model_files=[model_file for model_file in all_model_files if re.match(regex,os.path.basename(model_file))]
-        # exclude models under the median loss
-        #losses = []
-        #for model_file in all_model_files:
-        #    saved_state=torch.load(model_file, map_location=torch.device('cpu'))
-        #    losses.append(np.min([saved_state['val_losses'][-i] for i in range(10)]))
-        #max_loss = np.median(losses)
-        for model_file in all_model_files:
-            saved_state=torch.load(model_file, map_location=torch.device('cpu'))
-            if True: #np.min([saved_state['val_losses'][-i] for i in range(10)])<max_loss:
-                model=models[model_type](input_dim=state_length+calculation_length+2*actuator_length, output_dim=state_length,
-                                         **saved_state['model_hyperparams'])
-                model.load_state_dict(saved_state['model_state_dict'])
-                considered_models.append(model)
-        print(f'{len(considered_models)} models used')
-        #print(f'{len(considered_models)}/{len(all_model_files)} models used (i.e. only loss<{max_loss:0.2e})')
-    else:
-        model_file=os.path.join(output_dir, f'{output_filename_base}{epoch_specification}.tar')
+    for model_file in get_model_files(config_filename, ensemble=ensemble, epoch=epoch):
         saved_state=torch.load(model_file, map_location=torch.device('cpu'))
         model=models[model_type](input_dim=state_length+calculation_length+2*actuator_length, output_dim=state_length,
                                  **saved_state['model_hyperparams'])
         model.load_state_dict(saved_state['model_state_dict'])
-        considered_models=[model]
+        considered_models.append(model)
+    if ensemble:
+        print(f'{len(considered_models)} models used')
+    else:
         print(f'Using {model_file}')
+    for model in considered_models:
+        if hasattr(model, 'compile_rollout_step'):
+            model.compile_rollout_step(compile_mode)
     return considered_models
 
 def get_fake_actuator_state(normalized_true_state, profiles, parameters, actuators):
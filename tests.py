@@ -2,10 +2,20 @@ import unittest
 import torch
 import os
 from customDatasetMakers import get_state_indices_dic, state_to_dic, dic_to_state, \
-    preprocess_data
+    preprocess_data, get_chain_bounds, get_batched_chain_bounds
 from dataSettings import get_denormalized_dic, get_normalized_dic
-from customModels import IanRNN, HiroLinear
-from train_helpers import get_state_mask, get_sample_time_state_mask, masked_loss
+from customModels import IanRNN, HiroLinear, HiroLRAN, EnsembleIanRNN, InverseLinear, set_model_precision, get_reset_mask
+from train_helpers import get_state_mask, get_sample_time_state_mask, masked_loss, shard_indices, \
+    get_rng_state, set_rng_state, save_atomic, CheckpointWriter, make_bucket
+from prediction_helpers import IncrementalPredictor, RaggedArray, RunningMoments, get_fast_profile_prediction, \
+    get_shared_shot_time_indices, get_denormalized_output_dic, get_ml_predictions, pad_buckets, get_column_selection
+from pipeline_helpers import StagePipeline, StageCache, save_arrays, load_arrays
+from evaluation_helpers import get_min_prediction_steps, get_all_sigmas, grouped_nanmean, grouped_nanpercentile, \
+    grouped_median_and_iqr
+import dataSettings
+import random
+import tempfile
+import pickle
 import numpy as np
 
 # takes ~90 seconds the first time then faster after (I think h5 unravels itself like DNA / histones)
@@ -245,6 +255,76 @@ class TestTrainHelpers(unittest.TestCase):
                             0,
                             1])
         self.assertTrue(torch.allclose(truth,mask))
+    def test_shard_indices(self):
+        indices=[4,0,3,1,2]
+        shards=[shard_indices(indices, rank, 2) for rank in range(2)]
+        # same number of buckets per rank, wrapping around to pad
+        self.assertEqual(shards, [[4,3,2],[0,1,4]])
+        # every bucket is covered
+        self.assertCountEqual(set(shards[0]+shards[1]), indices)
+        # more ranks than buckets
+        self.assertEqual([shard_indices([1,0], rank, 3) for rank in range(3)], [[1],[0],[1]])
+    def test_resume_state(self):
+        # restoring the RNG state from a saved checkpoint reproduces the same draws
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename=os.path.join(tmp_dir,'resume.tar')
+            save_atomic({'rng_state': get_rng_state()}, filename)
+            self.assertEqual(os.listdir(tmp_dir), ['resume.tar'])
+            first_draws=(torch.rand(3), np.random.rand(3), random.random())
+            set_rng_state(torch.load(filename)['rng_state'])
+            second_draws=(torch.rand(3), np.random.rand(3), random.random())
+        self.assertTrue(torch.equal(first_draws[0],second_draws[0]))
+        self.assertTrue(np.array_equal(first_draws[1],second_draws[1]))
+        self.assertEqual(first_draws[2],second_draws[2])
+    def test_checkpoint_writer(self):
+        # snapshots are taken at submission, so later in-place updates don't leak into the file
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename=os.path.join(tmp_dir,'model.tar')
+            copy_filename=os.path.join(tmp_dir,'modelEPOCH0.tar')
+            weights=torch.zeros(3)
+            losses=[1.]
+            writer=CheckpointWriter()
+            snapshot=writer.save({'weights': weights, 'losses': losses}, filename)
+            weights+=1
+            losses.append(2.)
+            writer.save(snapshot, copy_filename, snapshot=False)
+            writer.close()
+            for saved_filename in [filename, copy_filename]:
+                saved_state=torch.load(saved_filename)
+                self.assertTrue(torch.equal(saved_state['weights'],torch.zeros(3)))
+                self.assertEqual(saved_state['losses'],[1.])
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ['model.tar','modelEPOCH0.tar'])
+    def test_ragged_array(self):
+        # samples keep their own lengths and are only cut/padded when asked
+        arrays=[np.random.rand(length,2) for length in [3,0,5]]
+        ragged=RaggedArray.from_list(arrays)
+        self.assertEqual(list(ragged.lengths),[3,0,5])
+        self.assertTrue(np.array_equal(ragged[2],arrays[2]))
+        padded=ragged.to_padded(4)
+        self.assertEqual(padded.shape,(3,4,2))
+        self.assertTrue(np.array_equal(padded[0,:3],arrays[0]))
+        self.assertTrue(np.isnan(padded[0,3:]).all() and np.isnan(padded[1]).all())
+        self.assertTrue(np.array_equal(padded[2],arrays[2][:4]))
+        self.assertEqual(RaggedArray.from_list([],(2,)).to_padded(4).shape,(0,4,2))
+    def test_shared_shot_times(self):
+        # (shot, time) pairs in both, ordered numerically; the repeated pair uses its first index
+        shots,times,indices=get_shared_shot_time_indices([[200,100,100,100,300],[100,100,200,400]],
+                                                         [[5,1000,-20,1000,5],[1000,-20,5,5]])
+        self.assertEqual(list(zip(shots,times)),[(100,-20),(100,1000),(200,5)])
+        self.assertEqual(list(indices[0]),[2,1,0])
+        self.assertEqual(list(indices[1]),[1,0,2])
+    def test_chain_bounds(self):
+        nan=np.nan
+        array=np.array([nan,1,2,3,nan,nan,4,nan,5,6])
+        starts,ends=get_chain_bounds(array)
+        self.assertEqual(list(zip(starts,ends)),[(1,3),(6,6),(8,9)])
+        # the chain running to the end is kept whatever its length
+        starts,ends=get_chain_bounds(array,min_length=3)
+        self.assertEqual(list(zip(starts,ends)),[(1,3),(8,9)])
+        self.assertEqual(len(get_chain_bounds(np.zeros(0))[0]),0)
+        # chains never run from one array into the next, and each array keeps its last chain
+        array_inds,starts,ends=get_batched_chain_bounds([array,np.ones(2),np.zeros(0),np.array([1,nan,nan])],min_length=3)
+        self.assertEqual(list(zip(array_inds,starts,ends)),[(0,1,3),(0,8,9),(1,0,1)])
     def test_mask(self, use_gpu=True):
         if use_gpu and torch.cuda.is_available():
             device='cuda'
@@ -319,6 +399,223 @@ class TestTrainHelpers(unittest.TestCase):
                          mask)
 
 
+class TestPredictionHelpers(unittest.TestCase):
+    def test_running_moments(self):
+        # merging members in uneven batches gives np.mean/np.std over all of them
+        values=np.random.rand(7,2,5)
+        moments=RunningMoments((3,2,5))
+        for batch in [values[:1],values[1:4],values[4:]]:
+            moments.update(batch, (1,slice(None),slice(None)))
+        self.assertTrue(np.allclose(moments.mean[1],np.mean(values,axis=0)))
+        self.assertTrue(np.allclose(moments.std()[1],np.std(values,axis=0)))
+        self.assertTrue(np.isnan(moments.std()[0]).all())
+    def test_batched_denormalization(self):
+        # whole padded buckets denormalized at once match denormalizing each unpadded sample on its own,
+        # with nan past each sample's length (including where padding denormalizes to inf, e.g. 1/qpsi)
+        torch.manual_seed(0)
+        nx=dataSettings.nx
+        profiles=['zipfit_trotfit_rho','zipfit_edensfit_rho','qpsi_EFIT01']
+        parameters=['volume_EFIT01']
+        actuators=['ip','aminor_EFIT01','rmaxis_EFIT01']
+        nwarmup=2
+        prediction_length=7
+        state_length=len(profiles)*nx+len(parameters)
+        x=[torch.rand(length,state_length+2*len(actuators))+0.5 for length in [10,8,8,5,4]]
+        y=[torch.rand(len(sample),state_length)+0.5 for sample in x]
+        model=IanRNN(input_dim=state_length+2*len(actuators), output_dim=state_length, encoder_dim=4, encoder_extra_layers=0,
+                     rnn_dim=4, rnn_num_layers=1, decoder_dim=4, decoder_extra_layers=0)
+        model.eval()
+        for use_fancy_normalization in [False,True]:
+            yhat,yhat_parameters=get_ml_predictions(x, y, profiles, parameters, [], actuators, [model],
+                                                    recorded_profiles=profiles, recorded_parameters=parameters,
+                                                    prediction_length=prediction_length, nwarmup=nwarmup,
+                                                    use_fancy_normalization=use_fancy_normalization, bucket_size=12)
+            expected=np.ones(yhat.shape)*np.nan
+            expected_parameters=np.ones(yhat_parameters.shape)*np.nan
+            for sample_ind,sample in enumerate(x):
+                with torch.no_grad():
+                    output=model(sample[None], reset_probability=0, nwarmup=nwarmup)[0].numpy()
+                denormed_dic=get_denormalized_output_dic(output, sample.numpy(), profiles, parameters, [], actuators,
+                                                         use_fancy_normalization=use_fancy_normalization)
+                times=slice(nwarmup,nwarmup+prediction_length)
+                num_times=len(sample[times])
+                for profile_ind,profile in enumerate(profiles):
+                    expected[sample_ind,profile_ind,:num_times]=denormed_dic[profile][times]
+                expected_parameters[sample_ind,0,:num_times]=denormed_dic['volume_EFIT01'][times]
+            self.assertTrue(np.isnan(yhat[3,:,3:]).all() and np.isnan(yhat_parameters[4,:,2:]).all())
+            self.assertTrue(np.allclose(yhat, expected, equal_nan=True, rtol=1e-4))
+            self.assertTrue(np.allclose(yhat_parameters, expected_parameters, equal_nan=True, rtol=1e-4))
+    def test_compiled_ensemble_predictions(self):
+        # members with a compiled rollout step are stacked into an ensemble with the same compiled step,
+        # matching the eager models over buckets of different sizes
+        torch.manual_seed(0)
+        nx=dataSettings.nx
+        x=[torch.rand(length,nx+2) for length in [9,7,4,3]]
+        y=[sample[:,:nx] for sample in x]
+        models=[IanRNN(input_dim=nx+2, output_dim=nx, encoder_dim=4, encoder_extra_layers=0, rnn_dim=4, rnn_num_layers=1,
+                       decoder_dim=4, decoder_extra_layers=0).eval() for i in range(2)]
+        kwargs={'recorded_profiles': ['zipfit_itempfit_rho'], 'prediction_length': 5, 'nwarmup': 2, 'bucket_size': 10}
+        yhat,_=get_ml_predictions(x, y, ['zipfit_itempfit_rho'], [], [], ['ip'], models, **kwargs)
+        self.assertFalse(np.isnan(yhat).all())
+        for compile_mode in ['script','compile']:
+            for model in models:
+                model.compile_rollout_step(compile_mode)
+            self.assertEqual(list(EnsembleIanRNN.from_members(models).compiled_steps), [compile_mode])
+            compiled_yhat,_=get_ml_predictions(x, y, ['zipfit_itempfit_rho'], [], [], ['ip'], models, **kwargs)
+            self.assertTrue(np.allclose(yhat, compiled_yhat, equal_nan=True, atol=1e-6))
+    def test_mixed_ensemble_predictions(self):
+        # IanRNNs that can't be stacked (here different hidden sizes) are still averaged one at a time
+        torch.manual_seed(0)
+        nx=dataSettings.nx
+        x=[torch.rand(length,nx+2) for length in [9,7,4]]
+        y=[sample[:,:nx] for sample in x]
+        models=[IanRNN(input_dim=nx+2, output_dim=nx, encoder_dim=4, encoder_extra_layers=0, rnn_dim=rnn_dim, rnn_num_layers=1,
+                       decoder_dim=4, decoder_extra_layers=0).eval() for rnn_dim in [4,6]]
+        self.assertFalse(EnsembleIanRNN.can_stack(models))
+        kwargs={'recorded_profiles': ['zipfit_itempfit_rho'], 'prediction_length': 5, 'nwarmup': 2, 'bucket_size': 10}
+        yhat,_=get_ml_predictions(x, y, ['zipfit_itempfit_rho'], [], [], ['ip'], models, **kwargs)
+        member_yhats=[get_ml_predictions(x, y, ['zipfit_itempfit_rho'], [], [], ['ip'], [model], **kwargs)[0] for model in models]
+        self.assertFalse(np.isnan(yhat).all())
+        self.assertTrue(np.allclose(yhat, np.mean(member_yhats, axis=0), equal_nan=True, rtol=1e-4))
+    def test_shared_buckets(self):
+        # a model rolled out over its columns of buckets padded with more signals matches rolling it out on its own
+        nx=dataSettings.nx
+        profiles=['zipfit_etempfit_rho','zipfit_itempfit_rho']
+        actuators=['pinj','ip']
+        signals=[{sig: torch.rand(length,nx) for sig in profiles} | {sig: torch.rand(length,2) for sig in actuators}
+                 for length in [9,7,7,4]]
+        superset_x=[torch.cat([sample[sig] for sig in profiles]+[sample[sig][:,[time_index]] for time_index in [0,1] for sig in actuators],dim=-1)
+                    for sample in signals]
+        superset_y=[torch.cat([sample[sig] for sig in profiles],dim=-1) for sample in signals]
+        x=[torch.cat([sample['zipfit_itempfit_rho'],sample['ip']],dim=-1) for sample in signals]
+        y=[sample['zipfit_itempfit_rho'] for sample in signals]
+        model=IanRNN(input_dim=nx+2, output_dim=nx, encoder_dim=4, encoder_extra_layers=0, rnn_dim=4, rnn_num_layers=1,
+                     decoder_dim=4, decoder_extra_layers=0)
+        model.eval()
+        kwargs={'recorded_profiles': ['zipfit_itempfit_rho'], 'prediction_length': 5, 'nwarmup': 2, 'bucket_size': 10}
+        yhat,_=get_ml_predictions(x, y, ['zipfit_itempfit_rho'], [], [], ['ip'], [model], **kwargs)
+        superset={'profiles': profiles, 'actuators': actuators}
+        subset={'profiles': ['zipfit_itempfit_rho'], 'actuators': ['ip']}
+        shared_yhat,_=get_ml_predictions(None, None, ['zipfit_itempfit_rho'], [], [], ['ip'], [model],
+                                         padded_buckets=list(pad_buckets(make_bucket(superset_x, 10), make_bucket(superset_y, 10))),
+                                         input_columns=get_column_selection(subset, superset),
+                                         output_columns=get_column_selection({'profiles': subset['profiles']}, {'profiles': profiles}),
+                                         **kwargs)
+        self.assertFalse(np.isnan(yhat).all())
+        self.assertTrue(np.allclose(yhat, shared_yhat, equal_nan=True))
+        # the same inputs are just a slice
+        self.assertEqual(get_column_selection(superset, superset), slice(0,2*nx+4))
+
+class TestEvaluationHelpers(unittest.TestCase):
+    def test_all_sigmas(self):
+        truth=np.ones((2,2,4,3))
+        model_predictions=np.stack([truth*2,truth*0.5])
+        # second sample's last 2 times are missing for one model
+        model_predictions[1,1,0,2:]=np.nan
+        self.assertEqual(list(get_min_prediction_steps(model_predictions,4)),[3,1])
+        all_sigmas=get_all_sigmas(model_predictions,truth,['zipfit_etempfit_rho','qpsi_EFIT01'],4)
+        self.assertEqual(all_sigmas.shape,(2,2,2,4))
+        # q is compared as 1/q
+        self.assertTrue(np.allclose(all_sigmas[0,:,:,:3],[[[100]*3,[50]*3],[[50]*3,[100]*3]]))
+        self.assertTrue(np.isnan(all_sigmas[0,:,:,3:]).all() and np.isnan(all_sigmas[1,:,:,1:]).all())
+    def test_grouped_statistics(self):
+        shots=[3,1,3,2,1,3]
+        values=np.array([[1.,np.nan],[2.,np.nan],[3.,4.],[5.,6.],[6.,np.nan],[8.,np.nan]])
+        unique_shots,means=grouped_nanmean(values,shots)
+        self.assertEqual(list(unique_shots),[1,2,3])
+        self.assertTrue(np.allclose(means,[[4,np.nan],[5,6],[4,4]],equal_nan=True))
+        unique_shots,percentiles=grouped_nanpercentile(values,shots,[0,50,100])
+        self.assertEqual(percentiles.shape,(3,3,2))
+        self.assertTrue(np.allclose(percentiles[:,2,0],[1,3,8]))
+        self.assertTrue(np.isnan(percentiles[:,0,1]).all())
+        unique_shots,medians,iqrs=grouped_median_and_iqr(values,shots)
+        self.assertTrue(np.allclose(medians,percentiles[1],equal_nan=True))
+        self.assertTrue(np.allclose(iqrs[2],[3.5,0]))
+
+class TestPipelineHelpers(unittest.TestCase):
+    def test_stage_pipeline(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            calls=[]
+            def make_pipeline(scale, offset):
+                pipeline=StagePipeline()
+                pipeline.add_stage('data', lambda: calls.append('data') or np.arange(3)*scale, params={'scale': scale},
+                                   filename=os.path.join(tmp_dir,'data.pkl'))
+                pipeline.add_stage('shifted', lambda data: calls.append('shifted') or data+offset, params={'offset': offset},
+                                   dependencies=['data'], filename=os.path.join(tmp_dir,'shifted.pkl'))
+                return pipeline
+            self.assertEqual(make_pipeline(2,1).plan('shifted'),['data','shifted'])
+            self.assertEqual(list(make_pipeline(2,1).get('shifted')),[1,3,5])
+            # nothing changed, so everything is loaded
+            self.assertEqual(make_pipeline(2,1).plan('shifted'),[])
+            self.assertEqual(list(make_pipeline(2,1).get('shifted')),[1,3,5])
+            # only the changed stage reruns, and changes upstream rerun everything after
+            self.assertEqual(list(make_pipeline(2,0).get('shifted')),[0,2,4])
+            self.assertEqual(list(make_pipeline(1,0).get('shifted')),[0,1,2])
+            self.assertEqual(calls,['data','shifted','shifted','data','shifted'])
+            with self.assertRaises(ValueError):
+                make_pipeline(1,0).add_stage('later', lambda later: later, dependencies=['missing'])
+    def test_stage_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            calls=[]
+            used_times=[]
+            # room for two entries
+            cache=StageCache(tmp_dir, max_size=2*len(pickle.dumps(np.arange(3))))
+            def get_data(scale):
+                pipeline=StagePipeline(cache=cache)
+                pipeline.add_stage('data', lambda: calls.append(scale) or np.arange(3)*scale, params={'scale': scale})
+                data=list(pipeline.get('data'))
+                # file times are only so precise, so the order entries were used in is set explicitly
+                used_times.append(len(used_times))
+                os.utime(pipeline.get_filename('data'), ns=(used_times[-1],used_times[-1]))
+                return data
+            self.assertEqual(get_data(1),[0,1,2])
+            self.assertEqual(get_data(2),[0,2,4])
+            # both still cached, each under its own inputs
+            self.assertEqual(get_data(1),[0,1,2])
+            self.assertEqual(calls,[1,2])
+            # the least recently used (scale 2) is evicted to make room
+            self.assertEqual(get_data(3),[0,3,6])
+            self.assertEqual(get_data(1),[0,1,2])
+            self.assertEqual(get_data(2),[0,2,4])
+            self.assertEqual(calls,[1,2,3,2])
+    def test_stage_batch(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            calls=[]
+            def make_pipeline(scales):
+                pipeline=StagePipeline(cache=StageCache(tmp_dir))
+                pipeline.add_stage('data', lambda: np.arange(3), params={})
+                pipeline.add_batch('scaled', lambda data, keys: calls.append(keys) or [data*key for key in keys])
+                for scale in scales:
+                    pipeline.add_stage(f'scaled {scale}', None, params={'scale': scale}, dependencies=['data'],
+                                       batch='scaled', batch_key=scale)
+                return pipeline
+            pipeline=make_pipeline([1,2])
+            self.assertEqual(list(pipeline.get('scaled 2')),[0,2,4])
+            self.assertEqual(list(pipeline.get('scaled 1')),[0,1,2])
+            # only what isn't cached yet is computed, all in one call
+            pipeline=make_pipeline([1,2,3,4])
+            self.assertEqual(list(pipeline.get('scaled 1')),[0,1,2])
+            self.assertEqual(list(pipeline.get('scaled 4')),[0,4,8])
+            self.assertEqual(calls,[[1,2],[3,4]])
+            with self.assertRaises(ValueError):
+                pipeline.add_stage('scaled 5', None, batch='scaled', batch_key=5)
+    def test_array_stage(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache=StageCache(tmp_dir, max_size=0)
+            def get_arrays(scale):
+                pipeline=StagePipeline(cache=cache)
+                pipeline.add_stage('arrays', lambda: {'data': np.arange(3)*scale, 'shots': np.array([1,1,2])},
+                                   params={'scale': scale}, suffix='', save=save_arrays, load=load_arrays)
+                return pipeline.get('arrays')
+            get_arrays(2)
+            arrays=get_arrays(2)
+            self.assertIsInstance(arrays['data'], np.memmap)
+            self.assertEqual(list(arrays['data']),[0,2,4])
+            self.assertEqual(list(arrays['shots']),[1,1,2])
+            # only the entry in use is kept
+            get_arrays(3)
+            self.assertEqual(len(os.listdir(tmp_dir)),1)
+
 class TestModels(unittest.TestCase):
     def test_ian_rnn(self, use_gpu=True):
         state_length=2
@@ -366,6 +663,192 @@ class TestModels(unittest.TestCase):
         # check that lstm works at all (don't have a careful test for output correctness)
         model(test_input,reset_probability=0)
         model(test_input,reset_probability=1)
+    def test_reset_mask(self):
+        # deterministic stepping resets every int(1/p) steps after warmup, like the old per-step counter
+        reset_mask=get_reset_mask(2, 10, reset_probability=1./3, nwarmup=2, deterministic=True)
+        desired_times=[0,1,2,5,8]
+        self.assertTrue(torch.equal(reset_mask[0], torch.tensor([t in desired_times for t in range(10)])))
+        self.assertTrue(torch.equal(reset_mask[0], reset_mask[1]))
+        # warmup is always reset, otherwise probabilistic resets are per sample
+        torch.manual_seed(0)
+        reset_mask=get_reset_mask(50, 10, reset_probability=0.5, nwarmup=1)
+        self.assertTrue(reset_mask[:,:2].all())
+        self.assertFalse(torch.equal(reset_mask[0], reset_mask[1]))
+        self.assertFalse(get_reset_mask(3, 10, reset_probability=0, nwarmup=1)[:,2:].any())
+        # resetting every step in the rollout loop is the same as teacher forcing
+        torch.manual_seed(0)
+        model=IanRNN(input_dim=6, output_dim=4, encoder_dim=8, rnn_dim=8, decoder_dim=8)
+        test_input=torch.rand((3,7,6))
+        self.assertTrue(torch.allclose(model(test_input,reset_probability=0.99,deterministic=True),
+                                       model(test_input,reset_probability=1),atol=1e-6))
+    def test_rollout_step(self):
+        # the in-place (no_grad) and traced rollouts give the same answer as the autograd one
+        torch.manual_seed(0)
+        test_input=torch.rand((3,7,6))
+        models=[IanRNN(input_dim=6, output_dim=4, encoder_dim=8, rnn_dim=8, decoder_dim=8, rnn_type=rnn_type)
+                for rnn_type in ['lstm','linear']]
+        models+=[EnsembleIanRNN(input_dim=6, output_dim=4, num_members=2, encoder_dim=8, rnn_dim=8, decoder_dim=8, rnn_type=rnn_type)
+                 for rnn_type in ['lstm','linear']]
+        for model in models:
+            model_output=model(test_input,reset_probability=0.5,nwarmup=1,deterministic=True)
+            with torch.no_grad():
+                self.assertTrue(torch.allclose(model(test_input,reset_probability=0.5,nwarmup=1,deterministic=True),
+                                               model_output,atol=1e-6))
+                model.compile_rollout_step('script')
+                self.assertTrue(torch.allclose(model(test_input,reset_probability=0.5,nwarmup=1,deterministic=True),
+                                               model_output,atol=1e-6))
+    def test_incremental_prediction(self):
+        # stepping through the history one row at a time matches rerunning the model over it
+        torch.manual_seed(0)
+        test_input=torch.rand((3,7,6))
+        for model in [IanRNN(input_dim=6, output_dim=4, encoder_dim=8, rnn_dim=8, decoder_dim=8),
+                      IanRNN(input_dim=6, output_dim=4, encoder_dim=8, rnn_dim=8, decoder_dim=8, rnn_type='linear'),
+                      HiroLRAN(input_dim=6, output_dim=4, latent_dim=5, encoder_dim=8)]:
+            predictor=IncrementalPredictor(model)
+            predictor.warmup(test_input[:,:2])
+            for t_ind in range(2,7):
+                self.assertTrue(torch.allclose(predictor.predict(test_input[:,t_ind]),
+                                               get_fast_profile_prediction(test_input[:,:t_ind+1],model),atol=1e-6))
+    def test_lran_parallel_scan(self):
+        # the scanned latent rollout matches stepping through time, including resets
+        torch.manual_seed(0)
+        model=HiroLRAN(input_dim=6, output_dim=4, latent_dim=5, encoder_dim=8)
+        test_input=torch.rand((3,11,6))
+        for reset_probability in [0,0.3]:
+            torch.manual_seed(1)
+            scan_output=model(test_input,reset_probability=reset_probability,nwarmup=2)
+            torch.manual_seed(1)
+            loop_output=model(test_input,reset_probability=reset_probability,nwarmup=2,parallel_scan=False)
+            self.assertTrue(torch.allclose(scan_output,loop_output,atol=1e-5))
+        # with an eigenvalue above 1 the powers of A overflow over a long sequence, which only
+        # matters to the stretches cut off by resets
+        with torch.no_grad():
+            model.A.weight.copy_(torch.diag(torch.tensor([1.2,0.9,0.5,-0.5,0.1])))
+        test_input=torch.rand((3,1100,6))
+        torch.manual_seed(1)
+        scan_output=model(test_input,reset_probability=0.3,nwarmup=2)
+        torch.manual_seed(1)
+        loop_output=model(test_input,reset_probability=0.3,nwarmup=2,parallel_scan=False)
+        self.assertTrue(torch.isfinite(loop_output).all())
+        self.assertTrue(torch.allclose(scan_output,loop_output,rtol=1e-4,atol=1e-4))
+    def test_lran_prediction_matrices(self):
+        # lifted matrices reproduce the autoregressive latent rollout, and the cache is dropped
+        # once the weights change
+        torch.manual_seed(0)
+        model=HiroLRAN(input_dim=6, output_dim=4, latent_dim=5, encoder_dim=8)
+        z_t=torch.rand((3,6,5))
+        u_t1=torch.rand((3,6,1))
+        reset_mask=torch.zeros((3,6),dtype=torch.bool)
+        reset_mask[:,0]=True
+        with torch.no_grad():
+            scan_output=model.latent_scan(z_t, u_t1, reset_mask)
+            self.assertTrue(torch.allclose(model.predict_latent(z_t[:,0], u_t1), scan_output, atol=1e-6))
+            Phi,Gamma=model.get_prediction_matrices(6)
+            self.assertIs(model.get_prediction_matrices(6)[0], Phi)
+            # shorter horizons reuse the leading blocks
+            self.assertTrue(torch.equal(model.get_prediction_matrices(4)[1], Gamma[:20,:4]))
+            self.assertIs(model.get_prediction_matrices(6)[0], Phi)
+            model.A.weight.mul_(0.5)
+            self.assertIsNot(model.get_prediction_matrices(6)[0], Phi)
+            # inference without resets goes through the lifted prediction
+            for seq_len in [11,7,3]:
+                test_input=torch.rand((3,seq_len,6))
+                torch.manual_seed(1)
+                lifted_output=model(test_input,reset_probability=0,nwarmup=2)
+                torch.manual_seed(1)
+                loop_output=model(test_input,reset_probability=0,nwarmup=2,parallel_scan=False)
+                self.assertTrue(torch.allclose(lifted_output,loop_output,atol=1e-5))
+            self.assertEqual(model.prediction_matrices_cache['horizon'],8)
+    def test_device_consistency(self, use_gpu=True):
+        # outputs stay on the input's device and dtype, with no hidden transfers
+        devices=['cpu']
+        if use_gpu and torch.cuda.is_available():
+            devices.append('cuda')
+        for device in devices:
+            test_input=torch.rand((3,7,6), dtype=torch.float64, device=device)
+            models=[IanRNN(input_dim=6, output_dim=4, encoder_dim=8, rnn_dim=8, decoder_dim=8),
+                    IanRNN(input_dim=6, output_dim=4, encoder_dim=8, rnn_dim=8, decoder_dim=8, rnn_type='linear'),
+                    EnsembleIanRNN(input_dim=6, output_dim=4, num_members=2, encoder_dim=8, rnn_dim=8, decoder_dim=8),
+                    HiroLRAN(input_dim=6, output_dim=4, latent_dim=5, encoder_dim=8)]
+            for model in models:
+                model.to(device=device, dtype=torch.float64)
+                for reset_probability in [1,0.5]:
+                    model_output=model(test_input,reset_probability=reset_probability,nwarmup=2)
+                    self.assertEqual(model_output.dtype, torch.float64)
+                    self.assertEqual(model_output.device.type, device)
+            model=models[-1]
+            model_output=model(test_input,reset_probability=0,parallel_scan=False)
+            self.assertEqual((model_output.dtype,model_output.device.type), (torch.float64,device))
+            inverse=InverseLinear(torch.nn.Linear(4,4).to(device=device, dtype=torch.float64))
+            model_output=inverse(test_input[...,:4])
+            self.assertEqual((model_output.dtype,model_output.device.type), (torch.float64,device))
+    def test_ensemble_ian_rnn(self):
+        # each member of the stacked ensemble should behave exactly like a standalone IanRNN
+        torch.manual_seed(0)
+        state_length=4
+        actuator_length=2
+        hyperparams={'encoder_dim': 16, 'rnn_dim': 8, 'decoder_dim': 16}
+        test_input=torch.rand((5,7,state_length+2*actuator_length))
+        for rnn_type in ['lstm','linear']:
+            ensemble=EnsembleIanRNN(input_dim=state_length+2*actuator_length, output_dim=state_length,
+                                    num_members=3, rnn_type=rnn_type, **hyperparams)
+            for reset_probability in [1,0]:
+                ensemble_output=ensemble(test_input,reset_probability=reset_probability,nwarmup=2)
+                self.assertEqual(ensemble_output.size(),(3,5,7,state_length))
+                for member in range(3):
+                    model=IanRNN(input_dim=state_length+2*actuator_length, output_dim=state_length,
+                                 rnn_type=rnn_type, **hyperparams)
+                    model.load_state_dict(ensemble.member_state_dict(member))
+                    model_output=model(test_input,reset_probability=reset_probability,nwarmup=2)
+                    self.assertTrue(torch.allclose(ensemble_output[member],model_output,atol=1e-6))
+    def test_ensemble_from_members(self):
+        # one batched rollout of stacked members matches looping over the members
+        torch.manual_seed(0)
+        test_input=torch.rand((5,7,8))
+        for rnn_type in ['lstm','linear']:
+            models=[IanRNN(input_dim=8, output_dim=4, encoder_dim=16, rnn_dim=8, decoder_dim=16, rnn_type=rnn_type)
+                    for i in range(3)]
+            ensemble=EnsembleIanRNN.from_members(models)
+            with torch.no_grad():
+                mean,std,member_outputs=ensemble.predict(test_input,reset_probability=0,nwarmup=2,return_members=True)
+                model_outputs=torch.stack([model(test_input,reset_probability=0,nwarmup=2) for model in models])
+            self.assertTrue(torch.allclose(member_outputs,model_outputs,atol=1e-6))
+            self.assertTrue(torch.allclose(mean,model_outputs.mean(dim=0),atol=1e-6))
+            self.assertTrue(torch.allclose(std,model_outputs.std(dim=0,unbiased=False),atol=1e-6))
+        with self.assertRaises(ValueError):
+            EnsembleIanRNN.from_members([models[0], IanRNN(input_dim=8, output_dim=4, encoder_dim=10)])
+    def test_mixed_precision(self):
+        # bf16 autocast of encoder/decoder should track the fp32 loss curve
+        torch.manual_seed(0)
+        state_length=4
+        actuator_length=2
+        test_input=torch.rand((3,6,state_length+2*actuator_length))
+        target=torch.rand((3,6,state_length))
+        loss_fn=torch.nn.MSELoss()
+        for model_class,hyperparams in [(IanRNN, {'encoder_dim': 32, 'rnn_dim': 8, 'decoder_dim': 32}),
+                                        (HiroLRAN, {'latent_dim': 8, 'encoder_dim': 32})]:
+            losses={}
+            for precision in ['fp32','bf16']:
+                torch.manual_seed(1)
+                model=model_class(input_dim=state_length+2*actuator_length, output_dim=state_length,
+                                  **hyperparams)
+                set_model_precision(model, precision)
+                optimizer=torch.optim.Adam(model.parameters(), lr=1e-3)
+                losses[precision]=[]
+                for step in range(5):
+                    optimizer.zero_grad()
+                    model_output=model(test_input,reset_probability=1)
+                    self.assertEqual(model_output.dtype,torch.float32)
+                    loss=loss_fn(model_output,target)
+                    loss.backward()
+                    optimizer.step()
+                    losses[precision].append(loss.item())
+            self.assertTrue(np.allclose(losses['bf16'],losses['fp32'],rtol=5e-2))
+            # outputs come back in the model's own dtype
+            model.double()
+            self.assertEqual(model(test_input.double(),reset_probability=0).dtype,torch.float64)
+        with self.assertRaises(ValueError):
+            set_model_precision(model, 'fp8')
     def test_HiroLinear(self, use_gpu=True):
         state_length=2
         actuator_length=1
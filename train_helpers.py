@@ -1,5 +1,10 @@
 import torch
 import numpy as np
+import os
+import random
+import shutil
+import threading
+import atexit
 import dataSettings
 from customDatasetMakers import get_state_indices_dic
 
@@ -55,3 +60,119 @@ def make_bucket(arrays, bucket_size):
     if len(current_bucket)>0:
         buckets.append(current_bucket)
     return buckets
+
+# split a (shuffled) list of bucket indices across ranks for distributed training,
+# wrapping around so that every rank takes the same number of optimizer steps
+def shard_indices(indices, rank, world_size):
+    indices=list(indices)
+    num_per_rank=-(-len(indices)//world_size)
+    padded_indices=list(indices)
+    while len(padded_indices)<num_per_rank*world_size:
+        padded_indices+=indices
+    return padded_indices[:num_per_rank*world_size][rank::world_size]
+
+# mean of per-bucket losses, summed over all ranks if running distributed
+def distributed_mean(values, device='cpu'):
+    totals=torch.tensor([float(sum(values)), float(len(values))], dtype=torch.float64, device=device)
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        torch.distributed.all_reduce(totals)
+    return (totals[0]/totals[1]).item()
+
+# write to a temporary file then rename, so a job killed mid-write never leaves a corrupt checkpoint
+def save_atomic(obj, filename):
+    tmp_filename=f'{filename}.tmp{os.getpid()}'
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+# everything random in training (bucket shuffles, autoregression resets) draws from these
+def get_rng_state():
+    return {'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            # stored as a tensor rather than numpy array so torch.load doesn't need to unpickle numpy
+            'numpy': [np.random.get_state()[0], torch.from_numpy(np.random.get_state()[1].astype(np.int64)), *np.random.get_state()[2:]],
+            'python': random.getstate()}
+
+def set_rng_state(rng_state):
+    torch.set_rng_state(rng_state['torch'])
+    if torch.cuda.is_available() and len(rng_state['cuda'])>0:
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+    numpy_state=rng_state['numpy']
+    np.random.set_state((numpy_state[0], numpy_state[1].numpy().astype(np.uint32), *numpy_state[2:]))
+    random.setstate(rng_state['python'])
+
+# copy of a (nested) checkpoint dictionary with all tensors moved to CPU memory,
+# so training can keep updating the originals while it's written out
+def snapshot_state(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot_state(value) for key,value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(value) for value in obj)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    return obj
+
+# writes checkpoints from a background thread so training doesn't stall on slow (shared) filesystems
+# if a checkpoint is superseded (same filename submitted again) before being written, only the newest is written
+class CheckpointWriter:
+    def __init__(self):
+        self.pending={}
+        self.num_writing=0
+        self.error=None
+        self.closed=False
+        self.condition=threading.Condition()
+        self.thread=threading.Thread(target=self._write_pending, daemon=True)
+        self.thread.start()
+        # make sure everything gets written even if training dies
+        atexit.register(self.close)
+    # returns the CPU snapshot, which can be passed back in with snapshot=False to reuse it
+    def save(self, state, filename, snapshot=True):
+        if snapshot:
+            state=snapshot_state(state)
+        self._submit(filename, lambda: save_atomic(state, filename))
+        return state
+    def copy(self, source_filename, filename):
+        self._submit(filename, lambda: shutil.copyfile(source_filename, filename))
+    def _submit(self, filename, job):
+        with self.condition:
+            self._raise_error()
+            # drop (rather than overwrite) so jobs stay in submission order
+            self.pending.pop(filename, None)
+            self.pending[filename]=job
+            self.condition.notify_all()
+    def _write_pending(self):
+        while True:
+            with self.condition:
+                while len(self.pending)==0 and not self.closed:
+                    self.condition.wait()
+                if len(self.pending)==0:
+                    return
+                filename=next(iter(self.pending))
+                job=self.pending.pop(filename)
+                self.num_writing+=1
+            try:
+                job()
+            except Exception as e:
+                self.error=e
+            with self.condition:
+                self.num_writing-=1
+                self.condition.notify_all()
+    def _raise_error(self):
+        if self.error is not None:
+            error,self.error=self.error,None
+            raise error
+    # block until everything submitted so far is on disk
+    def flush(self):
+        with self.condition:
+            while len(self.pending)>0 or self.num_writing>0:
+                self.condition.wait()
+        self._raise_error()
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        with self.condition:
+            self.closed=True
+            self.condition.notify_all()
+        self.thread.join()